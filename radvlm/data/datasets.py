@@ -307,6 +307,23 @@ class PadChest_grounding_per_image(Dataset):
 
 
 
+# Other phrases naming the CheXpert pathologies in free-text answers, counted as predictions of
+# the pathology by the classification metrics (see `evaluate_classification`). Plural forms
+# are matched through their singular ("pleural effusions" contains "pleural effusion").
+PATHOLOGY_SYNONYMS = {
+    "Enlarged Cardiomediastinum": ["widened mediastinum", "mediastinal widening", "enlarged mediastinum"],
+    "Cardiomegaly": ["enlarged heart", "heart is enlarged", "cardiac enlargement", "enlarged cardiac silhouette",
+                     "cardiac silhouette is enlarged"],
+    "Lung Lesion": ["lung nodule", "pulmonary nodule", "lung mass", "pulmonary mass"],
+    "Edema": ["oedema"],
+    "Atelectasis": ["atelectatic"],
+    "Pleural Effusion": ["pleural fluid"],
+    "Pleural Other": ["pleural thickening"],
+    "Support Devices": ["support device", "endotracheal tube", "central venous catheter", "nasogastric tube",
+                        "pacemaker"],
+}
+
+
 class CheXpert_Dataset_MM(Dataset):
     """For CheXpert dataset"""
 
@@ -349,6 +366,7 @@ class CheXpert_Dataset_MM(Dataset):
             "Pneumothorax", "Pleural Effusion", "Pleural Other", 
             "Fracture", "Support Devices"
         ])
+        self.pathology_synonyms = PATHOLOGY_SYNONYMS
 
 
         if split in ['valid', 'train']:
@@ -642,6 +660,7 @@ class MIMIC_Dataset_MM(Dataset):
             "Pneumothorax", "Pleural Effusion", "Pleural Other", 
             "Fracture", "Support Devices"
         ])
+        self.pathology_synonyms = PATHOLOGY_SYNONYMS
 
         self.reportspath = os.path.join(datasetpath, 'reports.csv')
         self.reports = pd.read_csv(self.reportspath)
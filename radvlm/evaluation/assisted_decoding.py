@@ -0,0 +1,95 @@
+import time
+
+
+class AssistedDecodingStats:
+    """
+    Measure the efficiency of assisted (speculative) generation with a draft model.
+
+    Forward pre-hooks count the forward passes of the target and draft models, and the
+    target's `generate` is wrapped to count generated tokens and generation time.
+    With assisted generation, every forward pass of the draft model proposes one candidate
+    token, and every forward pass of the target verifies the candidates, accepting some of
+    them and producing one extra token. Therefore:
+
+        accepted tokens = generated tokens - target forward passes
+        acceptance rate = accepted tokens / drafted tokens
+
+    Args:
+        model: The target model.
+        assistant_model: The draft model, or None to only measure throughput.
+    """
+
+    def __init__(self, model, assistant_model=None):
+        self.model = model
+        self.assistant_model = assistant_model
+        self.num_generate_calls = 0
+        self.generated_tokens = 0
+        self.generation_time = 0.0
+        self.target_forward_passes = 0
+        self.draft_forward_passes = 0
+        self._hooks = []
+        self._generate = None
+
+    def _count_target(self, module, args):
+        self.target_forward_passes += 1
+
+    def _count_draft(self, module, args):
+        self.draft_forward_passes += 1
+
+    def _timed_generate(self, *args, **kwargs):
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        start = time.perf_counter()
+        output = self._generate(*args, **kwargs)
+        self.generation_time += time.perf_counter() - start
+        self.num_generate_calls += 1
+        sequences = output if not hasattr(output, "sequences") else output.sequences
+        self.generated_tokens += sequences.shape[-1] - input_ids.shape[-1]
+        return output
+
+    def attach(self):
+        self._hooks.append(self.model.register_forward_pre_hook(self._count_target))
+        if self.assistant_model is not None:
+            self._hooks.append(self.assistant_model.register_forward_pre_hook(self._count_draft))
+        self._generate = self.model.generate
+        self.model.generate = self._timed_generate
+        return self
+
+    def detach(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        if self._generate is not None:
+            del self.model.generate
+            self._generate = None
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.detach()
+
+    def counts(self):
+        return {
+            "num_generate_calls": self.num_generate_calls,
+            "generated_tokens": self.generated_tokens,
+            "generation_time": self.generation_time,
+            "target_forward_passes": self.target_forward_passes,
+            "draft_forward_passes": self.draft_forward_passes,
+        }
+
+
+def summarize_decoding_stats(counts_list):
+    """
+    Merge the counts of several ranks (see `AssistedDecodingStats.counts`) and compute
+    the acceptance rate and generation throughput.
+
+    Returns:
+        dict: acceptance rate, tokens/sec of a single rank and the summed counts.
+    """
+    total = {key: sum(counts[key] for counts in counts_list) for key in counts_list[0]}
+    accepted = total["generated_tokens"] - total["target_forward_passes"]
+    drafted = total["draft_forward_passes"]
+    total["acceptance_rate"] = accepted / drafted if drafted > 0 else 0.0
+    generation_time = total["generation_time"]
+    total["tokens_per_sec"] = total["generated_tokens"] / generation_time if generation_time > 0 else 0.0
+    return total
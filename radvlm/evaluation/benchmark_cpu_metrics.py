@@ -0,0 +1,74 @@
+import gc
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from radvlm.evaluation.vilmedic.cpu_profile import METRIC_CPU_PROFILES, set_cpu_threads
+from radvlm.evaluation.synthetic_reports import generate_report_pairs
+
+METRICS = ["bertscore", "radentitynli"]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compare the CPU throughput and the scores of the BERT-based report metrics under each CPU profile")
+    parser.add_argument('--metrics', type=str, default='bertscore', help=f"Comma-separated list of metrics among: {', '.join(METRICS)}")
+    parser.add_argument('--profiles', type=str, default=','.join(METRIC_CPU_PROFILES), help='Comma-separated list of CPU profiles, the first one is the reference for the tolerance check')
+    parser.add_argument('--num_reports', type=int, default=256, help='Number of (reference, prediction) pairs')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic corpus')
+    parser.add_argument('--num_threads', type=int, default=None, help='Number of CPU threads (defaults to all available cores)')
+    parser.add_argument('--tolerance', type=float, default=0.02, help='Maximum absolute difference of the per-report scores to the reference profile')
+    return parser.parse_args()
+
+
+def load_scorer(metric, cpu_profile):
+    if metric == "bertscore":
+        from radvlm.evaluation.vilmedic.NLG.bertscore.bertscore import BertScore
+        # Without the reference cache, so that every profile embeds the whole corpus
+        return BertScore(device="cpu", cpu_profile=cpu_profile)
+    if metric == "radentitynli":
+        from radvlm.evaluation.vilmedic.RadEntityNLI.RadEntityNLI import RadEntityNLI
+        # Without the NLI, NER and reference caches, so that every profile scores the whole corpus
+        return RadEntityNLI(device="cpu", cpu_profile=cpu_profile, nli_disk_cache=False, reference_cache=False,
+                            ner_cache=False)
+    raise ValueError(f"Unknown metric: {metric}. Choose among: {', '.join(METRICS)}")
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    metrics = [metric.strip() for metric in args.metrics.split(",")]
+    profiles = [profile.strip() for profile in args.profiles.split(",")]
+    print(f"Using {set_cpu_threads(args.num_threads)} CPU threads")
+    references, predictions = generate_report_pairs(args.num_reports, seed=args.seed)
+
+    within_tolerance = True
+    for metric in metrics:
+        reference_scores = None
+        reference_time = None
+        for profile in profiles:
+            scorer = load_scorer(metric, profile)
+            # Warm-up on a few pairs, so that one-time initializations are not timed
+            scorer(references[:4], predictions[:4])
+            start = time.perf_counter()
+            mean_score, scores = scorer(references, predictions)
+            seconds = time.perf_counter() - start
+            scores = np.asarray(scores, dtype=np.float64)
+            message = (f"{metric} - {profile}: {args.num_reports / seconds:.1f} reports/s, "
+                       f"mean score {float(mean_score):.4f}")
+            if reference_scores is None:
+                reference_scores, reference_time = scores, seconds
+            else:
+                max_difference = float(np.abs(scores - reference_scores).max(initial=0.0))
+                passed = max_difference <= args.tolerance
+                within_tolerance = within_tolerance and passed
+                message += (f", {reference_time / seconds:.2f}x the throughput of {profiles[0]}, "
+                            f"max difference {max_difference:.4f} "
+                            f"({'within' if passed else 'above'} the tolerance of {args.tolerance})")
+            print(message)
+            del scorer
+            gc.collect()
+
+    if not within_tolerance:
+        sys.exit(1)
@@ -0,0 +1,90 @@
+import os
+import gc
+import json
+import time
+import argparse
+from torch.utils.data import DataLoader
+
+from radvlm.data.utils import custom_collate_fn
+from radvlm.evaluation.models_loading_inference import load_model_and_processor, CPU_PROFILES
+from radvlm.evaluation.evaluate_instructions import (
+    EVALUATION_TASKS,
+    RESULTS_DIR,
+    load_dataset,
+    process_inference_for_single_instruction,
+    ensure_directory_exists
+)
+from radvlm.evaluation.result_shards import IndexedDataset
+
+from radvlm import DATA_DIR
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compare the CPU inference throughput of the CPU profiles on a small slice of each task")
+    parser.add_argument('--model_name', type=str, required=True, help='The model name to evaluate (llavaov, llavamed, chexagent or a LLaVA-OV checkpoint)')
+    parser.add_argument('--profiles', type=str, default=','.join(CPU_PROFILES), help='Comma-separated list of CPU profiles to compare, the first one is the reference for output agreement')
+    parser.add_argument('--tasks', type=str, default='all', help="Comma-separated list of tasks, or 'all'")
+    parser.add_argument('--num_samples', type=int, default=4, help='Number of samples of each task')
+    parser.add_argument('--num_threads', type=int, default=None, help='Number of CPU threads (defaults to all available cores)')
+    return parser.parse_args()
+
+
+def run_slice(tokenizer, model, processor, dataset, model_name, task, num_samples):
+    """Run inference on the first `num_samples` samples of a task and return (outputs, seconds)."""
+    data_loader = DataLoader(
+        IndexedDataset(dataset),
+        batch_size=1,
+        sampler=list(range(min(num_samples, len(dataset)))),
+        shuffle=False,
+        collate_fn=custom_collate_fn
+    )
+    start = time.perf_counter()
+    output = process_inference_for_single_instruction(
+        tokenizer,
+        model,
+        processor,
+        data_loader,
+        model_name=model_name,
+        task=task
+    )
+    return output, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    profiles = [profile.strip() for profile in args.profiles.split(",")]
+    tasks = EVALUATION_TASKS if args.tasks == 'all' else [task.strip() for task in args.tasks.split(",")]
+
+    datasets = {task: load_dataset(task, DATA_DIR) for task in tasks}
+    results = {}
+    reference_outputs = {}
+    for profile in profiles:
+        tokenizer, model, processor = load_model_and_processor(args.model_name, cpu_profile=profile, num_threads=args.num_threads)
+        results[profile] = {}
+        for task in tasks:
+            output, seconds = run_slice(tokenizer, model, processor, datasets[task], args.model_name, task, args.num_samples)
+            predictions = [sample["output"] for sample in output]
+            if task not in reference_outputs:
+                reference_outputs[task] = predictions
+            agreement = sum(pred == ref for pred, ref in zip(predictions, reference_outputs[task])) / max(len(predictions), 1)
+            results[profile][task] = {
+                "num_samples": len(output),
+                "seconds": seconds,
+                "seconds_per_sample": seconds / max(len(output), 1),
+                "output_agreement": agreement,
+            }
+            print(f"{profile} - {task}: {results[profile][task]['seconds_per_sample']:.2f} s/sample, "
+                  f"{agreement:.2f} of the outputs identical to {profiles[0]}")
+        del tokenizer, model, processor
+        gc.collect()
+
+    print(f"{'task':<28}" + "".join(f"{profile:>12}" for profile in profiles) + "   (seconds per sample)")
+    for task in tasks:
+        print(f"{task:<28}" + "".join(f"{results[profile][task]['seconds_per_sample']:>12.2f}" for profile in profiles))
+
+    ensure_directory_exists(RESULTS_DIR)
+    results_path = os.path.join(RESULTS_DIR, f"{os.path.basename(args.model_name)}_cpu_profiles_benchmark.json")
+    with open(results_path, "w") as json_file:
+        json.dump(results, json_file)
+    print(f"Results saved to {results_path}")
@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import tempfile
+import multiprocessing
+from queue import Empty
+
+from radvlm.evaluation.synthetic_reports import generate_report_pairs
+
+# Throughput of each report metric on synthetic corpora of increasing size. Every (metric, size)
+# run happens in a fresh process, so that its peak RSS only counts its own scorer and corpus,
+# and nothing (scorer, cache) is shared between runs. Disk caches are disabled so that the
+# whole corpus is scored. When a checkpoint cannot be loaded (e.g. offline), the tiny
+# stand-in models of `stand_in_metrics.py` are used instead, which is recorded in the results.
+
+METRICS = ["bleu", "ciderd", "rouge1", "rouge2", "rougel", "rouge", "bertscore", "radgraph", "chexbert",
+           "radentitymatchexact", "radentitynli"]
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the throughput and peak memory of the report metrics on synthetic corpora")
+    parser.add_argument('--metrics', type=str, default=','.join(METRICS), help=f"Comma-separated list of metrics among: {', '.join(METRICS)}")
+    parser.add_argument('--sizes', type=str, default='1000,10000,100000', help='Comma-separated numbers of (reference, prediction) pairs')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic corpora')
+    parser.add_argument('--device', type=str, default=None, help='Device of the model-based metrics (CUDA when available by default)')
+    parser.add_argument('--stand_in', type=str, default='auto', choices=['auto', 'always', 'never'],
+                        help='Use the tiny stand-in models when a checkpoint cannot be loaded (auto), for all model-based metrics (always), or never')
+    parser.add_argument('--stand_in_dir', type=str, default=os.path.join(tempfile.gettempdir(), "radvlm_tiny_bert"), help='Directory of the tiny stand-in BERT')
+    parser.add_argument('--max_seconds', type=float, default=None, help='Skip the sizes of a metric whose time, extrapolated linearly from the previous size, exceeds this budget')
+    parser.add_argument('--output', type=str, default=os.path.join(script_dir, 'results', 'metric_benchmark.json'), help='JSON file of the results')
+    return parser.parse_args()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def load_metric(metric, device, stand_in_dir=None):
+    """
+    Create the scorer of `metric` (with the stand-in models if `stand_in_dir` is given) and
+    return a function scoring (references, predictions) as `utils.calcAllMetrics_whole` does.
+    """
+    from radvlm.evaluation.vilmedic import registry
+    from radvlm.evaluation.vilmedic import utils
+
+    if stand_in_dir is not None:
+        from radvlm.evaluation import stand_in_metrics
+    if metric == "bleu":
+        registry.get_scorer("bleu")
+        return utils.calcBLEU
+    if metric == "ciderd":
+        registry.get_scorer("ciderd")
+        return utils.calcCiderD
+    if metric in ["rouge1", "rouge2", "rougel"]:
+        registry.get_scorer(metric)
+        return lambda refs, hyps: utils.calcRouge(refs, hyps, rouges=metric)
+    if metric == "rouge":
+        registry.get_scorer("rouge")
+        return utils.calcRougeAll
+    if metric == "bertscore":
+        from radvlm.evaluation.vilmedic.NLG.bertscore.bertscore import BertScore
+        bert_scorer = stand_in_metrics.stand_in_bert_scorer(stand_in_dir, device) if stand_in_dir else None
+        registry.set_scorer("bertscore", BertScore(device=device, reference_cache=False, bert_scorer=bert_scorer))
+        return utils.calcBertScore
+    if metric == "radgraph":
+        if stand_in_dir is not None:
+            registry.set_scorer("radgraph", stand_in_metrics.StandInF1RadGraph(stand_in_dir, device))
+        registry.get_scorer("radgraph")
+        return lambda refs, hyps: utils.calcF1RadGraph(refs, hyps, batch=True)
+    if metric == "chexbert":
+        if stand_in_dir is not None:
+            registry.set_scorer("chexbert", stand_in_metrics.StandInF1CheXbert(stand_in_dir, device))
+        registry.get_scorer("chexbert")
+        return utils.calcChexbert
+    if metric == "radentitymatchexact":
+        from radvlm.evaluation.vilmedic.RadEntityMatchExact.RadEntityMatchExact import RadEntityMatchExact
+        scorer = RadEntityMatchExact(ner_cache=False, ner=stand_in_metrics.LexiconNER() if stand_in_dir else None)
+        # The stanza pipeline is otherwise loaded by the first (timed) call
+        scorer.ner
+        return scorer
+    if metric == "radentitynli":
+        from radvlm.evaluation.vilmedic.RadEntityNLI.RadEntityNLI import RadEntityNLI
+        stand_ins = {}
+        if stand_in_dir is not None:
+            stand_ins = {
+                "ner": stand_in_metrics.LexiconNER(),
+                "nli_model": stand_in_metrics.stand_in_nli_model(stand_in_dir),
+                "bert_scorer": stand_in_metrics.stand_in_bert_scorer(stand_in_dir, device),
+            }
+        scorer = RadEntityNLI(device=device, nli_disk_cache=False, ner_cache=False, reference_cache=False, **stand_ins)
+        scorer.match_exact.ner
+        return scorer
+    raise ValueError(f"Unknown metric: {metric}. Choose among: {', '.join(METRICS)}")
+
+
+def _create_scorer(metric, device, stand_in, stand_in_dir):
+    """(scoring function, reason for using the stand-in models or None)."""
+    model_based = metric in ["bertscore", "radgraph", "chexbert", "radentitymatchexact", "radentitynli"]
+    if not model_based or stand_in == "never":
+        return load_metric(metric, device), None
+    if stand_in == "always":
+        return load_metric(metric, device, stand_in_dir), "--stand_in always"
+    try:
+        return load_metric(metric, device), None
+    except (ImportError, OSError) as error:
+        print(f"{metric}: cannot load the checkpoint ({type(error).__name__}: {error}), using the stand-in models")
+        return load_metric(metric, device, stand_in_dir), f"{type(error).__name__}: {error}"
+
+
+def run_benchmark(metric, num_pairs, seed, device, stand_in, stand_in_dir):
+    """Score a corpus of `num_pairs` pairs with `metric`, in the current (fresh) process."""
+    from radvlm.evaluation.vilmedic import registry
+
+    if device is not None:
+        registry.set_device(device)
+    device = registry.get_device()
+    references, predictions = generate_report_pairs(num_pairs, seed=seed)
+    baseline_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    scorer, stand_in_reason = _create_scorer(metric, device, stand_in, stand_in_dir)
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    scorer(references, predictions)
+    seconds = time.perf_counter() - start
+    return {
+        "metric": metric,
+        "num_pairs": num_pairs,
+        "device": str(device),
+        "stand_in": stand_in_reason is not None,
+        "stand_in_reason": stand_in_reason,
+        "load_seconds": load_seconds,
+        "seconds": seconds,
+        "pairs_per_sec": num_pairs / seconds,
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _run_in_child(queue, *args):
+    try:
+        queue.put(run_benchmark(*args))
+    except Exception as error:
+        queue.put({"metric": args[0], "num_pairs": args[1], "error": f"{type(error).__name__}: {error}"})
+
+
+def run_isolated(*args):
+    """`run_benchmark` in a new process, so that its peak RSS and state are its own."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_in_child, args=(queue,) + args)
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            # Killed without reporting, e.g. by the out-of-memory killer
+            if not process.is_alive():
+                result = {"metric": args[0], "num_pairs": args[1], "error": f"exit code {process.exitcode}"}
+                break
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    metrics = [metric.strip().lower() for metric in args.metrics.split(",")]
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)}. Choose among: {', '.join(METRICS)}")
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+    if args.stand_in != "never":
+        from radvlm.evaluation.stand_in_metrics import build_tiny_bert
+        build_tiny_bert(args.stand_in_dir)
+
+    results = {"seed": args.seed, "sizes": sizes, "runs": []}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    for metric in metrics:
+        previous = None
+        for num_pairs in sizes:
+            if args.max_seconds is not None and previous is not None and "seconds" in previous:
+                projected = previous["seconds"] * num_pairs / previous["num_pairs"]
+                if projected > args.max_seconds:
+                    print(f"{metric} - {num_pairs} pairs: skipped, about {projected:.0f} s expected")
+                    results["runs"].append({"metric": metric, "num_pairs": num_pairs,
+                                            "skipped": f"about {projected:.0f} s expected"})
+                    continue
+            result = run_isolated(metric, num_pairs, args.seed, args.device, args.stand_in, args.stand_in_dir)
+            results["runs"].append(result)
+            if "error" in result:
+                print(f"{metric} - {num_pairs} pairs: failed ({result['error']})")
+                break
+            print(f"{metric} - {num_pairs} pairs{' (stand-in)' if result['stand_in'] else ''}: "
+                  f"{result['pairs_per_sec']:.1f} pairs/sec, {result['seconds']:.1f} s "
+                  f"(+{result['load_seconds']:.1f} s to load), peak RSS {result['peak_rss_mb']:.0f} MB "
+                  f"({result['baseline_rss_mb']:.0f} MB before loading)")
+            previous = result
+            # Written after every run, so that the results of a long benchmark are kept if it is stopped
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
@@ -0,0 +1,74 @@
+import time
+import argparse
+
+from radvlm.evaluation.vilmedic.NLG.bleu.bleu_scorer import BleuScorer
+from radvlm.evaluation.vilmedic.NLG.ciderD.ciderD_scorer import CiderScorer
+from radvlm.evaluation.vilmedic.concurrent_metrics import compute_bleu_ciderd
+from radvlm.evaluation.vilmedic.NLG.ngrams import NgramFeaturizer, cook_bleu_counts
+from radvlm.evaluation.synthetic_reports import generate_report_pairs
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the shared n-gram featurization of BLEU and CIDEr-D on a fixed synthetic corpus")
+    parser.add_argument('--num_reports', type=int, default=100000, help='Number of (reference, prediction) pairs')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic corpus')
+    return parser.parse_args()
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def string_scores(references, predictions):
+    """Previous behaviour: each scorer cooks its own tuple-keyed n-gram counts."""
+    bleu_scorer = BleuScorer(n=4)
+    cider_scorer = CiderScorer(n=4)
+    for reference, prediction in zip(references, predictions):
+        bleu_scorer += (prediction, [reference])
+        cider_scorer += (prediction, [reference])
+    score, scores = bleu_scorer.compute_score(option='closest', verbose=0)
+    return (score[3], scores[3]), cider_scorer.compute_score()
+
+
+def string_cooking(references, predictions):
+    bleu_scorer = BleuScorer(n=4)
+    cider_scorer = CiderScorer(n=4)
+    for reference, prediction in zip(references, predictions):
+        bleu_scorer += (prediction, [reference])
+        cider_scorer += (prediction, [reference])
+    cider_scorer.compute_doc_freq()
+
+
+def shared_cooking(references, predictions):
+    featurizer = NgramFeaturizer(n=4)
+    reference_counts = featurizer.featurize(references)
+    prediction_counts = featurizer.featurize(predictions)
+    cook_bleu_counts(reference_counts, prediction_counts)
+    cider_scorer = CiderScorer(n=4)
+    cider_scorer.cook_append_counts(prediction_counts, reference_counts)
+    cider_scorer.compute_doc_freq()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    references, predictions = generate_report_pairs(args.num_reports, seed=args.seed)
+
+    _, string_cooking_time = timed(string_cooking, references, predictions)
+    _, shared_cooking_time = timed(shared_cooking, references, predictions)
+    (string_bleu, string_ciderd), string_time = timed(string_scores, references, predictions)
+    (shared_bleu, shared_ciderd), shared_time = timed(compute_bleu_ciderd, references, predictions)
+
+    # Both implementations must give bit-for-bit identical scores
+    identical = (
+        string_bleu[0] == shared_bleu[0] and string_bleu[1] == shared_bleu[1]
+        and string_ciderd[0] == shared_ciderd[0] and (string_ciderd[1] == shared_ciderd[1]).all()
+    )
+    print(f"BLEU-4: {shared_bleu[0]:.6f}, CIDEr-D: {shared_ciderd[0]:.6f}, identical to the tuple n-grams: {identical}")
+    print(f"N-gram counts and document frequencies ({args.num_reports} pairs): "
+          f"tuples {string_cooking_time:.1f} s, shared int64 keys {shared_cooking_time:.1f} s "
+          f"({string_cooking_time / shared_cooking_time:.1f}x)")
+    print(f"BLEU + CIDEr-D end to end: tuples {string_time:.1f} s, shared int64 keys {shared_time:.1f} s "
+          f"({string_time / shared_time:.1f}x)")
@@ -0,0 +1,53 @@
+import time
+import argparse
+
+from radgraph import F1RadGraph
+
+from radvlm.evaluation.vilmedic.utils import calcF1RadGraph
+from radvlm.evaluation.vilmedic.registry import get_scorer
+from radvlm.evaluation.synthetic_reports import generate_report_pairs
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the RadGraph F1 computation on a fixed synthetic corpus")
+    parser.add_argument('--num_pairs', type=int, default=512, help='Number of (reference, prediction) pairs scored with the shared scorer')
+    parser.add_argument('--baseline_pairs', type=int, default=4, help='Number of pairs scored by reloading RadGraph for every pair, as before')
+    parser.add_argument('--batch_size', type=int, default=64, help='Number of pairs per call to the shared scorer')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic corpus')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    references, predictions = generate_report_pairs(args.num_pairs, seed=args.seed)
+
+    # Previous behaviour: a new F1RadGraph (and RadGraph-XL model) for every pair
+    start = time.perf_counter()
+    baseline_rewards = []
+    for reference, prediction in zip(references[:args.baseline_pairs], predictions[:args.baseline_pairs]):
+        baseline_rewards.append(F1RadGraph(reward_level="all", model_type="radgraph-xl")([reference], [prediction])[0])
+    baseline_time = time.perf_counter() - start
+
+    # Shared scorer, loaded once and fed batches of pairs
+    start = time.perf_counter()
+    get_scorer("radgraph")
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    simple, partial, complete, per_sample = calcF1RadGraph(
+        references, predictions, batch=True, batch_size=args.batch_size, return_per_sample=True
+    )
+    shared_time = time.perf_counter() - start
+
+    # Both implementations must give the same per-sample rewards
+    for i, rewards in enumerate(baseline_rewards):
+        shared_rewards = tuple(per_sample[level][i] for level in range(3))
+        if any(abs(a - b) > 1e-9 for a, b in zip(rewards, shared_rewards)):
+            print(f"Mismatch on pair {i}: {rewards} vs {shared_rewards}")
+
+    baseline_speed = 2 * len(baseline_rewards) / baseline_time
+    shared_speed = 2 * len(references) / shared_time
+    print(f"RadGraph F1 (simple/partial/complete): {simple:.4f} / {partial:.4f} / {complete:.4f}")
+    print(f"Reload per pair: {baseline_speed:.2f} reports/sec ({len(baseline_rewards)} pairs)")
+    print(f"Shared scorer:   {shared_speed:.2f} reports/sec ({len(references)} pairs, one-time load {load_time:.1f} s)")
+    print(f"Speedup: {shared_speed / baseline_speed:.1f}x")
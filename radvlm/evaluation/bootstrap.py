@@ -0,0 +1,213 @@
+import argparse
+
+import numpy as np
+
+# Bootstrap confidence intervals and paired significance tests from per-sample scores.
+# Resamples are drawn as one (resamples, samples) matrix of draw counts, so that the
+# statistic of every resample is a matrix product with the per-sample scores instead of
+# a new run of the metric. Per-sample scores come in two forms:
+#
+# - a 1-D array: the metric is the mean of the array (BERTScore, ROUGE, RadGraph rewards,
+#   CheXbert per-sample accuracy, per-sample AP);
+# - a confusion dict {"tp", "fp", "fn": (samples, labels) arrays, "labels": names}: the
+#   metrics are the micro/macro precision, recall and F1 and the per-label F1 of
+#   `evaluate_classification`.
+
+# Upper bound on the size of a chunk of the draw count matrix
+_MAX_CHUNK_ELEMENTS = 1 << 24
+
+
+def resample_counts(num_samples, num_resamples, rng):
+    """(num_resamples, num_samples) matrix of the number of times each sample is drawn."""
+    indices = rng.integers(0, num_samples, size=(num_resamples, num_samples))
+    indices += np.arange(num_resamples)[:, None] * num_samples
+    return np.bincount(indices.ravel(), minlength=num_resamples * num_samples).reshape(num_resamples, num_samples)
+
+
+def _divide(numerator, denominator):
+    # 0 where the denominator is 0, as the `zero_division` default of sklearn
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator, dtype=float), where=denominator != 0)
+
+
+def _f1(precision, recall):
+    return _divide(2 * precision * recall, precision + recall)
+
+
+def confusion_statistics(tp, fp, fn, labels):
+    """
+    Metrics of `evaluate_classification` from (..., labels) true positive, false positive and
+    false negative counts, each metric with the leading shape of the counts.
+    """
+    precision = _divide(tp, tp + fp)
+    recall = _divide(tp, tp + fn)
+    f1 = _f1(precision, recall)
+    tp_all, fp_all, fn_all = tp.sum(axis=-1), fp.sum(axis=-1), fn.sum(axis=-1)
+    precision_micro = _divide(tp_all, tp_all + fp_all)
+    recall_micro = _divide(tp_all, tp_all + fn_all)
+    statistics = {
+        "Precision(macro)": precision.mean(axis=-1),
+        "Precision(micro)": precision_micro,
+        "Recall(macro)": recall.mean(axis=-1),
+        "Recall(micro)": recall_micro,
+        "F1 Score(macro)": f1.mean(axis=-1),
+        "F1 Score(micro)": _f1(precision_micro, recall_micro),
+    }
+    for k, label in enumerate(labels):
+        statistics[label] = f1[..., k]
+    return statistics
+
+
+def _statistics(per_sample, counts):
+    """{metric: (resamples,) values} of the resamples given by `counts`."""
+    statistics = {}
+    for name, scores in per_sample.items():
+        if isinstance(scores, dict):
+            weighted = [counts @ np.asarray(scores[key], dtype=float) for key in ("tp", "fp", "fn")]
+            statistics.update(confusion_statistics(*weighted, scores["labels"]))
+        else:
+            statistics[name] = counts @ np.asarray(scores, dtype=float) / counts.shape[1]
+    return statistics
+
+
+def num_samples_of(per_sample):
+    sizes = {len(scores["tp"]) if isinstance(scores, dict) else len(scores) for scores in per_sample.values()}
+    if len(sizes) != 1:
+        raise ValueError(f"All per-sample scores must have the same number of samples, got {sorted(sizes)}")
+    return sizes.pop()
+
+
+def bootstrap_distributions(per_sample, num_resamples=1000, seed=0, paired_per_sample=None):
+    """
+    Bootstrap distribution of each metric of `per_sample`, over `num_resamples` resamples
+    drawn with `seed`. With `paired_per_sample` (the scores of another model on the same
+    samples, in the same order), its distributions are computed on the same resamples.
+
+    Returns:
+        dict, or (dict, dict) with `paired_per_sample`: {metric: (num_resamples,) array}.
+    """
+    num_samples = num_samples_of(per_sample)
+    if paired_per_sample is not None and num_samples_of(paired_per_sample) != num_samples:
+        raise ValueError("Paired per-sample scores must have the same number of samples")
+    rng = np.random.default_rng(seed)
+    chunk_size = max(1, _MAX_CHUNK_ELEMENTS // max(num_samples, 1))
+    chunks, paired_chunks = [], []
+    for start in range(0, num_resamples, chunk_size):
+        counts = resample_counts(num_samples, min(chunk_size, num_resamples - start), rng)
+        chunks.append(_statistics(per_sample, counts))
+        if paired_per_sample is not None:
+            paired_chunks.append(_statistics(paired_per_sample, counts))
+
+    def concatenate(chunk_list):
+        return {name: np.concatenate([chunk[name] for chunk in chunk_list]) for name in chunk_list[0]}
+
+    if paired_per_sample is not None:
+        return concatenate(chunks), concatenate(paired_chunks)
+    return concatenate(chunks)
+
+
+def point_estimates(per_sample):
+    """Value of each metric on the samples themselves."""
+    return {name: float(values[0]) for name, values in
+            _statistics(per_sample, np.ones((1, num_samples_of(per_sample)))).items()}
+
+
+def confidence_intervals(per_sample, num_resamples=1000, alpha=0.05, seed=0):
+    """{"<metric>_ci_low": ..., "<metric>_ci_high": ...}: percentile intervals at level 1 - alpha."""
+    distributions = bootstrap_distributions(per_sample, num_resamples, seed)
+    intervals = {}
+    for name, values in distributions.items():
+        low, high = np.percentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+        intervals[f"{name}_ci_low"] = float(low)
+        intervals[f"{name}_ci_high"] = float(high)
+    return intervals
+
+
+def paired_p_values(per_sample, other_per_sample, num_resamples=1000, seed=0):
+    """
+    {"<metric>_p_value": ...}: two-sided p-value of the difference of each metric between two
+    models scored on the same samples, with the bootstrap distribution of the difference
+    shifted to the null hypothesis of no difference.
+    """
+    distributions, other_distributions = bootstrap_distributions(
+        per_sample, num_resamples, seed, paired_per_sample=other_per_sample
+    )
+    observed = point_estimates(per_sample)
+    other_observed = point_estimates(other_per_sample)
+    p_values = {}
+    for name, values in distributions.items():
+        difference = observed[name] - other_observed[name]
+        shifted = values - other_distributions[name] - difference
+        extreme = np.count_nonzero(np.abs(shifted) >= abs(difference))
+        p_values[f"{name}_p_value"] = float((extreme + 1) / (num_resamples + 1))
+    return p_values
+
+
+def save_per_sample(path, per_sample, sample_ids):
+    """Save per-sample scores with the ids of their samples to a `.npz` file."""
+    arrays = {"sample_ids": np.asarray(sample_ids)}
+    for name, scores in per_sample.items():
+        if isinstance(scores, dict):
+            for key in ("tp", "fp", "fn"):
+                arrays[f"{name}/{key}"] = np.asarray(scores[key])
+            arrays[f"{name}/labels"] = np.asarray(scores["labels"])
+        else:
+            arrays[name] = np.asarray(scores, dtype=float)
+    np.savez_compressed(path, **arrays)
+
+
+def load_per_sample(path):
+    """Returns (per_sample, sample_ids) saved by `save_per_sample`."""
+    per_sample = {}
+    with np.load(path) as data:
+        sample_ids = data["sample_ids"].tolist()
+        for key in data.files:
+            if key == "sample_ids":
+                continue
+            if "/" in key:
+                name, field = key.split("/", 1)
+                value = data[key].tolist() if field == "labels" else data[key]
+                per_sample.setdefault(name, {})[field] = value
+            else:
+                per_sample[key] = data[key]
+    return per_sample, sample_ids
+
+
+def align_per_sample(per_sample, sample_ids, other_per_sample, other_sample_ids):
+    """Restrict two sets of per-sample scores to their common samples, in the same order."""
+    other_index = {sample_id: i for i, sample_id in enumerate(other_sample_ids)}
+    pairs = [(i, other_index[sample_id]) for i, sample_id in enumerate(sample_ids) if sample_id in other_index]
+    if not pairs:
+        raise ValueError("The two sets of per-sample scores have no sample in common")
+    index, other = (np.array(side) for side in zip(*pairs))
+
+    def select(scores, rows):
+        if isinstance(scores, dict):
+            return {key: value if key == "labels" else np.asarray(value)[rows] for key, value in scores.items()}
+        return np.asarray(scores)[rows]
+
+    names = [name for name in per_sample if name in other_per_sample]
+    return ({name: select(per_sample[name], index) for name in names},
+            {name: select(other_per_sample[name], other) for name in names})
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Paired bootstrap test between the per-sample scores saved by two evaluations of the same task")
+    parser.add_argument('per_sample', type=str, help='Per-sample scores (.npz) of the evaluated model')
+    parser.add_argument('other_per_sample', type=str, help='Per-sample scores (.npz) of the model it is compared to')
+    parser.add_argument('--num_resamples', type=int, default=1000, help='Number of bootstrap resamples')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the resamples')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    per_sample, other_per_sample = align_per_sample(*load_per_sample(args.per_sample), *load_per_sample(args.other_per_sample))
+    estimates = point_estimates(per_sample)
+    other_estimates = point_estimates(other_per_sample)
+    intervals = confidence_intervals(per_sample, args.num_resamples, seed=args.seed)
+    p_values = paired_p_values(per_sample, other_per_sample, args.num_resamples, seed=args.seed)
+    print(f"{num_samples_of(per_sample)} common samples")
+    for name in estimates:
+        print(f"{name}: {estimates[name]:.4f} [{intervals[name + '_ci_low']:.4f}, {intervals[name + '_ci_high']:.4f}] "
+              f"vs {other_estimates[name]:.4f}, p = {p_values[name + '_p_value']:.4f}")
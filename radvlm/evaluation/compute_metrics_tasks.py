@@ -1,9 +1,12 @@
-from sklearn.metrics import precision_recall_fscore_support
 import numpy as np
 import re
+from functools import lru_cache
+from scipy.sparse import csr_matrix
+from faster_coco_eval import COCO, COCOeval_faster
 from radvlm.evaluation.vilmedic.utils import calcAllMetrics_whole
+from radvlm.evaluation.bootstrap import confusion_statistics
 
-def evaluate_results(task, output, dataset):
+def evaluate_results(task, output, dataset, return_per_sample=False, reference_set=None):
     """
     Evaluate the results based on the task.
 
@@ -11,21 +14,29 @@ def evaluate_results(task, output, dataset):
         task (str): The task performed.
         output (list): The inference output.
         dataset (Dataset): The dataset used.
+        return_per_sample (bool): Also return the per-sample scores of the metrics that
+            support bootstrap confidence intervals (see `bootstrap.py`), in the order of `output`.
+        reference_set (str): report_generation only: name under which the CIDEr-D reference
+            statistics are persisted, for runs on the full test set (see `evaluate_reports`).
 
     Returns:
-        dict: The evaluation metrics.
+        dict: The evaluation metrics, and the per-sample scores with `return_per_sample`.
     """
     if task in ["object_grounding", "region_grounding", "abnormality_grounding", "abnormality_detection", "phrase_grounding"]:
-        metrics = evaluate_boxes(output, avg_iou=True)
+        metrics, per_sample = evaluate_boxes(output, avg_iou=True, return_per_sample=True)
+        if task in ["abnormality_grounding", "abnormality_detection"]:
+            metrics.update(evaluate_coco_detection(output, task))
 
     elif task == "abnormality_classification":
         labels = [element.lower() for element in dataset.pathologies] 
-        metrics = evaluate_classification(output, labels)
+        metrics, per_sample = evaluate_classification(output, labels, return_per_sample=True,
+                                                      synonyms=getattr(dataset, "pathology_synonyms", None))
 
     elif task == "report_generation":
         list_predictions = [item["output"] for item in output]
         list_groundtruth = [item["txt"] for item in output]
-        metrics = evaluate_reports(list_groundtruth, list_predictions)
+        metrics, per_sample = evaluate_reports(list_groundtruth, list_predictions, reference_set=reference_set,
+                                               return_per_sample=True)
 
     else:
         raise ValueError(f"Unsupported task: {task}")
@@ -33,15 +44,20 @@ def evaluate_results(task, output, dataset):
     for key, value in metrics.items():
         print(f"{key}: {round(float(value)*100, 1)}")
 
+    if return_per_sample:
+        return metrics, per_sample
     return metrics
 
 
 
-def evaluate_reports(output_report_list, gt_report_list):
+def evaluate_reports(output_report_list, gt_report_list, reference_set=None, return_per_sample=False):
     """
     Evaluate the model's predicted reports against ground truth reports.
     output_report_list (list): List of model outputs(String).
     gt_report_list (list): List of ground truth reports(String).
+    reference_set (str): Name under which the reference statistics of BLEU and CIDEr-D are
+        persisted and reused by later calls with the same references.
+    return_per_sample (bool): Also return the per-sample scores (see `calcAllMetrics_whole`).
     Returns:
         dict: A dictionary containing performance metrics (BLEU, ROUGE, METEOR, CIDEr).
 
@@ -53,9 +69,8 @@ def evaluate_reports(output_report_list, gt_report_list):
          'chexbert_all_micro': 0.8148148148148148, 'chexbert_all_macro': 0.5476190476190476,
          'chexbert_5_micro': 0.9230769230769231, 'chexbert_5_macro': 0.9333333333333332}
     """
-    metrics = calcAllMetrics_whole(output_report_list, gt_report_list)
-
-    return metrics
+    return calcAllMetrics_whole(output_report_list, gt_report_list, reference_set=reference_set,
+                                return_per_sample=return_per_sample)
 
 
 def extract_bounding_boxes(answer):
@@ -63,100 +78,104 @@ def extract_bounding_boxes(answer):
     pattern = r"\[([\d\.]+),\s*([\d\.]+),\s*([\d\.]+),\s*([\d\.]+)\]"
     return [list(map(float, match)) for match in re.findall(pattern, answer)]
 
-def compute_iou(box1, box2):
-    """Compute the Intersection over Union (IoU) of two bounding boxes."""
-    x1 = max(box1[0], box2[0])
-    y1 = max(box1[1], box2[1])
-    x2 = min(box1[2], box2[2])
-    y2 = min(box1[3], box2[3])
+def compute_iou_matrix(boxes1, boxes2):
+    """Compute the IoU between each pair of boxes of two (N, 4) and (M, 4) arrays, as an (N, M) array."""
+    boxes1 = np.asarray(boxes1, dtype=float).reshape(-1, 4)[:, None, :]
+    boxes2 = np.asarray(boxes2, dtype=float).reshape(-1, 4)[None, :, :]
+    x1 = np.maximum(boxes1[..., 0], boxes2[..., 0])
+    y1 = np.maximum(boxes1[..., 1], boxes2[..., 1])
+    x2 = np.minimum(boxes1[..., 2], boxes2[..., 2])
+    y2 = np.minimum(boxes1[..., 3], boxes2[..., 3])
 
-    inter_area = max(0, x2 - x1) * max(0, y2 - y1)
+    inter_area = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
 
-    box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
-    box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
+    box1_area = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    box2_area = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
 
-    iou = inter_area / (box1_area + box2_area - inter_area)
-    return iou
+    union_area = box1_area + box2_area - inter_area
+    # Pairs of degenerate boxes with an empty union get an IoU of 0
+    return np.divide(inter_area, union_area, out=np.zeros_like(inter_area), where=union_area != 0)
 
 def compute_average_precision(recall, precision):
-    """Compute Average Precision (AP) given precision and recall values."""
-    recall = np.concatenate(([0.0], recall, [1.0]))
-    precision = np.concatenate(([0.0], precision, [0.0]))
-    
+    """
+    Compute Average Precision (AP) given precision and recall values.
+    Also accepts (T, N) arrays, one row per IoU threshold, and then returns T values.
+    """
+    recall = np.asarray(recall, dtype=float)
+    precision = np.asarray(precision, dtype=float)
+    pad = np.zeros(recall.shape[:-1] + (1,))
+    recall = np.concatenate((pad, recall, pad + 1.0), axis=-1)
+    precision = np.concatenate((pad, precision, pad), axis=-1)
+
     # Ensure precision is monotonically decreasing
-    for i in range(len(precision) - 1, 0, -1):
-        precision[i - 1] = np.maximum(precision[i - 1], precision[i])
+    precision = np.flip(np.maximum.accumulate(np.flip(precision, axis=-1), axis=-1), axis=-1)
+
+    # Terms where the recall does not change are zero
+    return np.sum((recall[..., 1:] - recall[..., :-1]) * precision[..., 1:], axis=-1)
 
-    indices = np.where(recall[1:] != recall[:-1])[0]
-    ap = np.sum((recall[indices + 1] - recall[indices]) * precision[indices + 1])
-    return ap
 
+def evaluate_boxes(output_list, iou_thresholds=None, avg_iou=False, return_per_sample=False):
+    """
+    Evaluate the model's predicted bounding boxes against ground truth boxes using a custom method.
 
-def evaluate_boxes(output_list, iou_thresholds=None, avg_iou=False):
-    """Evaluate the model's predicted bounding boxes against ground truth boxes using a custom method."""
+    The IoU matrix of each sample is computed once, and all `iou_thresholds` (e.g.
+    COCO's 0.5:0.95) are evaluated in the same pass. Each predicted box, in the order
+    of the output, is matched to the ground truth box with the highest IoU, and counts as a
+    true positive if that IoU reaches the threshold and the ground truth box was not
+    matched by a previous prediction.
+
+    With `return_per_sample`, the AP of each sample is also returned as {"mAP_<threshold>": array}.
+    """
     if iou_thresholds is None:
         iou_thresholds = [0.5]  # Default to 0.5 if no thresholds are provided
-    
+    thresholds = np.asarray(iou_thresholds, dtype=float)
+
     results = {}
     total_iou_sum = 0
     total_boxes_count = 0
+    all_precisions = []
 
-    for iou_threshold in iou_thresholds:
-        all_precisions = []
-        all_recalls = []
-
-        for output_single in output_list:
-            if not ("output" in output_single and "boxes" in output_single):
-                raise ValueError("Both keys 'output' and 'boxes' must be contained in dict.")
-
-            output_text = output_single["output"]
-            predicted_boxes = extract_bounding_boxes(output_text)
-            actual_boxes = output_single["boxes"]
-
-            if len(predicted_boxes) == 0 or len(actual_boxes) == 0:
-                all_precisions.append(0)
-                all_recalls.append(0)
-                continue
-
-            ious = np.zeros((len(predicted_boxes), len(actual_boxes)))
-
-            # Compute IoU between each pair of predicted and ground truth boxes
-            for i, pred_box in enumerate(predicted_boxes):
-                for j, gt_box in enumerate(actual_boxes):
-                    ious[i, j] = compute_iou(pred_box, gt_box)
-
-            # If avg_iou is True, calculate the average IoU across all matches
-            if avg_iou:
-                total_iou_sum += np.sum(ious)
-                total_boxes_count += len(predicted_boxes) * len(actual_boxes)
-
-            # Match predicted boxes to ground truth boxes
-            matched_gt = set()
-            true_positives = np.zeros(len(predicted_boxes))
-            false_positives = np.zeros(len(predicted_boxes))
-
-            for i, pred_box in enumerate(predicted_boxes):
-                max_iou_idx = np.argmax(ious[i, :])
-                max_iou = ious[i, max_iou_idx]
-
-                if max_iou >= iou_threshold and max_iou_idx not in matched_gt:
-                    true_positives[i] = 1
-                    matched_gt.add(max_iou_idx)
-                else:
-                    false_positives[i] = 1
-
-            tp_cumsum = np.cumsum(true_positives)
-            fp_cumsum = np.cumsum(false_positives)
-            recall = tp_cumsum / len(actual_boxes)
-            precision = tp_cumsum / (tp_cumsum + fp_cumsum)
-
-            # Compute average precision for this sample
-            ap = compute_average_precision(recall, precision)
-            all_precisions.append(ap)
-            all_recalls.append(np.max(recall))
-
-        # Compute mean average precision (mAP)
-        mAP = np.mean(all_precisions) if all_precisions else 0.0
+    for output_single in output_list:
+        if not ("output" in output_single and "boxes" in output_single):
+            raise ValueError("Both keys 'output' and 'boxes' must be contained in dict.")
+
+        output_text = output_single["output"]
+        predicted_boxes = extract_bounding_boxes(output_text)
+        actual_boxes = output_single["boxes"]
+
+        if len(predicted_boxes) == 0 or len(actual_boxes) == 0:
+            all_precisions.append(np.zeros(len(thresholds)))
+            continue
+
+        # IoU between each pair of predicted and ground truth boxes
+        ious = compute_iou_matrix(predicted_boxes, actual_boxes)
+
+        # If avg_iou is True, calculate the average IoU across all matches
+        if avg_iou:
+            total_iou_sum += np.sum(ious)
+            total_boxes_count += ious.size
+
+        # Best ground truth box of each prediction, independent of the threshold
+        best_gt = np.argmax(ious, axis=1)
+        best_iou = ious[np.arange(len(predicted_boxes)), best_gt]
+        passes = best_iou[None, :] >= thresholds[:, None]  # (T, P)
+
+        # A passing prediction is a true positive if it is the first passing prediction of its ground truth box
+        best_gt_one_hot = best_gt[:, None] == np.arange(ious.shape[1])[None, :]  # (P, G)
+        num_matches = np.cumsum(passes[:, :, None] & best_gt_one_hot[None, :, :], axis=1)  # (T, P, G)
+        true_positives = passes & (num_matches[:, np.arange(len(predicted_boxes)), best_gt] == 1)
+
+        tp_cumsum = np.cumsum(true_positives, axis=1)
+        fp_cumsum = np.cumsum(~true_positives, axis=1)
+        recall = tp_cumsum / len(actual_boxes)
+        precision = tp_cumsum / (tp_cumsum + fp_cumsum)
+
+        # Compute average precision of this sample for every threshold
+        all_precisions.append(compute_average_precision(recall, precision))
+
+    # Compute mean average precision (mAP)
+    mAPs = np.mean(all_precisions, axis=0) if all_precisions else np.zeros(len(thresholds))
+    for iou_threshold, mAP in zip(iou_thresholds, mAPs):
         results[f"mAP_{iou_threshold}"] = mAP
 
     # Calculate and add average IoU to results if avg_iou is True
@@ -164,69 +183,220 @@ def evaluate_boxes(output_list, iou_thresholds=None, avg_iou=False):
         avg_iou_value = total_iou_sum / total_boxes_count
         results["avg_iou"] = avg_iou_value
 
+    if return_per_sample:
+        sample_aps = np.array(all_precisions).reshape(len(all_precisions), len(thresholds))
+        return results, {f"mAP_{iou_threshold}": sample_aps[:, k] for k, iou_threshold in enumerate(iou_thresholds)}
     return results
 
 
 
-def evaluate_classification(output_list, labels):
+def parse_detection_output(output_text, class_names):
+    """
+    Parse an abnormality detection answer, e.g. "The findings include a nodule/mass located at
+    the coordinates [0.1, 0.2, 0.3, 0.4]; an aortic enlargement located at ...", into
+    (class_name, box) pairs. Each ";"-separated segment is assigned the longest class name
+    found before its first box; segments without a known class name are ignored.
+    """
+    detections = []
+    if not class_names:
+        return detections
+    class_pattern, names_by_lower = _class_name_pattern(tuple(class_names))
+    for segment in output_text.split(";"):
+        boxes = extract_bounding_boxes(segment)
+        if not boxes:
+            continue
+        description = segment[:segment.find("[")].lower()
+        matches = class_pattern.findall(description)
+        if not matches:
+            continue
+        class_name = names_by_lower[max(matches, key=len)]
+        detections.extend((class_name, box) for box in boxes)
+    return detections
+
+
+@lru_cache(maxsize=8)
+def _class_name_pattern(class_names):
+    """Regex matching any of the (lowercased) class names as whole words, longest names first."""
+    names_by_lower = {name.lower(): name for name in class_names}
+    alternation = "|".join(re.escape(name) for name in sorted(names_by_lower, key=len, reverse=True))
+    return re.compile(r"\b(?:" + alternation + r")\b"), names_by_lower
+
+
+def evaluate_coco_detection(output_list, task, canvas_size=1000):
+    """
+    Compute dataset-level COCO detection metrics (AP@[0.5:0.95], AP50 and AR@100, overall and
+    per class) with the C++ evaluator of faster-coco-eval.
+
+    The ground truth and the parsed outputs are converted to COCO structures in memory.
+    Normalized boxes are scaled to a `canvas_size` x `canvas_size` image, so the COCO area
+    ranges are not meaningful and only the "all" range is reported. Generated boxes have no
+    confidence, so all detections get a score of 1.
+
+    Args:
+        output_list (list of dicts): Outputs with "img_path", "output", "boxes", and "labels"
+            (abnormality_detection, one label per box) or "label" (abnormality_grounding).
+        task (str): "abnormality_detection" or "abnormality_grounding".
+        canvas_size (int): Size of the canvas the normalized boxes are scaled to.
+
+    Returns:
+        dict: "coco_AP", "coco_AP50", "coco_AR" and "coco_AP_<class>", "coco_AP50_<class>",
+        "coco_AR_<class>" for each class.
+    """
+    def to_xywh(box):
+        x1, y1, x2, y2 = [coord * canvas_size for coord in box]
+        return [x1, y1, max(0.0, x2 - x1), max(0.0, y2 - y1)]
+
+    # Ground truth of each sample as (class_name, box) pairs
+    samples_gt = []
+    for output_single in output_list:
+        if task == "abnormality_grounding":
+            samples_gt.append([(output_single["label"], box) for box in output_single["boxes"]])
+        else:
+            samples_gt.append(list(zip(output_single["labels"], output_single["boxes"])))
+    class_names = sorted({class_name for sample_gt in samples_gt for class_name, _ in sample_gt})
+    category_ids = {class_name: idx + 1 for idx, class_name in enumerate(class_names)}
+
+    images = {}
+    annotations = []
+    detections = []
+    for output_single, sample_gt in zip(output_list, samples_gt):
+        # Single-label grounding samples of the same image share a COCO image
+        image_id = images.setdefault(output_single.get("img_path", len(images)), len(images) + 1)
+        for class_name, box in sample_gt:
+            bbox = to_xywh(box)
+            annotations.append({
+                "id": len(annotations) + 1,
+                "image_id": image_id,
+                "category_id": category_ids[class_name],
+                "bbox": bbox,
+                "area": bbox[2] * bbox[3],
+                "iscrowd": 0,
+            })
+        if task == "abnormality_grounding":
+            predictions = [(output_single["label"], box) for box in extract_bounding_boxes(output_single["output"])]
+        else:
+            predictions = parse_detection_output(output_single["output"], class_names)
+        for class_name, box in predictions:
+            detections.append([image_id, *to_xywh(box), 1.0, category_ids[class_name]])
+
+    if not detections or not annotations:
+        # Nothing to match: every overall and per-class metric is 0, so the keys do not depend on the outputs
+        metrics = {"coco_AP": 0.0, "coco_AP50": 0.0, "coco_AR": 0.0}
+        for class_name in class_names:
+            metrics[f"coco_AP_{class_name}"] = 0.0
+            metrics[f"coco_AP50_{class_name}"] = 0.0
+            metrics[f"coco_AR_{class_name}"] = 0.0
+        return metrics
+
+    coco_gt = COCO()
+    coco_gt.dataset = {
+        "images": [{"id": image_id, "width": canvas_size, "height": canvas_size} for image_id in images.values()],
+        "annotations": annotations,
+        "categories": [{"id": category_id, "name": class_name} for class_name, category_id in category_ids.items()],
+    }
+    coco_gt.createIndex()
+    coco_dt = coco_gt.loadRes(np.array(detections, dtype=float))
+
+    coco_eval = COCOeval_faster(coco_gt, coco_dt, "bbox", print_function=lambda *args: None, separate_eval=True)
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize()
+    stats = coco_eval.stats_as_dict
+    metrics = {"coco_AP": stats["AP_all"], "coco_AP50": stats["AP_50"], "coco_AR": stats["AR_100"]}
+
+    # Per-class metrics, over the "all" area range and the largest number of detections
+    precision = coco_eval.eval["precision"][:, :, :, 0, -1]  # (IoU thresholds, recall points, classes)
+    recall = coco_eval.eval["recall"][:, :, 0, -1]  # (IoU thresholds, classes)
+    iou_50 = int(np.argmin(np.abs(coco_eval.params.iouThrs - 0.5)))
+
+    def valid_mean(values):
+        values = values[values > -1]
+        return float(values.mean()) if values.size else 0.0
+
+    for k, category_id in enumerate(coco_eval.params.catIds):
+        class_name = class_names[category_id - 1]
+        metrics[f"coco_AP_{class_name}"] = valid_mean(precision[:, :, k])
+        metrics[f"coco_AP50_{class_name}"] = valid_mean(precision[iou_50, :, k])
+        metrics[f"coco_AR_{class_name}"] = valid_mean(recall[:, k])
+    return metrics
+
+
+
+@lru_cache(maxsize=8)
+def _label_matcher(labels, synonyms=()):
+    """
+    Regex finding, at every position of a lowercased text, the longest label name or synonym
+    starting there, and the indices of the labels implied by each phrase: its own, and those
+    of the shorter phrases it contains, which the regex does not report at the same position.
+    `synonyms` is a tuple of (label, phrases) pairs.
+    """
+    phrases = {}
+    for index, label in enumerate(labels):
+        phrases.setdefault(label.lower(), set()).add(index)
+    label_index = {label.lower(): index for index, label in enumerate(labels)}
+    for label, label_synonyms in synonyms:
+        for phrase in label_synonyms:
+            phrases.setdefault(phrase.lower(), set()).add(label_index[label.lower()])
+    phrases.pop("", None)
+    implied = {
+        phrase: sorted(set().union(*(indices for other, indices in phrases.items() if other in phrase)))
+        for phrase in phrases
+    }
+    alternation = "|".join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True))
+    return re.compile("(?=(" + alternation + "))"), implied
+
+
+def evaluate_classification(output_list, labels, return_per_sample=False, synonyms=None):
     """Process the data to match classification with output and calculate metrics.
+    A label is predicted when its name (or one of its `synonyms`) appears in the output. The
+    outputs are scanned once with a regex of all the names, into sparse predicted and actual
+    label matrices, and all metrics come from the confusion counts of these matrices.
     Args:
         output_list (list of dicts): List of dicts containing model outputs and actual labels.
         labels (list): List of all possible labels.
+        return_per_sample (bool): Also return the confusion rows of each sample (see `bootstrap.py`).
+        synonyms (dict): Other phrases by label, counting as predictions of the label.
     Returns:
-        dict: A dictionary containing processed data and performance metrics (Accuracy, F1 Score).
+        dict: A dictionary containing performance metrics (Precision, Recall, F1 Score).
     """
-    ret = []
-    predicted = []
-    actual = []
-
-    # Create a mapping of labels to indices for compatibility with sklearn functions
     label_to_index = {label.lower(): idx for idx, label in enumerate(labels)}
+    pattern, implied = _label_matcher(
+        tuple(labels),
+        tuple((label, tuple(phrases)) for label, phrases in sorted((synonyms or {}).items()))
+    )
 
+    predicted_indices, predicted_indptr = [], [0]
+    actual_indices, actual_indptr = [], [0]
     for output_single in output_list:
         if not ("output" in output_single and "labels" in output_single):
             raise ValueError("Both keys 'output' and 'labels' must be contained in dict.")
 
-        ret_cell = output_single.copy()
-        output_text = output_single["output"].lower()
-        predicted_labels = [label for label in labels if label.lower() in output_text]
-        actual_labels = [label.lower() for label in output_single["labels"]]
-
-        correct_labels = [label for label in predicted_labels if label in actual_labels]
-        incorrect_labels = [label for label in predicted_labels if label not in actual_labels]
-        missing_labels = [label for label in actual_labels if label not in predicted_labels]
-        predicted_arrays = [1 if label.lower() in predicted_labels else 0 for label in labels]
-        actual_arrays = [1 if label.lower() in actual_labels else 0 for label in labels]
-
-        predicted.append(predicted_arrays)
-        actual.append(actual_arrays)
-        ret_cell["correct_labels"] = correct_labels
-        ret_cell["incorrect_labels"] = incorrect_labels
-        ret_cell["missing_labels"] = missing_labels
-        ret.append(ret_cell)
-
-    predicted = np.array(predicted)
-    actual = np.array(actual)
-    
-    # Calculate macro and micro metrics
-    precision_micro, recall_micro, f1_score_micro, _ = precision_recall_fscore_support(actual, predicted, average='micro')
-    precision_macro, recall_macro, f1_score_macro, _ = precision_recall_fscore_support(actual, predicted, average='macro')
-
-    # Calculate F1 score per label
-    _, _, f1_scores_per_label, _ = precision_recall_fscore_support(actual, predicted, average=None)
-
-    # Organize per-label F1 scores using original label names
-    per_label_f1_scores = {label: f1_score for label, f1_score in zip(labels, f1_scores_per_label)}
-
-    # Metrics dictionary
-    metrics = {
-        "Precision(macro)": precision_macro,
-        "Precision(micro)": precision_micro,
-        "Recall(macro)": recall_macro,
-        "Recall(micro)": recall_micro,
-        "F1 Score(macro)": f1_score_macro,
-        "F1 Score(micro)": f1_score_micro,
-        **per_label_f1_scores
-    }
-    
-    return metrics
\ No newline at end of file
+        found = set(pattern.findall(output_single["output"].lower()))
+        predicted_indices.extend(sorted(set().union(*(implied[phrase] for phrase in found))))
+        predicted_indptr.append(len(predicted_indices))
+        actual_indices.extend(sorted({
+            label_to_index[label.lower()] for label in output_single["labels"] if label.lower() in label_to_index
+        }))
+        actual_indptr.append(len(actual_indices))
+
+    shape = (len(output_list), len(labels))
+    predicted = csr_matrix((np.ones(len(predicted_indices), dtype=int), predicted_indices, predicted_indptr), shape=shape)
+    actual = csr_matrix((np.ones(len(actual_indices), dtype=int), actual_indices, actual_indptr), shape=shape)
+
+    # Confusion counts of each label, from which the micro, macro and per-label metrics are computed
+    true_positives = predicted.multiply(actual).tocsr()
+    tp = np.asarray(true_positives.sum(axis=0)).ravel()
+    fp = np.asarray(predicted.sum(axis=0)).ravel() - tp
+    fn = np.asarray(actual.sum(axis=0)).ravel() - tp
+    metrics = {name: float(value) for name, value in confusion_statistics(tp, fp, fn, labels).items()}
+
+    if return_per_sample:
+        tp_rows = true_positives.toarray()
+        per_sample = {"classification": {
+            "tp": tp_rows,
+            "fp": predicted.toarray() - tp_rows,
+            "fn": actual.toarray() - tp_rows,
+            "labels": list(labels),
+        }}
+        return metrics, per_sample
+    return metrics
@@ -1,10 +1,17 @@
 import json
-from green_score import GREEN
-import os 
+import os
 import argparse
 
+import numpy as np
+from accelerate import PartialState
+
+from radvlm.evaluation.vilmedic.NLG.green.green import GREEN
+
 parser = argparse.ArgumentParser(description="A script to evaluate reports with the GREEN metric.")
 parser.add_argument('--model_name', type=str, default='radialog', help="The VLM to evaluate")
+parser.add_argument('--batch_size', type=int, default=8, help="Maximum number of pairs generated at once by each process")
+parser.add_argument('--max_batch_tokens', type=int, default=8192, help="Maximum number of padded prompt tokens generated at once by each process")
+parser.add_argument('--no_cache', action='store_true', help="Do not read or write the GREEN responses cached on disk")
 args = parser.parse_args()
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -19,8 +26,49 @@ list_groundtruth = [item["txt"] for item in output]
 
 model_name = "StanfordAIMI/GREEN-radllama2-7b"
 
-green_scorer = GREEN(model_name, output_dir=".")
-mean, std, green_score_list, summary, result_df = green_scorer(list_groundtruth, list_predictions)
+distributed_state = PartialState()
+if args.no_cache and distributed_state.num_processes > 1:
+    raise ValueError("The processes share their responses through the cache file, remove --no_cache.")
+green_scorer = GREEN(
+    model_id_or_path=model_name,
+    do_sample=False,
+    batch_size=args.batch_size,
+    return_0_if_no_green_score=True,
+    device=distributed_state.device,
+    cache=not args.no_cache,
+    max_batch_tokens=args.max_batch_tokens,
+)
+
+# Only the pairs missing from the cache are generated, split between the processes, which
+# append their responses to the shared cache file
+pairs = [pair for pair in dict.fromkeys(zip(list_groundtruth, list_predictions)) if pair not in green_scorer.cache]
+if distributed_state.is_main_process:
+    print(f"{len(pairs)} of {len(output)} pairs to score, the others are cached")
+with distributed_state.split_between_processes(pairs) as process_pairs:
+    green_scorer.score_pairs(process_pairs, progress=distributed_state.is_main_process)
+distributed_state.wait_for_everyone()
+
+if distributed_state.is_main_process:
+    if distributed_state.num_processes > 1:
+        green_scorer.cache.reload()
+    mean, green_score_list = green_scorer(list_groundtruth, list_predictions)
+    green_score_list = green_score_list.tolist()
+
+    # Mean count of each type of clinically significant error
+    responses = [result[1] for result in green_scorer.cached_results(list_groundtruth, list_predictions)]
+    error_counts = np.array([
+        green_scorer.model.parse_error_counts(response, green_scorer.model.categories[0])[1] for response in responses
+    ])
+    summary = {
+        sub_category: float(count)
+        for sub_category, count in zip(green_scorer.model.sub_categories, error_counts.mean(axis=0))
+    }
+
+    print(float(mean), float(np.std(green_score_list)))
+    print(json.dumps(summary, indent=2))
 
-print(mean)
-print(summary)
+    green_path = os.path.join(script_dir, 'results', args.model_name + '_report_generation_green.json')
+    with open(green_path, 'w') as file:
+        json.dump({"green_mean": float(mean), "green_std": float(np.std(green_score_list)),
+                   "significant_errors": summary, "greens": green_score_list}, file)
+    print(f"GREEN scores saved to {green_path}")
@@ -2,7 +2,9 @@ import os
 import json
 import argparse
 import random
-from torch.utils.data import DataLoader, DistributedSampler
+import time
+import torch
+from torch.utils.data import DataLoader
 from accelerate import PartialState
 from accelerate.utils import gather_object
     
@@ -16,9 +18,33 @@ from radvlm.data.datasets import (
     MS_CXR
 )
 
-from radvlm.evaluation.models_loading_inference import load_model_and_processor, inference_radialog, inference_llavamed, inference_llavaov, inference_chexagent, inference_maira2_report, inference_maira2_grounding
+from radvlm.evaluation.models_loading_inference import load_model_and_processor, load_draft_model, inference_radialog, inference_llavamed, inference_llavaov, inference_chexagent, inference_maira2_report, inference_maira2_grounding
 from radvlm.evaluation.utils import plot_images_with_Bbox
 from radvlm.evaluation.compute_metrics_tasks import evaluate_results
+from radvlm.evaluation.result_shards import (
+    IndexedDataset,
+    ResultShardWriter,
+    get_shard_dir,
+    clear_shards,
+    load_finished_ids,
+    load_merged_results
+)
+from radvlm.evaluation.scheduling import DynamicChunkSampler
+from radvlm.evaluation.generation_policies import get_generation_policy
+from radvlm.evaluation.assisted_decoding import AssistedDecodingStats, summarize_decoding_stats
+from radvlm.evaluation.profiling import TRACER, get_trace_path, summarize_traces, print_trace_summary
+from radvlm.evaluation.vilmedic.accumulators import ReportMetricsAccumulator
+from radvlm.evaluation.bootstrap import (
+    align_per_sample,
+    confidence_intervals,
+    load_per_sample,
+    paired_p_values,
+    save_per_sample
+)
+from radvlm.evaluation.vilmedic.registry import set_device as set_metrics_device
+from radvlm.evaluation.vilmedic.registry import set_cpu_profile as set_metrics_cpu_profile
+from radvlm.evaluation.vilmedic.registry import get_device as get_metrics_device
+from radvlm.evaluation.vilmedic.registry import set_reference_cache as set_metrics_reference_cache
 
 from radvlm import DATA_DIR
 
@@ -26,6 +52,49 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 RESULTS_DIR = os.path.join(script_dir, "results")
 
 
+# Tasks supported by `load_dataset`
+EVALUATION_TASKS = [
+    "abnormality_classification",
+    "abnormality_grounding",
+    "abnormality_detection",
+    "report_generation",
+    "region_grounding",
+    "phrase_grounding"
+]
+
+
+def add_inference_arguments(parser):
+    """Add the arguments shared by the single-task and multi-task evaluation scripts."""
+    parser.add_argument('--model_name', type=str, required=True, help='The model name to evaluate')
+    parser.add_argument('--num_batches', type=int, default=None, help='Number of batches to process, if none process all')
+    parser.add_argument('--scheduler', type=str, default='static', choices=['static', 'dynamic'], help='static: fixed partition of the dataset per rank, dynamic: ranks pull chunks of samples from a shared queue')
+    parser.add_argument('--chunk_size', type=int, default=8, help='Number of samples pulled at once with the dynamic scheduler')
+    parser.add_argument('--generation_policy', type=str, default='task', choices=['task', 'model_default'], help='task: token budget and stopping criteria adapted to the expected answer of the task, model_default: default budget of the inference functions')
+    parser.add_argument('--draft_model_name', type=str, default=None, help='Small LLaVA-OV checkpoint sharing the tokenizer of the evaluated model, used as draft model for assisted generation (report_generation only, greedy outputs are unchanged)')
+    parser.add_argument('--resume', action='store_true', help='Resume from the result shards of a previous run, skipping finished samples')
+    parser.add_argument('--cpu_profile', type=str, default=None, choices=['bf16', 'fp32', 'int8'], help='Run on CPU with weights in bf16, fp32, or fp32 with dynamic int8 quantization of the linear layers (LLaVA-OV, LLaVA-Med and CheXagent only)')
+    parser.add_argument('--num_threads', type=int, default=None, help='Number of CPU threads used with --cpu_profile (defaults to all available cores)')
+    parser.add_argument('--trace', action='store_true', help='Record per-sample stage timings and token counts to a JSONL trace, and print p50/p95 latencies per stage')
+    parser.add_argument('--streaming_metrics', action='store_true', help='report_generation only: score the reports on each rank as they are generated and merge the metric states, instead of scoring all reports on the main process at the end')
+    parser.add_argument('--bootstrap_resamples', type=int, default=1000, help='Number of bootstrap resamples of the 95%% confidence intervals added to the metrics (0 to disable)')
+    parser.add_argument('--compare_to', type=str, default=None, help='Model evaluated before on the same task: add paired bootstrap p-values of the differences with its metrics')
+    parser.add_argument('--reference_set', type=str, default=None, help='report_generation only: name under which the CIDEr-D statistics of the references are persisted and reused by later full test-set evaluations (e.g. mimic_cxr_test), ignored with --num_batches')
+    parser.add_argument('--bertscore_reference_cache', action='store_true', help='Cache the BERTScore embeddings of the reference reports on disk in fp16 and reuse them in later runs (scores differ from bert_score by about 1e-4)')
+    parser.add_argument('--metrics_cpu_profile', type=str, default=None, choices=['fp32', 'int8'], help='Compute the model-based report metrics on CPU, with the BERTScore encoder in fp32 or with dynamic int8 quantization of its linear layers')
+
+
+def configure_metrics(args):
+    """
+    Run the model-based report metrics on CPU if `--metrics_cpu_profile` is given, and cache
+    the BERTScore reference embeddings with `--bertscore_reference_cache`.
+    """
+    if args.bertscore_reference_cache:
+        set_metrics_reference_cache(True)
+    if args.metrics_cpu_profile is not None:
+        set_metrics_device("cpu")
+        set_metrics_cpu_profile(args.metrics_cpu_profile, args.num_threads)
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Process inference for a single instruction")
     parser.add_argument('--task', type=str, required=True, choices=[
@@ -38,8 +107,7 @@ def parse_arguments():
         "phrase_grounding",
         "vqa"
     ], help='The task to perform')
-    parser.add_argument('--model_name', type=str, required=True, help='The model name to evaluate')
-    parser.add_argument('--num_batches', type=int, default=None, help='Number of batches to process, if none process all')
+    add_inference_arguments(parser)
     return parser.parse_args()
     
 
@@ -116,15 +184,35 @@ def load_dataset(task, data_dir):
     return dataset
 
 
-def process_inference_for_single_instruction(tokenizer, model, processor, data_loader, process_batch_num=None, model_name='llavaov', task='report_generation'):
+def process_inference_for_single_instruction(tokenizer, model, processor, data_loader, process_batch_num=None, model_name='llavaov', task='report_generation', result_writer=None, use_generation_policy=True, assistant_model=None, metric_accumulator=None):
+    """
+    Run inference over the data loader.
+
+    If `result_writer` is given, each result is appended to the rank's shard as soon as
+    it is produced and nothing is kept in memory; otherwise the results are returned.
+    If `use_generation_policy` is set, the token budget and stopping criteria of the task
+    are applied (see `generation_policies.py`), and any text decoded after the expected
+    answer is trimmed and kept under the `extra_output` key for auditing.
+    `assistant_model` is a draft model used for assisted generation with LLaVA-OV checkpoints.
+    If `metric_accumulator` is given (see `vilmedic/accumulators.py`), each generated report
+    is added to it together with its ground truth.
+    """
     ret = []
-    total_batches = len(data_loader)
+    policy = get_generation_policy(task, model_name) if use_generation_policy else None
+    budget_kwargs = {"max_new_tokens": policy.max_new_tokens} if policy is not None else {}
+    num_trimmed = 0
+    try:
+        total_batches = len(data_loader)
+    except TypeError:
+        # The dynamic scheduler does not know in advance how many samples a rank gets
+        total_batches = "?"
     for batch_i, batch in enumerate(data_loader):
         if process_batch_num and batch_i >= process_batch_num:
             break
         if batch_i % 10 == 0:
             print(f"Processing batch {batch_i + 1} / {total_batches}")
         datapoint = batch[0]
+        TRACER.start_sample(datapoint.get("sample_id"), task)
 
         prompt = datapoint["instr"]["question"]
 
@@ -141,7 +229,7 @@ def process_inference_for_single_instruction(tokenizer, model, processor, data_l
                     prompt = "Write an example findings section for the CXR"
                 else:
                     prompt = "Identify any diseases visible in the given CXR. Options:\n atelectasis, cardiomegaly, consolidation, edema, enlarged cardiomediastinum, fracture, lung lesion, lung opacity, pleural effusion, pleural other, pneumonia, pneumothorax, support devices"
-                generated_text = inference_chexagent(model, tokenizer, image_path, prompt)
+                generated_text = inference_chexagent(model, tokenizer, image_path, prompt, **budget_kwargs)
 
             elif task in ['abnormality_grounding', 'phrase_grounding', 'region_grounding']:
 
@@ -164,31 +252,48 @@ def process_inference_for_single_instruction(tokenizer, model, processor, data_l
                         "Identify the position of the following region in the CXR: {}",
                     ]
                 prompt = random.choice(questions_variations).format(datapoint["label"])
-                generated_text = inference_chexagent(model, tokenizer, image_path, prompt, grounding=True)
+                generated_text = inference_chexagent(model, tokenizer, image_path, prompt, grounding=True, **budget_kwargs)
 
         elif model_name == 'llavamed':
-            generated_text, _ = inference_llavamed(model, processor, image_path, prompt)
+            stopping_criteria = policy.stopping_criteria(processor) if policy is not None else None
+            generated_text, _ = inference_llavamed(model, processor, image_path, prompt, stopping_criteria=stopping_criteria, **budget_kwargs)
 
         elif model_name == 'maira2':
             if task == 'report_generation':
-                generated_text = inference_maira2_report(model, processor, image_path, prompt)
+                generated_text = inference_maira2_report(model, processor, image_path, prompt, **budget_kwargs)
             elif task == 'abnormality_grounding' or task == 'phrase_grounding' or task == 'region_grounding':
-                generated_text = inference_maira2_grounding(model, processor, image_path, datapoint['label'])
+                generated_text = inference_maira2_grounding(model, processor, image_path, datapoint['label'], **budget_kwargs)
         else:
             # for llava-ov checkpoint
-            generated_text, _ = inference_llavaov(model, processor, image_path, prompt)
+            stopping_criteria = policy.stopping_criteria(processor.tokenizer) if policy is not None else None
+            generated_text, _ = inference_llavaov(model, processor, image_path, prompt, stopping_criteria=stopping_criteria, assistant_model=assistant_model, **budget_kwargs)
+
+        extra_output = ""
+        if policy is not None:
+            generated_text, extra_output = policy.split_output(generated_text)
+            num_trimmed += bool(extra_output)
 
         # Store results in dictionary 
-        optional_keys = ["id", "idx", "img_path", "img", "labels", "label", "txt", "boxes"]
+        optional_keys = ["sample_id", "id", "idx", "img_path", "labels", "label", "txt", "boxes"]
         ans = {}
         ans["output"] = generated_text
         ans["instr"] = prompt
         ans["answer"] = datapoint['instr']["answer"]
+        if extra_output:
+            ans["extra_output"] = extra_output
         for key in optional_keys:
             if key in datapoint:
                 ans[key] = datapoint[key]
-        ret.append(ans)
+        TRACER.end_sample()
+        if metric_accumulator is not None:
+            metric_accumulator.add(datapoint["txt"], generated_text)
+        if result_writer is not None:
+            result_writer.write(ans)
+        else:
+            ret.append(ans)
 
+    if num_trimmed:
+        print(f"Trimmed the text decoded after the answer of {num_trimmed} samples (kept under 'extra_output')")
     return ret
 
 
@@ -207,6 +312,37 @@ def save_results(metrics, model_name, task, num_batches, output=False):
     print(f"Results saved to {results_path}")
 
 
+def get_per_sample_path(model_name, task, num_batches):
+    filename = f"{os.path.basename(model_name)}_{task}"
+    if num_batches is not None:
+        filename += "_partial"
+    return os.path.join(RESULTS_DIR, filename + "_per_sample.npz")
+
+
+def add_bootstrap_statistics(metrics, per_sample, sample_ids, model_name, task, num_batches, num_resamples, compare_to=None):
+    """
+    Add the bootstrap confidence intervals of the metrics to `metrics`, save the per-sample
+    scores next to the results, and with `compare_to`, add the paired p-values of the
+    differences with the per-sample scores saved by the evaluation of that model.
+    `sample_ids` is None when the per-sample scores are not in the order of the samples.
+    """
+    metrics.update(confidence_intervals(per_sample, num_resamples))
+    if sample_ids is None:
+        if compare_to is not None:
+            print("Paired tests need per-sample scores in sample order, which streaming metrics do not keep.")
+        return
+    ensure_directory_exists(RESULTS_DIR)
+    save_per_sample(get_per_sample_path(model_name, task, num_batches), per_sample, sample_ids)
+    if compare_to is not None:
+        other_path = get_per_sample_path(compare_to, task, num_batches)
+        if not os.path.exists(other_path):
+            print(f"No per-sample scores of {compare_to} for {task} at {other_path}, skipping the paired tests.")
+            return
+        aligned, other_aligned = align_per_sample(per_sample, sample_ids, *load_per_sample(other_path))
+        metrics.update(paired_p_values(aligned, other_aligned, num_resamples))
+        metrics["p_value_reference"] = os.path.basename(compare_to)
+
+
 def display_sample_outputs(output, num_samples=10):
     num_show_output = min(num_samples, len(output))
     for i in range(num_show_output):
@@ -223,61 +359,202 @@ def ensure_directory_exists(path):
         os.makedirs(path, exist_ok=True)
         print(f"Created directory: {path}")
 
-if __name__ == "__main__":
+def evaluate_task(task, model_name, tokenizer, model, processor, distributed_state, dataset=None, num_batches=None, scheduler='static', chunk_size=8, generation_policy='task', resume=False, draft_model=None, trace=False, streaming_metrics=False, bootstrap_resamples=1000, compare_to=None, reference_set=None):
+    """
+    Run inference and evaluation of one task with an already loaded model.
 
-    args = parse_arguments()
-    tokenizer, model, processor = load_model_and_processor(args.model_name)
-        
-    distributed_state = PartialState()
-            
-    model.to(distributed_state.device)
-    model.eval()
+    Args:
+        task (str): The task to evaluate.
+        model_name (str): The name of the evaluated model.
+        tokenizer, model, processor: As returned by `load_model_and_processor`.
+        distributed_state (PartialState): The state of the current process.
+        dataset: The task dataset, loaded with `load_dataset` if None.
+        num_batches (int): Number of batches to process per rank, if None process all.
+        scheduler (str): 'static' or 'dynamic' distribution of the samples across ranks.
+        chunk_size (int): Number of samples pulled at once with the dynamic scheduler.
+        generation_policy (str): 'task' or 'model_default'.
+        resume (bool): Skip the samples already in the result shards of a previous run.
+        draft_model: Draft model for assisted generation (report_generation only).
+        trace (bool): Record per-sample stage timings (see `profiling.py`).
+        streaming_metrics (bool): Score the generated reports on each rank during inference
+            and merge the metric states of the ranks (report_generation only).
+        reference_set (str): Name of the persisted CIDEr-D reference statistics of the full
+            test set (report_generation only), not used when `num_batches` is set.
+
+    Returns:
+        dict: The metrics of the task on the main process, None on the other processes.
+    """
+    # Assisted generation statistics
+    decoding_stats = None
+    if draft_model is not None:
+        if task != 'report_generation' or model_name in ['radialog', 'chexagent', 'llavamed', 'maira2']:
+            raise ValueError("Assisted generation is only supported for report generation with LLaVA-OV checkpoints.")
+        decoding_stats = AssistedDecodingStats(model, draft_model).attach()
+
+    # Report metrics accumulated on each rank while generating
+    metric_accumulator = None
+    if streaming_metrics:
+        if task != 'report_generation':
+            raise ValueError("Streaming metrics are only supported for report generation.")
+        # Scorers on the GPU of each rank, unless the metrics were moved to CPU (`--metrics_cpu_profile`)
+        if get_metrics_device().type != "cpu":
+            set_metrics_device(distributed_state.device)
+        metric_accumulator = ReportMetricsAccumulator()
 
     # Load dataset
-    dataset = load_dataset(args.task, DATA_DIR)
+    if dataset is None:
+        dataset = load_dataset(task, DATA_DIR)
 
-    # Prepare DataLoader
-    sampler = DistributedSampler(
-        dataset,
-        num_replicas=distributed_state.num_processes,
-        rank=distributed_state.process_index
-    )
+    # Result shards: one JSONL file per rank, appended as samples finish
+    shard_dir = get_shard_dir(RESULTS_DIR, model_name, task, num_batches)
+    if not resume and distributed_state.is_main_process:
+        clear_shards(shard_dir)
+    distributed_state.wait_for_everyone()
+    finished_ids = load_finished_ids(shard_dir)
+    if finished_ids:
+        print(f"Resuming: {len(finished_ids)} samples already processed")
+    distributed_state.wait_for_everyone()
+
+    # Prepare DataLoader. Samples are visited in the shuffled order of `DistributedSampler`
+    # (seed 0), identical on all ranks, so that `num_batches` evaluates a fixed random subset
+    order = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(0)).tolist()
+    if scheduler == 'dynamic':
+        indices = DynamicChunkSampler([idx for idx in order if idx not in finished_ids], chunk_size=chunk_size)
+    else:
+        # Strided partition of `DistributedSampler` without its padding, which would give some
+        # samples to two ranks and count them twice in the streaming metrics
+        sampler = order[distributed_state.process_index::distributed_state.num_processes]
+        indices = [idx for idx in sampler if idx not in finished_ids]
     data_loader = DataLoader(
-        dataset,
+        IndexedDataset(dataset),
         batch_size=1,
-        sampler=sampler,
+        sampler=indices,
         shuffle=False,
         collate_fn=custom_collate_fn
     )
 
+    # Per-stage instrumentation
+    if trace:
+        TRACER.enable(get_trace_path(RESULTS_DIR, model_name, task, distributed_state.process_index, num_batches), resume=resume)
+        TRACER.attach(model)
+
     # Run inference
-    output = process_inference_for_single_instruction(
-        tokenizer,
-        model,
-        processor,
-        data_loader,
-        process_batch_num=args.num_batches,
-        model_name=args.model_name, 
-        task=args.task
-    )
+    with ResultShardWriter(shard_dir, distributed_state.process_index) as result_writer:
+        process_inference_for_single_instruction(
+            tokenizer,
+            model,
+            processor,
+            data_loader,
+            process_batch_num=num_batches,
+            model_name=model_name, 
+            task=task,
+            result_writer=result_writer,
+            use_generation_policy=generation_policy == 'task',
+            assistant_model=draft_model,
+            metric_accumulator=metric_accumulator
+        )
+    if metric_accumulator is not None:
+        metric_accumulator.flush()
 
-    # Gather results
+    # Merge the shards of all ranks
+    TRACER.disable()
     distributed_state.wait_for_everyone()
-    output = gather_object(output)
-    if args.task == "report_generation":
-        save_results(output, args.model_name, args.task, args.num_batches, output=True)
-
+    if decoding_stats is not None:
+        decoding_stats.detach()
+        decoding_summary = summarize_decoding_stats(gather_object([decoding_stats.counts()]))
+    if metric_accumulator is not None:
+        metric_accumulators = gather_object([metric_accumulator])
 
     # Evaluate and save results
+    metrics = None
     if distributed_state.is_main_process:
+        output = load_merged_results(shard_dir)
+        if task == "report_generation":
+            save_results(output, model_name, task, num_batches, output=True)
+
         display_sample_outputs(output)
-        if args.task == "region_grounding" or args.task=="abnormality_grounding" or args.task=="phrase_grounding":
-            plot_images_with_Bbox(output, num_samples=16, results_dir=RESULTS_DIR)
+        if task == "region_grounding" or task=="abnormality_grounding" or task=="phrase_grounding":
+            plot_images_with_Bbox(output, num_samples=16, results_dir=RESULTS_DIR, filename=f"{task}_images_with_bboxes.png")
+
+        metrics_start = time.perf_counter()
+        if metric_accumulator is not None:
+            metric_accumulator = metric_accumulators[0]
+            for other in metric_accumulators[1:]:
+                metric_accumulator.merge(other)
+            # Samples of a previous run were not generated, hence not accumulated, by this one
+            metric_accumulator.update(
+                [item["txt"] for item in output if item.get("sample_id") in finished_ids],
+                [item["output"] for item in output if item.get("sample_id") in finished_ids]
+            )
+            metrics, per_sample = metric_accumulator.compute(return_per_sample=True)
+            # Accumulated in the order of generation on each rank
+            sample_ids = None
+            for key, value in metrics.items():
+                print(f"{key}: {round(float(value)*100, 1)}")
+        else:
+            # Only the full test set has the references of the persisted statistics
+            metrics, per_sample = evaluate_results(task, output, dataset, return_per_sample=True,
+                                                   reference_set=reference_set if num_batches is None else None)
+            sample_ids = [item.get("sample_id", idx) for idx, item in enumerate(output)]
+        if bootstrap_resamples > 0:
+            add_bootstrap_statistics(metrics, per_sample, sample_ids, model_name, task, num_batches,
+                                     bootstrap_resamples, compare_to)
+        metrics_time = time.perf_counter() - metrics_start
+        if trace:
+            trace_dir = os.path.dirname(get_trace_path(RESULTS_DIR, model_name, task, 0, num_batches))
+            trace_summary = summarize_traces(trace_dir)
+            trace_summary["metrics_time"] = metrics_time
+            print_trace_summary(trace_summary)
+            print(f"Metric computation: {metrics_time:.1f} s")
+            with open(os.path.join(trace_dir, "summary.json"), "w") as json_file:
+                json.dump(trace_summary, json_file)
+        if decoding_stats is not None:
+            print(f"Assisted generation: acceptance rate {decoding_summary['acceptance_rate']:.3f}, "
+                  f"{decoding_summary['tokens_per_sec']:.1f} tokens/sec per process")
+            metrics["assisted_decoding"] = decoding_summary
+        save_results(metrics, model_name, task, num_batches)
+    return metrics
 
-        metrics = evaluate_results(args.task, output, dataset)
-        save_results(metrics, args.model_name, args.task, args.num_batches)
-        
 
+if __name__ == "__main__":
 
+    args = parse_arguments()
+    configure_metrics(args)
+    tokenizer, model, processor = load_model_and_processor(args.model_name, cpu_profile=args.cpu_profile, num_threads=args.num_threads)
+        
+    distributed_state = PartialState()
+            
+    if args.cpu_profile is None:
+        model.to(distributed_state.device)
+    model.eval()
+
+    # Draft model for assisted generation
+    draft_model = None
+    if args.draft_model_name is not None:
+        if args.task != 'report_generation' or args.model_name in ['radialog', 'chexagent', 'llavamed', 'maira2']:
+            raise ValueError("Assisted generation is only supported for report generation with LLaVA-OV checkpoints.")
+        draft_model = load_draft_model(args.draft_model_name, cpu_profile=args.cpu_profile)
+        if args.cpu_profile is None:
+            draft_model.to(distributed_state.device)
+
+    evaluate_task(
+        args.task,
+        args.model_name,
+        tokenizer,
+        model,
+        processor,
+        distributed_state,
+        num_batches=args.num_batches,
+        scheduler=args.scheduler,
+        chunk_size=args.chunk_size,
+        generation_policy=args.generation_policy,
+        resume=args.resume,
+        draft_model=draft_model,
+        trace=args.trace,
+        streaming_metrics=args.streaming_metrics,
+        bootstrap_resamples=args.bootstrap_resamples,
+        compare_to=args.compare_to,
+        reference_set=args.reference_set
+    )
         
     print("Inference and evaluation complete.")
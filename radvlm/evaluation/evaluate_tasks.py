@@ -0,0 +1,104 @@
+import os
+import json
+import argparse
+from accelerate import PartialState
+
+from radvlm.evaluation.models_loading_inference import load_model_and_processor, load_draft_model
+from radvlm.evaluation.evaluate_instructions import (
+    EVALUATION_TASKS,
+    RESULTS_DIR,
+    add_inference_arguments,
+    configure_metrics,
+    evaluate_task,
+    ensure_directory_exists
+)
+from radvlm.evaluation.image_cache import IMAGE_CACHE, FEATURE_CACHE, configure_caches
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Evaluate several tasks in a single process, loading the model once")
+    parser.add_argument('--tasks', type=str, default='all', help=f"Comma-separated list of tasks, or 'all' for: {', '.join(EVALUATION_TASKS)}")
+    add_inference_arguments(parser)
+    parser.add_argument('--image_cache_gb', type=float, default=4, help='Size of the cache of decoded images shared across tasks (0 to disable)')
+    parser.add_argument('--feature_cache_gb', type=float, default=4, help='Size of the cache of preprocessed image tensors shared across tasks (0 to disable)')
+    return parser.parse_args()
+
+
+def parse_tasks(tasks):
+    if tasks == 'all':
+        return list(EVALUATION_TASKS)
+    tasks = [task.strip() for task in tasks.split(",") if task.strip()]
+    unsupported = [task for task in tasks if task not in EVALUATION_TASKS]
+    if unsupported:
+        raise ValueError(f"Unsupported tasks: {', '.join(unsupported)}. Choose among: {', '.join(EVALUATION_TASKS)}")
+    return tasks
+
+
+def save_summary(summary, model_name, num_batches):
+    ensure_directory_exists(RESULTS_DIR)
+    filename = f"{os.path.basename(model_name)}_summary"
+    if num_batches is not None:
+        filename += "_partial"
+    filename += ".json"
+    summary_path = os.path.join(RESULTS_DIR, filename)
+    with open(summary_path, "w") as json_file:
+        json.dump(summary, json_file)
+    print(f"Summary saved to {summary_path}")
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    tasks = parse_tasks(args.tasks)
+    configure_caches(args.image_cache_gb, args.feature_cache_gb)
+    configure_metrics(args)
+
+    tokenizer, model, processor = load_model_and_processor(args.model_name, cpu_profile=args.cpu_profile, num_threads=args.num_threads)
+
+    distributed_state = PartialState()
+
+    if args.cpu_profile is None:
+        model.to(distributed_state.device)
+    model.eval()
+
+    # Draft model for assisted generation, only used for report generation
+    draft_model = None
+    if args.draft_model_name is not None:
+        if 'report_generation' not in tasks or args.model_name in ['radialog', 'chexagent', 'llavamed', 'maira2']:
+            raise ValueError("Assisted generation is only supported for report generation with LLaVA-OV checkpoints.")
+        draft_model = load_draft_model(args.draft_model_name, cpu_profile=args.cpu_profile)
+        if args.cpu_profile is None:
+            draft_model.to(distributed_state.device)
+
+    # Datasets are built lazily inside `evaluate_task`, right before each task runs
+    summary = {}
+    for task in tasks:
+        print(f"==================== {task} ====================")
+        metrics = evaluate_task(
+            task,
+            args.model_name,
+            tokenizer,
+            model,
+            processor,
+            distributed_state,
+            num_batches=args.num_batches,
+            scheduler=args.scheduler,
+            chunk_size=args.chunk_size,
+            generation_policy=args.generation_policy,
+            resume=args.resume,
+            draft_model=draft_model if task == 'report_generation' else None,
+            trace=args.trace,
+            streaming_metrics=args.streaming_metrics and task == 'report_generation',
+            bootstrap_resamples=args.bootstrap_resamples,
+            compare_to=args.compare_to,
+            reference_set=args.reference_set if task == 'report_generation' else None
+        )
+        if distributed_state.is_main_process:
+            summary[task] = metrics
+            print(f"Image cache: {IMAGE_CACHE.stats()}, feature cache: {FEATURE_CACHE.stats()}")
+
+    if distributed_state.is_main_process:
+        summary["caches"] = {"image": IMAGE_CACHE.stats(), "features": FEATURE_CACHE.stats()}
+        save_summary(summary, args.model_name, args.num_batches)
+
+    print("Inference and evaluation complete.")
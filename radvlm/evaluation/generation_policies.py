@@ -0,0 +1,106 @@
+import re
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+# End of the sentence following a bounding box, e.g. "... at [0.12, 0.30, 0.45, 0.62] on the image."
+# Decimal points inside the boxes are never matched since no "[" may appear after the "]".
+BOXES_SENTENCE_END = r"\][^\[\]]*?[.!?](?=\s|$)"
+# End of the first sentence, e.g. "The following abnormalities are present: edema and atelectasis."
+SENTENCE_END = r"[.!?](?=\s|$)"
+
+# Token budgets and stop patterns of the tasks with short structured answers.
+# Tasks not listed here (report generation, vqa) keep the defaults of the inference functions.
+TASK_GENERATION_POLICIES = {
+    "abnormality_grounding": {"max_new_tokens": 128, "stop_pattern": BOXES_SENTENCE_END},
+    "region_grounding": {"max_new_tokens": 96, "stop_pattern": BOXES_SENTENCE_END},
+    "phrase_grounding": {"max_new_tokens": 128, "stop_pattern": BOXES_SENTENCE_END},
+    "object_grounding": {"max_new_tokens": 128, "stop_pattern": BOXES_SENTENCE_END},
+    "abnormality_detection": {"max_new_tokens": 384, "stop_pattern": BOXES_SENTENCE_END},
+    "abnormality_classification": {"max_new_tokens": 96, "stop_pattern": SENTENCE_END},
+}
+
+
+class StructuredAnswerStoppingCriteria(StoppingCriteria):
+    """
+    Stop decoding once the generated text matches `stop_pattern`.
+
+    The prompt length is inferred at the first call, which happens right after the first
+    token has been generated. This holds for both decoder inputs given as token ids and as
+    embeddings (LLaVA-Med), but not for assisted decoding where several tokens can be
+    accepted at once. A new instance must be created for every generation.
+
+    Only the last `window_size` generated tokens are decoded at each step, so the cost of a
+    step does not grow with the length of the answer. The stop patterns match the end of a
+    sentence, which falls within the window; a match that does not fit in it is missed, and
+    decoding then continues up to the token budget before the answer is trimmed by
+    `GenerationPolicy.split_output`.
+    """
+
+    def __init__(self, tokenizer, stop_pattern, window_size=32):
+        self.tokenizer = tokenizer
+        self.stop_pattern = stop_pattern
+        self.window_size = window_size
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[-1] - 1
+        window_start = max(self.prompt_length, input_ids.shape[-1] - self.window_size)
+        generated_text = self.tokenizer.decode(input_ids[0, window_start:], skip_special_tokens=True)
+        is_done = self.stop_pattern.search(generated_text) is not None
+        return torch.full((input_ids.shape[0],), is_done, dtype=torch.bool, device=input_ids.device)
+
+
+class GenerationPolicy:
+    """
+    Generation budget and stopping rule of a task.
+
+    Args:
+        max_new_tokens (int): Maximum number of generated tokens.
+        stop_pattern (str): Regex matching the end of the expected answer, or None to only
+            apply the token budget.
+    """
+
+    def __init__(self, max_new_tokens, stop_pattern=None):
+        self.max_new_tokens = max_new_tokens
+        self.stop_pattern = re.compile(stop_pattern) if stop_pattern is not None else None
+
+    def stopping_criteria(self, tokenizer):
+        """Return a fresh `StoppingCriteriaList` for one call to `generate`, or None."""
+        if self.stop_pattern is None:
+            return None
+        return StoppingCriteriaList([StructuredAnswerStoppingCriteria(tokenizer, self.stop_pattern)])
+
+    def split_output(self, text):
+        """
+        Split a decoded output into the expected answer and the text decoded after it
+        (the remainder of the last generated token, or a continuation produced by a model
+        that was not stopped during decoding).
+
+        Returns:
+            tuple: (answer, extra_text)
+        """
+        if self.stop_pattern is None:
+            return text, ""
+        match = self.stop_pattern.search(text)
+        if match is None:
+            return text, ""
+        return text[:match.end()], text[match.end():].strip()
+
+
+def get_generation_policy(task, model_name):
+    """
+    Return the `GenerationPolicy` of a task for a given model, or None to keep the defaults.
+
+    RaDialog is always prompted for a full report, so no budget is applied. CheXagent and
+    MAIRA-2 answer grounding tasks with their own box format, parsed after decoding, so only
+    the token budget is applied.
+    """
+    policy = TASK_GENERATION_POLICIES.get(task)
+    if policy is None or model_name == 'radialog':
+        return None
+    if model_name in ['chexagent', 'maira2']:
+        return GenerationPolicy(policy["max_new_tokens"])
+    return GenerationPolicy(policy["max_new_tokens"], policy["stop_pattern"])
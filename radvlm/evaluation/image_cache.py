@@ -0,0 +1,92 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from PIL import Image
+
+from radvlm.evaluation.profiling import record_stage
+
+
+class ByteBoundedLRUCache:
+    """
+    Least-recently-used cache bounded by the total size in bytes of its values.
+    A cache with `max_bytes=0` is disabled and stores nothing.
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+        self.misses += 1
+        return None
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        if key in self._data:
+            self.current_bytes -= self._data.pop(key)[1]
+        self._data[key] = (value, nbytes)
+        self.current_bytes += nbytes
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._data.popitem(last=False)
+            self.current_bytes -= evicted_nbytes
+
+    def clear(self):
+        self._data.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Decoded RGB images, shared by all tasks evaluated in the same process
+IMAGE_CACHE = ByteBoundedLRUCache()
+# Prompt-independent preprocessed image tensors, keyed by (model_name, image_path)
+FEATURE_CACHE = ByteBoundedLRUCache()
+
+
+def configure_caches(image_cache_gb=0, feature_cache_gb=0):
+    """Set the size of the image and feature caches (0 disables a cache)."""
+    IMAGE_CACHE.max_bytes = int(image_cache_gb * 1024 ** 3)
+    FEATURE_CACHE.max_bytes = int(feature_cache_gb * 1024 ** 3)
+    IMAGE_CACHE.clear()
+    FEATURE_CACHE.clear()
+
+
+def load_image(image_path):
+    """Open an image as RGB, going through the shared image cache."""
+    image = IMAGE_CACHE.get(image_path)
+    if image is None:
+        with record_stage("image_decode"):
+            image = Image.open(image_path).convert('RGB')
+        IMAGE_CACHE.put(image_path, image, image.width * image.height * 3)
+    return image
+
+
+def get_cached_features(key, compute_features):
+    """
+    Return the tensor cached under `key`, computing it with `compute_features()` on a miss.
+    Only use it for features that do not depend on the prompt.
+    """
+    features = FEATURE_CACHE.get(key)
+    if features is None:
+        features = compute_features()
+        if isinstance(features, torch.Tensor):
+            nbytes = features.element_size() * features.nelement()
+        else:
+            nbytes = np.asarray(features).nbytes
+        FEATURE_CACHE.put(key, features, nbytes)
+    return features
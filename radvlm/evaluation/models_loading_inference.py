@@ -15,6 +15,10 @@ from pathlib import Path
 
 from torchvision.transforms import Compose, Resize, ToTensor, CenterCrop
 
+from radvlm.evaluation.image_cache import load_image, get_cached_features
+from radvlm.evaluation.profiling import record_stage
+from radvlm.evaluation.vilmedic.cpu_profile import apply_cpu_profile, set_cpu_threads
+
 evaluation_dir = os.path.abspath(os.path.dirname(__file__))
 radialog_path = os.path.join(evaluation_dir, "RaDialog")
 if radialog_path not in sys.path:
@@ -31,10 +35,42 @@ from LLAVA_Biovil.llava.constants import IMAGE_TOKEN_INDEX
 
 
 
-def load_model_and_processor(model_name, device_map='cpu'):
+# CPU profiles: dtype in which the weights are loaded. The 'int8' profile loads the weights
+# in fp32 and then applies dynamic int8 quantization to the linear layers.
+CPU_PROFILES = {
+    'bf16': torch.bfloat16,
+    'fp32': torch.float32,
+    'int8': torch.float32,
+}
+CPU_PROFILE_MODELS = ['llavaov', 'llavamed', 'chexagent']
+
+
+def load_model_and_processor(model_name, device_map='cpu', cpu_profile=None, num_threads=None):
+    """
+    Load a model with its tokenizer and/or processor.
+
+    Args:
+        model_name (str): A baseline name or a LLaVA-OV (RadVLM) checkpoint.
+        device_map: Device map passed to `from_pretrained`.
+        cpu_profile (str): One of `CPU_PROFILES` to run on CPU, or None to load the model in
+            its default (GPU) dtype. Only supported for LLaVA-OV checkpoints, LLaVA-Med and CheXagent.
+        num_threads (int): Number of CPU threads used with a CPU profile (defaults to all cores).
 
+    Returns:
+        tuple: (tokenizer, model, processor), where unused entries are None.
+    """
     processor = None
     tokenizer = None
+
+    cpu_dtype = None
+    if cpu_profile is not None:
+        if cpu_profile not in CPU_PROFILES:
+            raise ValueError(f"Unknown CPU profile: {cpu_profile}. Choose among: {', '.join(CPU_PROFILES)}")
+        if model_name in ['radialog', 'maira2', 'qwen2vl']:
+            raise ValueError(f"CPU profiles are only supported for {', '.join(CPU_PROFILE_MODELS)} and LLaVA-OV checkpoints.")
+        cpu_dtype = CPU_PROFILES[cpu_profile]
+        device_map = 'cpu'
+        print(f"Using {set_cpu_threads(num_threads)} CPU threads")
     
     if model_name == 'radialog':
         repo_id = "ChantalPellegrini/RaDialog-interactive-radiology-report-generation"
@@ -54,7 +90,7 @@ def load_model_and_processor(model_name, device_map='cpu'):
     
     elif model_name == 'chexagent':
         model_id = "StanfordAIMI/CheXagent-2-3b"
-        dtype = torch.bfloat16
+        dtype = cpu_dtype if cpu_dtype is not None else torch.bfloat16
         tokenizer = transformers.AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
         model = transformers.AutoModelForCausalLM.from_pretrained(model_id, device_map=device_map, trust_remote_code=True)
         model = model.to(dtype)
@@ -65,7 +101,7 @@ def load_model_and_processor(model_name, device_map='cpu'):
         register_llava_med_hf()
         model = transformers.AutoModelForCausalLM.from_pretrained(
             model_path,
-            torch_dtype=torch.float16,
+            torch_dtype=cpu_dtype if cpu_dtype is not None else torch.float16,
             local_files_only=False,
             device_map=device_map,
             trust_remote_code=True,
@@ -97,7 +133,7 @@ def load_model_and_processor(model_name, device_map='cpu'):
     else:
         # Load llava-ov checkpoint 
         common_kwargs = {
-            "torch_dtype": torch.float16,
+            "torch_dtype": cpu_dtype if cpu_dtype is not None else torch.float16,
             "low_cpu_mem_usage": True, 
         }
 
@@ -111,23 +147,62 @@ def load_model_and_processor(model_name, device_map='cpu'):
         )
         processor = transformers.AutoProcessor.from_pretrained(model_name)
 
+    if cpu_profile is not None:
+        model = apply_cpu_profile(model, cpu_profile)
+
     return tokenizer, model, processor
 
 
+def load_draft_model(draft_model, device_map='cpu', cpu_profile=None):
+    """
+    Prepare a small model used as draft model for assisted generation. The draft model must
+    share the tokenizer of the target checkpoint (e.g. the 0.5B LLaVA-OV model, or a 0.5B
+    RadVLM checkpoint, for a 7B RadVLM target).
+    With a `cpu_profile`, the draft model is prepared like the target (see `CPU_PROFILES`).
+
+    Args:
+        draft_model: A checkpoint name or path ('llavaov-0.5b' for the 0.5B LLaVA-OV model),
+            a model config, from which a randomly initialized model is built (e.g. tiny
+            models for tests), or an already created model.
+        device_map: Device map passed to `from_pretrained` without `cpu_profile`.
+        cpu_profile (str): One of `CPU_PROFILES` to run on CPU, or None for fp16 weights.
+
+    Returns:
+        The draft model, in eval mode.
+    """
+    torch_dtype = torch.float16 if cpu_profile is None else CPU_PROFILES[cpu_profile]
+    if isinstance(draft_model, str):
+        if draft_model == 'llavaov-0.5b':
+            draft_model = 'llava-hf/llava-onevision-qwen2-0.5b-si-hf'
+        draft_model = transformers.AutoModelForImageTextToText.from_pretrained(
+            draft_model,
+            device_map=device_map if cpu_profile is None else 'cpu',
+            torch_dtype=torch_dtype,
+            low_cpu_mem_usage=True
+        )
+    elif isinstance(draft_model, transformers.PretrainedConfig):
+        draft_model = transformers.AutoModelForImageTextToText.from_config(draft_model, torch_dtype=torch_dtype)
+    draft_model.eval()
+    if cpu_profile is not None:
+        draft_model = apply_cpu_profile(draft_model, cpu_profile)
+    return draft_model
+
+
 
 def inference_maira2_report(model, processor, image_path, prompt, grounding=False, max_new_tokens=500):
-    image = Image.open(image_path).convert('RGB') 
-    processed_inputs = processor.format_and_preprocess_reporting_input(
-                current_frontal=image,
-                current_lateral=None,
-                prior_frontal=None,
-                indication=None,
-                technique=None,
-                comparison=None,
-                prior_report=None,
-                return_tensors="pt",
-                get_grounding=False
-                ).to(model.device)
+    image = load_image(image_path)
+    with record_stage("preprocess"):
+        processed_inputs = processor.format_and_preprocess_reporting_input(
+                    current_frontal=image,
+                    current_lateral=None,
+                    prior_frontal=None,
+                    indication=None,
+                    technique=None,
+                    comparison=None,
+                    prior_report=None,
+                    return_tensors="pt",
+                    get_grounding=False
+                    ).to(model.device)
     
     output_decoding = model.generate(
                     **processed_inputs,
@@ -145,12 +220,13 @@ def inference_maira2_report(model, processor, image_path, prompt, grounding=Fals
 
 def inference_maira2_grounding(model, processor, image_path, label, max_new_tokens=500):
 
-    image = Image.open(image_path).convert('RGB') 
-    processed_inputs = processor.format_and_preprocess_phrase_grounding_input(
-        frontal_image=image,
-        phrase=label,
-        return_tensors="pt",
-    ).to(model.device)
+    image = load_image(image_path)
+    with record_stage("preprocess"):
+        processed_inputs = processor.format_and_preprocess_phrase_grounding_input(
+            frontal_image=image,
+            phrase=label,
+            return_tensors="pt",
+        ).to(model.device)
     
     output_decoding = model.generate(
         **processed_inputs, 
@@ -208,11 +284,6 @@ def inference_radialog(tokenizer, model, image_path, prompt, chat_history=None,
     # Check if this is the first turn (single-turn scenario)
     first_turn = (len(chat_history) == 0)
 
-    # Preprocess the image
-    image = Image.open(image_path).convert('RGB')
-    image = remap_to_uint8(np.array(image))
-    image = Image.fromarray(image).convert("L")
-
     model.config.tokenizer_padding_side = "left"
     conv = conv_vicuna_v1.copy()
 
@@ -234,13 +305,19 @@ def inference_radialog(tokenizer, model, image_path, prompt, chat_history=None,
     # Construct the final prompt text
     text_input = conv.get_prompt()
 
-    # Prepare the image tensor
-    vis_transforms_biovil = create_chest_xray_transform_for_inference(512, center_crop_size=448)
-    image_tensor = vis_transforms_biovil(image).unsqueeze(0)
-    image_tensor = image_tensor.to(model.device, dtype=torch.bfloat16)
+    # Preprocess the image (independent of the prompt, so it can be shared across tasks)
+    def preprocess_image():
+        image = remap_to_uint8(np.array(load_image(image_path)))
+        image = Image.fromarray(image).convert("L")
+        vis_transforms_biovil = create_chest_xray_transform_for_inference(512, center_crop_size=448)
+        return vis_transforms_biovil(image).unsqueeze(0)
 
-    # Tokenize input including the image token
-    input_ids = tokenizer_image_token(text_input, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).to(model.device)
+    with record_stage("preprocess"):
+        image_tensor = get_cached_features(('radialog', image_path), preprocess_image)
+        image_tensor = image_tensor.to(model.device, dtype=torch.bfloat16)
+
+        # Tokenize input including the image token
+        input_ids = tokenizer_image_token(text_input, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).to(model.device)
 
     # Stopping criteria
     stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
@@ -284,7 +361,7 @@ def create_chest_xray_transform_for_inference(resize: int, center_crop_size: int
 
 
 
-def inference_llavamed(model, processor, image_path, prompt, chat_history=None, max_new_tokens=500):
+def inference_llavamed(model, processor, image_path, prompt, chat_history=None, max_new_tokens=500, stopping_criteria=None):
     """
     Unified function for LLaVA-Med inference, supporting both single-turn and multi-turn modes.
 
@@ -295,6 +372,7 @@ def inference_llavamed(model, processor, image_path, prompt, chat_history=None,
         prompt: The user message for this turn.
         chat_history: A list of (user_message, assistant_message) for past turns. If None or empty, single-turn mode is used.
         max_new_tokens: Maximum number of new tokens to generate.
+        stopping_criteria: Optional `StoppingCriteriaList` passed to `generate`.
 
     Returns:
         chat_history: The updated chat_history including this turn's user prompt and the assistant's response.
@@ -340,14 +418,14 @@ def inference_llavamed(model, processor, image_path, prompt, chat_history=None,
 
     inputs = {"inputs": input_ids.unsqueeze(0)}
 
-    # If an image is provided (first turn), preprocess and include it
-    image = Image.open(image_path).convert('RGB')
-    if image is not None:
-        inputs["images"] = (
-            model.get_vision_tower()
-            .image_processor.preprocess(image, return_tensors="pt")["pixel_values"]
-            .to(model.device, torch.float16)
+    # Preprocess the image (independent of the prompt, so it can be shared across tasks)
+    with record_stage("preprocess"):
+        pixel_values = get_cached_features(
+            ('llavamed', image_path),
+            lambda: model.get_vision_tower()
+            .image_processor.preprocess(load_image(image_path), return_tensors="pt")["pixel_values"]
         )
+        inputs["images"] = pixel_values.to(model.device, model.dtype)
 
     # Set attention mask
     inputs["attention_mask"] = torch.ones_like(inputs["inputs"])
@@ -364,7 +442,8 @@ def inference_llavamed(model, processor, image_path, prompt, chat_history=None,
         output = model.generate(
             **inputs,
             generation_config=generation_config,
-            max_new_tokens=max_new_tokens
+            max_new_tokens=max_new_tokens,
+            stopping_criteria=stopping_criteria
         )
 
     # Decode the model's output
@@ -379,7 +458,7 @@ def inference_llavamed(model, processor, image_path, prompt, chat_history=None,
 
     
 
-def inference_llavaov(model, processor, image_path, prompt, chat_history=None, max_new_tokens=1500):
+def inference_llavaov(model, processor, image_path, prompt, chat_history=None, max_new_tokens=1500, stopping_criteria=None, assistant_model=None):
     """
     Generate a response using the LLaVA-OV model in either single-turn or multi-turn mode.
 
@@ -392,6 +471,9 @@ def inference_llavaov(model, processor, image_path, prompt, chat_history=None, m
                       If None or empty, single-turn mode is used. Even in single-turn mode, 
                       this function returns chat_history so that you can continue in subsequent turns.
         max_new_tokens: The maximum number of new tokens to generate.
+        stopping_criteria: Optional `StoppingCriteriaList` passed to `generate`.
+        assistant_model: Optional draft model for assisted generation (see `load_draft_model`).
+                         Outputs are identical to standard greedy decoding.
 
     Returns:
         chat_history (list): The updated chat_history including this turn's (prompt, response).
@@ -404,8 +486,7 @@ def inference_llavaov(model, processor, image_path, prompt, chat_history=None, m
 
     # Convert image to the expected shape (C, H, W)
 
-    image = Image.open(image_path).convert('RGB')
-    image = asarray(image.convert('RGB')).transpose(2, 0, 1)
+    image = asarray(load_image(image_path)).transpose(2, 0, 1)
 
     # Prepare the conversation from chat_history
     conversation = []
@@ -466,13 +547,20 @@ def inference_llavaov(model, processor, image_path, prompt, chat_history=None, m
     full_prompt = processor.apply_chat_template(conversation, add_generation_prompt=True)
 
     # Prepare model inputs
-    inputs = processor(images=image, text=full_prompt, return_tensors="pt", padding=True).to(
-        model.device, torch.float16
-    )
+    with record_stage("preprocess"):
+        inputs = processor(images=image, text=full_prompt, return_tensors="pt", padding=True).to(
+            model.device, model.dtype
+        )
 
     # Generate response
     with torch.inference_mode():
-        output = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        output = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            stopping_criteria=stopping_criteria,
+            assistant_model=assistant_model
+        )
 
     full_response = processor.decode(output[0], skip_special_tokens=True)
     response = re.split(r"(user|assistant)", full_response)[-1].strip()
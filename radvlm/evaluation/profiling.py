@@ -0,0 +1,243 @@
+import os
+import json
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+
+STAGES = ["image_decode", "preprocess", "vision_encode", "prefill", "decode", "other", "total"]
+
+_NO_STAGE = nullcontext()
+
+
+class _Stage:
+    """Context manager timing a stage of the current sample (see `StageTracer.stage`)."""
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.tracer._push()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._pop(self.name)
+
+
+class StageTracer:
+    """
+    Record per-sample stage timings and token counts of the evaluation driver.
+
+    Stage timings are exclusive: the time spent in a nested stage (e.g. image decoding
+    inside preprocessing, or vision encoding inside the prefill forward pass) is only
+    counted for the nested stage. Prefill and decode are measured with forward hooks on
+    the model: the first forward pass of a sample is the prefill, and the following ones
+    are decoding steps. The number of output tokens is the number of forward passes,
+    which is exact for greedy decoding but counts verification steps with assisted decoding.
+
+    When the tracer is disabled (the default), `stage` returns a shared no-op context
+    manager and no hooks are attached, so the instrumentation has no measurable cost.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.synchronize = False
+        self._file = None
+        self._hooks = []
+        self._sample = None
+        self._child_time = []
+        self._start_times = []
+
+    def enable(self, trace_path, resume=False):
+        """
+        Start writing one JSON record per sample to `trace_path`. When resuming, the records
+        are appended to the trace of the previous run, as the result shards are.
+        """
+        os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+        needs_newline = False
+        if resume and os.path.exists(trace_path) and os.path.getsize(trace_path) > 0:
+            with open(trace_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._file = open(trace_path, "a" if resume else "w")
+        if needs_newline:
+            # Terminate a record cut by a previous preemption
+            self._file.write("\n")
+        self.enabled = True
+
+    def disable(self):
+        self.detach()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.enabled = False
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _push(self):
+        self._child_time.append(0.0)
+        self._start_times.append(self._now())
+
+    def _pop(self, name):
+        elapsed = self._now() - self._start_times.pop()
+        exclusive = elapsed - self._child_time.pop()
+        if self._child_time:
+            self._child_time[-1] += elapsed
+        if self._sample is not None:
+            stages = self._sample["stages"]
+            stages[name] = stages.get(name, 0.0) + exclusive
+
+    def stage(self, name):
+        """Return a context manager timing the stage `name` of the current sample."""
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    # Forward hooks measuring the vision encoding, prefill and decoding steps
+
+    def _vision_pre_hook(self, module, args):
+        if self._sample is not None:
+            self._push()
+
+    def _vision_hook(self, module, args, output):
+        if self._sample is not None:
+            self._pop("vision_encode")
+
+    def _model_pre_hook(self, module, args, kwargs):
+        if self._sample is None:
+            return
+        if self._sample["forward_passes"] == 0:
+            inputs = kwargs.get("input_ids", args[0] if args else None)
+            if inputs is None:
+                inputs = kwargs.get("inputs_embeds")
+            if inputs is not None:
+                self._sample["prompt_tokens"] = inputs.shape[1]
+        self._push()
+
+    def _model_hook(self, module, args, kwargs, output):
+        if self._sample is None:
+            return
+        self._pop("prefill" if self._sample["forward_passes"] == 0 else "decode")
+        self._sample["forward_passes"] += 1
+
+    def attach(self, model):
+        """Attach forward hooks to the model and, if it can be found, its vision tower."""
+        if not self.enabled:
+            return self
+        self.synchronize = torch.cuda.is_available() and next(model.parameters()).is_cuda
+        self._hooks.append(model.register_forward_pre_hook(self._model_pre_hook, with_kwargs=True))
+        self._hooks.append(model.register_forward_hook(self._model_hook, with_kwargs=True))
+        vision_tower = find_vision_tower(model)
+        if vision_tower is not None:
+            self._hooks.append(vision_tower.register_forward_pre_hook(self._vision_pre_hook))
+            self._hooks.append(vision_tower.register_forward_hook(self._vision_hook))
+        return self
+
+    def detach(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    # Per-sample records
+
+    def start_sample(self, sample_id=None, task=None):
+        if not self.enabled:
+            return
+        self._child_time = []
+        self._start_times = []
+        self._sample = {"sample_id": sample_id, "task": task, "stages": {}, "prompt_tokens": None, "forward_passes": 0}
+        self._push()
+
+    def end_sample(self):
+        if not self.enabled or self._sample is None:
+            return
+        sample = self._sample
+        # Time of the sample not covered by any stage (prompt building, generation loop, decoding to text)
+        self._pop("other")
+        self._sample = None
+        stages = sample["stages"]
+        stages["total"] = sum(stages.values())
+        generation_time = stages.get("prefill", 0.0) + stages.get("decode", 0.0)
+        output_tokens = sample.pop("forward_passes")
+        sample["output_tokens"] = output_tokens
+        sample["tokens_per_sec"] = output_tokens / generation_time if generation_time > 0 else None
+        self._file.write(json.dumps(sample) + "\n")
+        self._file.flush()
+
+
+# Tracer shared by the evaluation driver and the inference functions, disabled by default
+TRACER = StageTracer()
+
+
+def record_stage(name):
+    """Time the stage `name` of the current sample (no-op when tracing is disabled)."""
+    return TRACER.stage(name)
+
+
+def find_vision_tower(model):
+    """Return the vision encoder of a LLaVA-style model, or None if it cannot be found."""
+    if hasattr(model, "get_vision_tower"):
+        return model.get_vision_tower()
+    for owner in [model, getattr(model, "model", None)]:
+        for name in ["vision_tower", "visual"]:
+            module = getattr(owner, name, None)
+            if isinstance(module, torch.nn.Module):
+                return module
+    return None
+
+
+def get_trace_path(results_dir, model_name, task, rank, num_batches=None):
+    trace_name = f"{os.path.basename(model_name)}_{task}"
+    if num_batches is not None:
+        trace_name += "_partial"
+    return os.path.join(results_dir, trace_name + "_trace", f"rank{rank}.jsonl")
+
+
+def summarize_traces(trace_dir):
+    """
+    Compute the p50 and p95 latency of each stage and of the generation throughput over
+    the traces of all ranks in `trace_dir`.
+
+    Returns:
+        dict: {stage: {"p50": ..., "p95": ..., "mean": ...}} plus the token counts.
+    """
+    records = []
+    for filename in sorted(os.listdir(trace_dir)):
+        if filename.endswith(".jsonl"):
+            with open(os.path.join(trace_dir, filename)) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        print(f"Skipping incomplete record in {filename}")
+
+    def percentiles(values):
+        if not values:
+            return None
+        values = np.asarray(values, dtype=float)
+        return {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)), "mean": float(values.mean())}
+
+    summary = {"num_samples": len(records)}
+    for stage in STAGES:
+        summary[stage] = percentiles([record["stages"][stage] for record in records if stage in record["stages"]])
+    for key in ["prompt_tokens", "output_tokens", "tokens_per_sec"]:
+        summary[key] = percentiles([record[key] for record in records if record.get(key) is not None])
+    return summary
+
+
+def print_trace_summary(summary):
+    print(f"{'stage':<16}{'p50 (s)':>12}{'p95 (s)':>12}{'mean (s)':>12}")
+    for stage in STAGES:
+        if summary[stage] is not None:
+            print(f"{stage:<16}{summary[stage]['p50']:>12.4f}{summary[stage]['p95']:>12.4f}{summary[stage]['mean']:>12.4f}")
+    for key in ["prompt_tokens", "output_tokens", "tokens_per_sec"]:
+        if summary[key] is not None:
+            print(f"{key:<16}{summary[key]['p50']:>12.1f}{summary[key]['p95']:>12.1f}{summary[key]['mean']:>12.1f}")
@@ -0,0 +1,131 @@
+import os
+import json
+import glob
+import shutil
+
+import numpy as np
+from torch.utils.data import Dataset
+
+
+class IndexedDataset(Dataset):
+    """
+    Wrap a dataset so that every sample carries a stable `sample_id`.
+
+    The id is the index of the sample in the wrapped dataset, which is stable across
+    runs because the evaluation datasets are built deterministically (fixed seeds).
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset[idx]
+        if sample is not None:
+            sample["sample_id"] = idx
+        return sample
+
+
+def get_shard_dir(results_dir, model_name, task, num_batches=None):
+    """
+    Return the directory holding the per-rank result shards of an evaluation run.
+    Follows the naming of the final results files in `save_results`.
+    """
+    dirname = f"{os.path.basename(model_name)}_{task}"
+    if num_batches is not None:
+        dirname += "_partial"
+    return os.path.join(results_dir, dirname + "_shards")
+
+
+def get_shard_path(shard_dir, rank):
+    return os.path.join(shard_dir, f"rank{rank}.jsonl")
+
+
+def clear_shards(shard_dir):
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+        print(f"Removed previous result shards in {shard_dir}")
+
+
+def _to_json(value):
+    """Fallback serializer for numpy / torch values found in datapoints."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def iter_shard_records(shard_dir):
+    """
+    Iterate over the records of all shards in `shard_dir`.
+    A truncated last line (process killed while writing) is skipped.
+    """
+    for path in sorted(glob.glob(os.path.join(shard_dir, "rank*.jsonl"))):
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Skipping incomplete record in {path}")
+
+
+def load_finished_ids(shard_dir):
+    """Return the set of sample ids already present in the shards."""
+    return {record["sample_id"] for record in iter_shard_records(shard_dir)}
+
+
+def load_merged_results(shard_dir):
+    """
+    Merge the shards of all ranks into a single list of results, sorted by sample id.
+    If a sample was written twice (e.g. rank killed after writing but before a restart
+    was scheduled), the first record is kept.
+    """
+    merged = {}
+    for record in iter_shard_records(shard_dir):
+        merged.setdefault(record["sample_id"], record)
+    return [merged[sample_id] for sample_id in sorted(merged)]
+
+
+class ResultShardWriter:
+    """
+    Append-only JSONL writer for the results of one rank.
+    Each record is flushed as soon as it is written, so that a preempted run
+    only loses the sample being processed.
+    """
+
+    def __init__(self, shard_dir, rank):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.path = get_shard_path(shard_dir, rank)
+        self.num_written = 0
+        needs_newline = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._file = open(self.path, "a")
+        if needs_newline:
+            # Terminate a record cut by a previous preemption
+            self._file.write("\n")
+
+    def write(self, record):
+        self._file.write(json.dumps(record, default=_to_json) + "\n")
+        self._file.flush()
+        self.num_written += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
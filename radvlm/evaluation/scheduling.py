@@ -0,0 +1,84 @@
+import os
+import itertools
+from datetime import timedelta
+
+import torch.distributed as dist
+
+_SHARED_STORE = None
+
+
+def get_shared_store(timeout=timedelta(minutes=30)):
+    """
+    Return a key-value store shared by all ranks, or None when running without an
+    initialized process group. The store is a `TCPStore` hosted by rank 0 on a free port of
+    `MASTER_ADDR`, whose port is broadcast to the other ranks, so the first call must be
+    made by all ranks. It is created once per process.
+    """
+    global _SHARED_STORE
+    if not (dist.is_available() and dist.is_initialized()):
+        return None
+    if _SHARED_STORE is None:
+        host = os.environ.get("MASTER_ADDR", "127.0.0.1")
+        world_size = dist.get_world_size()
+        is_master = dist.get_rank() == 0
+        store = None
+        port = [None]
+        if is_master:
+            store = dist.TCPStore(host, 0, world_size, is_master=True, timeout=timeout, wait_for_workers=False)
+            port = [store.port]
+        dist.broadcast_object_list(port, src=0)
+        if not is_master:
+            store = dist.TCPStore(host, port[0], world_size, is_master=False, timeout=timeout)
+        _SHARED_STORE = store
+    return _SHARED_STORE
+
+
+class DynamicChunkSampler:
+    """
+    Sampler distributing a list of dataset indices dynamically across ranks.
+
+    Instead of assigning a fixed partition to each rank (as `DistributedSampler` does),
+    every rank pulls the next chunk of `chunk_size` indices from a counter shared through
+    the TCP store of `get_shared_store`. Ranks generating long outputs simply pull fewer chunks, so all
+    ranks finish within one chunk of each other.
+
+    All ranks must build the sampler with the same `indices`, and in the same order
+    relative to other `DynamicChunkSampler` instances (the order defines the store key).
+    A sampler instance can only be iterated once.
+
+    Args:
+        indices (list): Dataset indices to distribute, identical on all ranks.
+        chunk_size (int): Number of indices pulled from the queue at once.
+        store: A `torch.distributed.Store`. Defaults to `get_shared_store()`; without an
+            initialized process group, the sampler yields all indices locally.
+        key (str): Prefix of the counter key in the store.
+    """
+
+    _num_instances = itertools.count()
+
+    def __init__(self, indices, chunk_size=8, store=None, key="radvlm_eval_queue"):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer.")
+        self.indices = list(indices)
+        self.chunk_size = chunk_size
+        self.store = store if store is not None else get_shared_store()
+        self.key = f"{key}_{next(self._num_instances)}"
+        self._local_counter = 0
+        self.num_chunks_pulled = 0
+
+    def _next_start(self):
+        """Atomically reserve the next chunk and return its start offset."""
+        if self.store is None:
+            self._local_counter += self.chunk_size
+            end = self._local_counter
+        else:
+            end = self.store.add(self.key, self.chunk_size)
+        return end - self.chunk_size
+
+    def __iter__(self):
+        while True:
+            start = self._next_start()
+            if start >= len(self.indices):
+                return
+            self.num_chunks_pulled += 1
+            yield from self.indices[start:start + self.chunk_size]
@@ -0,0 +1,205 @@
+import os
+import re
+
+import torch
+from transformers import BertConfig, BertModel, BertTokenizer
+
+from radvlm.evaluation.synthetic_reports import entity_types, vocabulary
+
+# Tiny stand-ins of the models behind the report metrics, used by `benchmark_metrics.py` to run
+# the metric code offline on the corpus of `synthetic_reports.py` when the real checkpoints
+# cannot be downloaded. The models have random weights, so their scores are meaningless: only
+# the shape of the computation (tokenization, batched encoder passes, scoring) is kept.
+
+_SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def build_tiny_bert(directory, hidden_size=64, num_layers=2, seed=0):
+    """
+    Save a randomly initialized BERT with a word-level vocabulary of the synthetic reports to
+    `directory`, unless it was already built there, and return `directory`.
+    """
+    if os.path.exists(os.path.join(directory, "config.json")):
+        return directory
+    os.makedirs(directory, exist_ok=True)
+    tokens = _SPECIAL_TOKENS + vocabulary() + list(".,;:-")
+    vocab_file = os.path.join(directory, "vocab.txt")
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(tokens) + "\n")
+    BertTokenizer(vocab_file, do_lower_case=True, model_max_length=512).save_pretrained(directory)
+    config = BertConfig(vocab_size=len(tokens), hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=2, intermediate_size=4 * hidden_size, max_position_embeddings=512)
+    torch.manual_seed(seed)
+    BertModel(config).save_pretrained(directory)
+    return directory
+
+
+def stand_in_bert_scorer(model_dir, device):
+    """`bert_score.BERTScorer` on the tiny BERT, for `BertScore` and `RadEntityNLI`."""
+    from bert_score import BERTScorer
+    return BERTScorer(model_type=model_dir, num_layers=BertConfig.from_pretrained(model_dir).num_hidden_layers,
+                      batch_size=64, device=str(device), lang='en', rescale_with_baseline=False)
+
+
+def stand_in_nli_model(model_dir, seed=0):
+    """`BERTNLI` on CPU with the tiny BERT as encoder, for `RadEntityNLI`."""
+    from radvlm.evaluation.vilmedic.RadEntityNLI.BERTNLI import BERTNLI
+    torch.manual_seed(seed)
+    model = BERTNLI(model_dir, bert_type='bert', length=128, force_lowercase=True, device='cpu')
+    return model.eval()
+
+
+class _Sentence(object):
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def to_dict(self):
+        return self.tokens
+
+
+class _Document(object):
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+
+
+class LexiconNER(object):
+    """
+    Stand-in of the stanza radiology NER for `RadEntityMatchExact`: the words of the synthetic
+    finding names and locations are tagged as single-token OBSERVATION and ANATOMY entities.
+    """
+
+    def __init__(self):
+        self.types = entity_types()
+
+    def annotate(self, text):
+        sentences, tokens = [], []
+        for word in _WORD_PATTERN.findall(text):
+            entity_type = self.types.get(word.lower())
+            tokens.append({'text': word, 'ner': f"S-{entity_type}" if entity_type is not None else 'O'})
+            if word == '.':
+                sentences.append(_Sentence(tokens))
+                tokens = []
+        if tokens:
+            sentences.append(_Sentence(tokens))
+        return _Document(sentences)
+
+    def __call__(self, texts):
+        return [self.annotate(text) for text in texts]
+
+
+class _TinyEncoder(object):
+    """Tiny BERT encoding batches of word-tokenized reports, with a random linear head."""
+
+    def __init__(self, model_dir, num_outputs, device, seed=0):
+        self.device = torch.device(device)
+        self.tokenizer = BertTokenizer.from_pretrained(model_dir)
+        self.model = BertModel.from_pretrained(model_dir).to(self.device).eval()
+        torch.manual_seed(seed)
+        self.head = torch.nn.Linear(self.model.config.hidden_size, num_outputs).to(self.device)
+
+    def encode(self, reports, max_words=254):
+        """(words of each report, head outputs of each word (or of [CLS] at index 0) of each report)."""
+        words = [_WORD_PATTERN.findall(report.lower())[:max_words] for report in reports]
+        max_len = max(len(report_words) for report_words in words) + 2
+        token_ids = torch.zeros((len(reports), max_len), dtype=torch.long)
+        attention_mask = torch.zeros((len(reports), max_len), dtype=torch.long)
+        for i, report_words in enumerate(words):
+            ids = self.tokenizer.convert_tokens_to_ids(["[CLS]"] + report_words + ["[SEP]"])
+            token_ids[i, :len(ids)] = torch.tensor(ids)
+            attention_mask[i, :len(ids)] = 1
+        with torch.no_grad():
+            hidden = self.model(token_ids.to(self.device), attention_mask=attention_mask.to(self.device))
+            return words, self.head(hidden.last_hidden_state).cpu()
+
+
+class StandInF1CheXbert(object):
+    """
+    Stand-in of `f1chexbert.F1CheXbert`: the 14 labels of a report come from 4-class heads on
+    the [CLS] output of the tiny BERT (1 for the "positive" class), one report at a time.
+    The labels are meaningless, so they are only numbered.
+    """
+
+    target_names = [f"label_{i}" for i in range(14)]
+    # Same positions as the 5 main labels of CheXbert
+    target_names_5 = [f"label_{i}" for i in (1, 4, 5, 7, 9)]
+
+    def __init__(self, model_dir, device):
+        self.encoder = _TinyEncoder(model_dir, 14 * 4, device)
+
+    def get_label(self, report):
+        _, outputs = self.encoder.encode([report])
+        return (outputs[0, 0].view(14, 4).argmax(-1) == 1).int().tolist()
+
+    def __call__(self, hyps, refs):
+        """(accuracy, accuracy per sample, report of the 14 labels, report of the 5 main labels)."""
+        from radvlm.evaluation.vilmedic.accumulators import CheXbertAccumulator
+        accumulator = CheXbertAccumulator(self.target_names, self.target_names_5)
+        accumulator.ref_labels = [self.get_label(ref.strip()) for ref in refs]
+        accumulator.hyp_labels = [self.get_label(hyp.strip()) for hyp in hyps]
+        accuracy, chexbert_all, chexbert_5 = accumulator.compute_reports()
+        return accuracy, accumulator.accuracy_per_sample(), chexbert_all, chexbert_5
+
+
+class StandInF1RadGraph(object):
+    """
+    Stand-in of `radgraph.F1RadGraph(reward_level="all")`: each word is tagged with an entity
+    label by a head on the tiny BERT, each observation is related to the closest anatomy before
+    it, and the simple/partial/complete rewards are the F1 of the entities, of the entities with
+    whether they have a relation, and of the entities with their relations.
+    """
+
+    LABELS = ["O", "ANAT-DP", "OBS-DP", "OBS-DA", "OBS-U"]
+
+    def __init__(self, model_dir, device):
+        self.encoder = _TinyEncoder(model_dir, len(self.LABELS), device)
+
+    def annotate(self, reports):
+        """{"entities": [(word, label)], "relations": [(observation index, anatomy index)]} of each report."""
+        words, outputs = self.encoder.encode(reports)
+        annotations = []
+        for report_words, labels in zip(words, outputs[:, 1:].argmax(-1).tolist()):
+            entities, relations, anatomy = [], [], None
+            for word, label in zip(report_words, labels):
+                if label == 0:
+                    continue
+                if self.LABELS[label].startswith("ANAT"):
+                    anatomy = len(entities)
+                elif anatomy is not None:
+                    relations.append((len(entities), anatomy))
+                entities.append((word, self.LABELS[label]))
+            annotations.append({"entities": entities, "relations": relations})
+        return annotations
+
+    @staticmethod
+    def _f1(hyp_items, ref_items):
+        hyp_items, ref_items = set(hyp_items), set(ref_items)
+        if not hyp_items or not ref_items:
+            return float(hyp_items == ref_items)
+        matches = len(hyp_items & ref_items)
+        return 2 * matches / (len(hyp_items) + len(ref_items))
+
+    @staticmethod
+    def _relation_items(annotation):
+        targets = {}
+        for source, target in annotation["relations"]:
+            targets.setdefault(source, set()).add(annotation["entities"][target])
+        partial = [entity + (i in targets,) for i, entity in enumerate(annotation["entities"])]
+        complete = [entity + (frozenset(targets.get(i, ())),) for i, entity in enumerate(annotation["entities"])]
+        return partial, complete
+
+    def __call__(self, refs, hyps):
+        """(mean rewards, (simple, partial, complete) reward lists, hypothesis and reference annotations)."""
+        annotations = self.annotate(list(hyps) + list(refs))
+        hyp_annotations, ref_annotations = annotations[:len(hyps)], annotations[len(hyps):]
+        rewards = ([], [], [])
+        for hyp, ref in zip(hyp_annotations, ref_annotations):
+            hyp_partial, hyp_complete = self._relation_items(hyp)
+            ref_partial, ref_complete = self._relation_items(ref)
+            rewards[0].append(self._f1(hyp["entities"], ref["entities"]))
+            rewards[1].append(self._f1(hyp_partial, ref_partial))
+            rewards[2].append(self._f1(hyp_complete, ref_complete))
+        mean_rewards = tuple(sum(level) / max(len(level), 1) for level in rewards)
+        return mean_rewards, rewards, hyp_annotations, ref_annotations
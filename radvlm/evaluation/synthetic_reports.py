@@ -0,0 +1,88 @@
+import random
+
+
+# Building blocks of synthetic chest X-ray findings, used to benchmark the report metrics
+# on a fixed corpus that does not require access to MIMIC-CXR
+_FINDINGS = [
+    "there is {severity} {finding} in the {location}",
+    "{severity} {finding} is seen in the {location}",
+    "the {location} demonstrates {severity} {finding}",
+    "no evidence of {finding} in the {location}",
+    "{finding} in the {location} is {change}",
+]
+_NORMAL = [
+    "the heart size is normal",
+    "the cardiomediastinal silhouette is within normal limits",
+    "no pleural effusion or pneumothorax is seen",
+    "the lungs are clear",
+    "there is no focal consolidation",
+    "no acute osseous abnormality is identified",
+    "the hilar contours are unremarkable",
+]
+_SEVERITIES = ["mild", "moderate", "severe", "small", "large", "minimal", "trace"]
+_FINDING_NAMES = [
+    "atelectasis", "pleural effusion", "pulmonary edema", "consolidation", "cardiomegaly",
+    "pneumothorax", "opacity", "pneumonia", "nodule", "interstitial markings",
+]
+_LOCATIONS = [
+    "right lower lobe", "left lower lobe", "right upper lobe", "left upper lobe", "lung bases",
+    "right apex", "left apex", "retrocardiac region", "right middle lobe", "perihilar region",
+]
+_CHANGES = ["unchanged", "improved", "worsened", "new", "stable"]
+
+
+def generate_report(rng, min_sentences=2, max_sentences=8):
+    """Generate one synthetic report with a random number of sentences."""
+    sentences = []
+    for _ in range(rng.randint(min_sentences, max_sentences)):
+        if rng.random() < 0.4:
+            sentence = rng.choice(_NORMAL)
+        else:
+            sentence = rng.choice(_FINDINGS).format(
+                severity=rng.choice(_SEVERITIES),
+                finding=rng.choice(_FINDING_NAMES),
+                location=rng.choice(_LOCATIONS),
+                change=rng.choice(_CHANGES),
+            )
+        sentences.append(sentence[0].upper() + sentence[1:] + ".")
+    return " ".join(sentences)
+
+
+def generate_report_pairs(num_pairs, seed=0, overlap=0.5):
+    """
+    Generate a fixed corpus of (reference, prediction) report pairs. Each sentence of a
+    prediction is copied from its reference with probability `overlap`, so that the
+    metrics cover a realistic range of partial matches.
+
+    Returns:
+        tuple: (references, predictions), two lists of `num_pairs` strings.
+    """
+    rng = random.Random(seed)
+    references = []
+    predictions = []
+    for _ in range(num_pairs):
+        reference = generate_report(rng)
+        reference_sentences = reference.split(". ")
+        prediction_sentences = [
+            sentence if rng.random() < overlap else generate_report(rng, 1, 1).rstrip(".")
+            for sentence in reference_sentences
+        ]
+        references.append(reference)
+        predictions.append(". ".join(prediction_sentences).rstrip(".") + ".")
+    return references, predictions
+
+
+def vocabulary():
+    """Sorted words of all the synthetic reports, lowercased."""
+    phrases = (_FINDINGS + _NORMAL + _SEVERITIES + _FINDING_NAMES + _LOCATIONS + _CHANGES)
+    words = set()
+    for phrase in phrases:
+        words.update(word for word in phrase.lower().split() if not word.startswith("{"))
+    return sorted(words)
+
+
+def entity_types():
+    """{word: "OBSERVATION" or "ANATOMY"} for the words of the finding names and locations."""
+    types = {word: "ANATOMY" for location in _LOCATIONS for word in location.split()}
+    types.update({word: "OBSERVATION" for finding in _FINDING_NAMES for word in finding.split()})
+    return types
@@ -53,7 +53,7 @@ def display_image_with_bboxes(ax, img_path, predicted_bboxes, actual_bboxes, lab
         ax.set_title(label)
 
 
-def plot_images_with_Bbox(output, results_dir, num_samples=10):
+def plot_images_with_Bbox(output, results_dir, num_samples=10, filename="images_with_bboxes.png"):
     # Ensure we don't exceed the available number of outputs
     num_samples = min(num_samples, len(output))
     
@@ -93,7 +93,7 @@ def plot_images_with_Bbox(output, results_dir, num_samples=10):
     
     plt.tight_layout()
     os.makedirs(results_dir, exist_ok=True)
-    plot_path = os.path.join(results_dir, "images_with_bboxes.png")
+    plot_path = os.path.join(results_dir, filename)
     plt.savefig(plot_path)
     plt.close(fig) 
     print(f"Plot saved at {plot_path}")
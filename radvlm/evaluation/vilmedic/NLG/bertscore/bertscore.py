@@ -1,29 +1,53 @@
 import torch
 import torch.nn as nn
 from bert_score import BERTScorer
+from .embedding_cache import CachedBERTScorer, ReferenceEmbeddingCache
+from ...cpu_profile import apply_cpu_profile, check_cpu_profile, resolve_device
 
 
 class BertScore(nn.Module):
-    def __init__(self):
+    """
+    BERTScore F1 with DistilBERT. With `reference_cache=True`, the reference embeddings are
+    stored in fp16 under `cache_dir` (see `embedding_cache.py`) and reused by later calls.
+    On CPU, `cpu_profile='int8'` quantizes the encoder (see `cpu_profile.py`). Another encoder
+    can be used by passing an already created `bert_score.BERTScorer` as `bert_scorer`.
+    """
+
+    def __init__(self, device=None, reference_cache=False, cache_dir=None, cpu_profile=None, batch_size=64,
+                 bert_scorer=None):
         super(BertScore, self).__init__()
-        with torch.no_grad():
-            self.bert_scorer = BERTScorer(model_type='distilbert-base-uncased',
-                                          num_layers=5,
-                                          batch_size=64,
-                                          nthreads=4,
-                                          all_layers=False,
-                                          idf=False,
-                                          device=None,
-                                          lang='en',
-                                          rescale_with_baseline=True,
-                                          baseline_path=None)
+        device = resolve_device(device)
+        self.cpu_profile = check_cpu_profile(cpu_profile, device)
+        self.batch_size = batch_size
+        if bert_scorer is None:
+            with torch.no_grad():
+                bert_scorer = BERTScorer(model_type='distilbert-base-uncased',
+                                         num_layers=5,
+                                         batch_size=64,
+                                         nthreads=4,
+                                         all_layers=False,
+                                         idf=False,
+                                         device=str(device),
+                                         lang='en',
+                                         rescale_with_baseline=True,
+                                         baseline_path=None)
+        self.bert_scorer = bert_scorer
+        if device.type == 'cpu':
+            apply_cpu_profile(self.bert_scorer._model, self.cpu_profile)
+        self.scorer = self.bert_scorer
+        if reference_cache:
+            self.scorer = CachedBERTScorer(
+                self.bert_scorer,
+                ReferenceEmbeddingCache(self.bert_scorer.model_type, self.bert_scorer.num_layers, cache_dir=cache_dir,
+                                        variant=self.cpu_profile)
+            )
 
     def forward(self, refs, hyps):
-        p, r, f = self.bert_scorer.score(
+        p, r, f = self.scorer.score(
             cands=hyps,
             refs=refs,
             verbose=False,
-            batch_size=64,
+            batch_size=self.batch_size,
         )
         return torch.mean(f).item(), f.tolist()
 
@@ -0,0 +1,205 @@
+import os
+import json
+import fcntl
+import hashlib
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from bert_score.utils import get_bert_embedding, greedy_cos_idf
+
+# Reference-side BERTScore embeddings on disk. The references of a test set are the same for
+# every evaluated model, so their per-token embeddings are computed once, stored in fp16 in
+# a memory-mapped file, and only the candidates are embedded by later scoring calls.
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "radvlm", "bertscore")
+
+
+def text_hash(text):
+    return hashlib.sha1(text.strip().encode()).hexdigest()
+
+
+class ReferenceEmbeddingCache(object):
+    """
+    Per-token embeddings of the texts embedded with one (model_type, num_layers), keyed by
+    text hash, in `<cache_dir>/<model_type>_L<num_layers>/`:
+
+    - `embeddings.f16`: fp16 rows of all cached tokens, appended as texts are added and
+      read through a memory map;
+    - `index.json`: {text hash: [first row, number of rows]}.
+
+    Writers (e.g. the ranks of a distributed evaluation) are serialized by an exclusive lock
+    on `index.lock`, under which the index on disk is merged before it is rewritten.
+
+    Args:
+        model_type (str): BERTScore model, e.g. 'distilbert-base-uncased'.
+        num_layers (int): Layer of the model whose output is used.
+        cache_dir (str): Root directory of the cache.
+        variant (str): Variant of the model whose embeddings differ from the original ones,
+            e.g. 'int8' for a quantized encoder (see `cpu_profile.py`), cached separately.
+    """
+
+    def __init__(self, model_type, num_layers, cache_dir=None, variant=None):
+        name = f"{model_type.replace('/', '--')}_L{num_layers}"
+        if variant is not None:
+            name += f"_{variant}"
+        self.directory = os.path.join(cache_dir or CACHE_DIR, name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.embeddings_path = os.path.join(self.directory, "embeddings.f16")
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.lock_path = os.path.join(self.directory, "index.lock")
+        self.index = {}
+        self.dim = None
+        self._load_index()
+        self._memmap = None
+
+    def _load_index(self):
+        """Merge the index on disk, which other processes may have extended, into `self.index`."""
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                state = json.load(f)
+            self.index.update(state["index"])
+            self.dim = state["dim"]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, text):
+        return text_hash(text) in self.index
+
+    def _rows(self):
+        if self._memmap is None and self.index:
+            self._memmap = np.memmap(self.embeddings_path, dtype=np.float16, mode="r").reshape(-1, self.dim)
+        return self._memmap
+
+    def get(self, text):
+        """fp32 tensor of shape (tokens, dim) of `text`, or None if it is not cached."""
+        entry = self.index.get(text_hash(text))
+        if entry is None:
+            return None
+        start, length = entry
+        return torch.from_numpy(np.array(self._rows()[start:start + length], dtype=np.float32))
+
+    def put(self, texts, embeddings):
+        """Append the (tokens, dim) embeddings of `texts` that are not cached yet."""
+        new = [(text_hash(text), embedding) for text, embedding in zip(texts, embeddings)
+               if text_hash(text) not in self.index]
+        if not new:
+            return
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Rows and index entries appended by other processes since this index was read
+                self._load_index()
+                if self.dim is None:
+                    self.dim = new[0][1].shape[-1]
+                num_rows = os.path.getsize(self.embeddings_path) // (2 * self.dim) if os.path.exists(self.embeddings_path) else 0
+                with open(self.embeddings_path, "ab") as f:
+                    for key, embedding in new:
+                        if key in self.index:  # duplicated text in `texts`, or added by another process
+                            continue
+                        rows = embedding.detach().to("cpu", torch.float16).numpy()
+                        f.write(rows.tobytes())
+                        self.index[key] = [num_rows, len(rows)]
+                        num_rows += len(rows)
+                with open(self.index_path + ".tmp", "w") as f:
+                    json.dump({"dim": self.dim, "index": self.index}, f)
+                os.replace(self.index_path + ".tmp", self.index_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._memmap = None
+
+
+class CachedBERTScorer(object):
+    """
+    Drop-in for `BERTScorer.score` that takes the reference embeddings from a
+    `ReferenceEmbeddingCache`, embedding and caching the missing ones, and embeds only the
+    candidates. Greedy matching and baseline rescaling are those of `bert_score`; the scores
+    differ from `BERTScorer.score` only by the fp16 rounding of the reference embeddings.
+
+    Args:
+        bert_scorer (BERTScorer): Scorer providing the model, tokenizer and baseline (idf=False).
+        cache (ReferenceEmbeddingCache): Cache of the reference embeddings, by default the one
+            of the model and layer of `bert_scorer` in the default cache directory.
+    """
+
+    def __init__(self, bert_scorer, cache=None):
+        if bert_scorer.idf:
+            raise ValueError("The reference embedding cache does not support idf weighting.")
+        self.bert_scorer = bert_scorer
+        self.cache = cache or ReferenceEmbeddingCache(bert_scorer.model_type, bert_scorer.num_layers)
+
+    def _embed(self, sentences, batch_size):
+        """{sentence: (fp32 embedding, idf weights)}, in batches sorted by length as `bert_score`."""
+        tokenizer = self.bert_scorer._tokenizer
+        idf_dict = defaultdict(lambda: 1.0)
+        idf_dict[tokenizer.sep_token_id] = 0
+        idf_dict[tokenizer.cls_token_id] = 0
+        sentences = sorted(set(sentences), key=lambda x: len(x.split(" ")), reverse=True)
+        stats = {}
+        for start in range(0, len(sentences), batch_size):
+            batch = sentences[start:start + batch_size]
+            embs, masks, padded_idf = get_bert_embedding(
+                batch, self.bert_scorer._model, tokenizer, idf_dict,
+                device=self.bert_scorer.device, all_layers=self.bert_scorer.all_layers
+            )
+            embs, masks, padded_idf = embs.cpu(), masks.cpu(), padded_idf.cpu()
+            for i, sentence in enumerate(batch):
+                sequence_len = masks[i].sum().item()
+                stats[sentence] = (embs[i, :sequence_len], padded_idf[i, :sequence_len])
+        return stats
+
+    def _idf(self, embedding):
+        # idf=False: weight 1 for every token except [CLS] and [SEP]
+        idf = torch.ones(embedding.size(0))
+        idf[0] = 0
+        idf[-1] = 0
+        return idf
+
+    def score(self, cands, refs, verbose=False, batch_size=64):
+        """Returns (P, R, F), each of shape (N), as `BERTScorer.score` with single references."""
+        stats = {}
+        missing = []
+        for ref in set(refs):
+            embedding = self.cache.get(ref)
+            if embedding is None:
+                missing.append(ref)
+            else:
+                stats[("ref", ref)] = (embedding, self._idf(embedding))
+        if missing:
+            computed = self._embed(missing, batch_size)
+            self.cache.put(missing, [computed[ref][0] for ref in missing])
+            for ref in missing:
+                # Same fp16 rounding as the references loaded from the cache
+                embedding = self.cache.get(ref)
+                stats[("ref", ref)] = (embedding, computed[ref][1])
+        if verbose:
+            print(f"{len(set(refs)) - len(missing)} cached reference embeddings, {len(missing)} new")
+        for cand, cand_stats in self._embed(cands, batch_size).items():
+            stats[("cand", cand)] = cand_stats
+
+        device = next(self.bert_scorer._model.parameters()).device
+        preds = []
+        with torch.no_grad():
+            for start in range(0, len(refs), batch_size):
+                ref_stats = self._pad_batch([stats[("ref", ref)] for ref in refs[start:start + batch_size]], device)
+                hyp_stats = self._pad_batch([stats[("cand", cand)] for cand in cands[start:start + batch_size]], device)
+                P, R, F1 = greedy_cos_idf(*ref_stats, *hyp_stats, self.bert_scorer.all_layers)
+                preds.append(torch.stack((P, R, F1), dim=-1).cpu())
+        all_preds = torch.cat(preds, dim=1 if self.bert_scorer.all_layers else 0)
+        if self.bert_scorer.rescale_with_baseline:
+            all_preds = (all_preds - self.bert_scorer.baseline_vals) / (1 - self.bert_scorer.baseline_vals)
+        return all_preds[..., 0], all_preds[..., 1], all_preds[..., 2]
+
+    @staticmethod
+    def _pad_batch(batch_stats, device):
+        # Same padding as `bert_score.utils.bert_cos_score_idf`
+        emb, idf = zip(*batch_stats)
+        emb = [e.to(device) for e in emb]
+        idf = [i.to(device) for i in idf]
+        lens = torch.tensor([e.size(0) for e in emb], dtype=torch.long)
+        emb_pad = pad_sequence(emb, batch_first=True, padding_value=2.0)
+        idf_pad = pad_sequence(idf, batch_first=True)
+        pad_mask = (torch.arange(lens.max()).expand(len(lens), -1) < lens.unsqueeze(1)).to(device)
+        return emb_pad, pad_mask, idf_pad
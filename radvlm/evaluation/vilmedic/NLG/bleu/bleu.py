@@ -10,6 +10,7 @@
 
 import torch.nn as nn
 from .bleu_scorer import BleuScorer
+from ..ngrams import NgramFeaturizer, cook_bleu_counts
 
 
 class Bleu(nn.Module):
@@ -22,21 +23,16 @@ class Bleu(nn.Module):
         return self.compute_score(gts, res)
 
     def compute_score(self, gts, res):
-        res = {i: [v] for i, v in enumerate(res)}
-        gts = {i: [v] for i, v in enumerate(gts)}
+        assert len(gts) == len(res)
+        featurizer = NgramFeaturizer(n=self._n)
+        return self.compute_score_counts(featurizer.featurize(gts), featurizer.featurize(res))
+
+    def compute_score_counts(self, gts_counts, res_counts):
+        """
+        BLEU score from references and hypotheses featurized by the same `NgramFeaturizer`.
+        """
         bleu_scorer = BleuScorer(n=self._n)
-
-        for id in sorted(gts.keys()):
-            hypo = res[id]
-            ref = gts[id]
-
-            # Sanity check.
-            assert (type(hypo) is list)
-            assert (len(hypo) == 1)
-            assert (type(ref) is list)
-            assert (len(ref) >= 1)
-
-            bleu_scorer += (hypo[0], ref)
+        bleu_scorer.ctest.extend(cook_bleu_counts(gts_counts, res_counts))
 
         # score, scores = bleu_scorer.compute_score(option='shortest')
         score, scores = bleu_scorer.compute_score(option='closest', verbose=0)
@@ -7,10 +7,96 @@
 #
 # Authors: Ramakrishna Vedantam <vrama91@vt.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
+import os
+import pickle
+import hashlib
+
+import numpy as np
 from .ciderD_scorer import CiderScorer
+from ..ngrams import NgramFeaturizer
 import pdb
 import torch.nn as nn
 
+# Reference statistics of named reference sets (see `get_reference_stats`)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "radvlm", "ciderd")
+_LOADED_STATS = {}
+
+
+def reference_fingerprint(refs, n=4, sigma=6.0):
+    digest = hashlib.sha1(f"{n}|{sigma}".encode())
+    for ref in refs:
+        digest.update(b"\x00" + ref.encode())
+    return digest.hexdigest()
+
+
+class CiderDReferenceStats(object):
+    """
+    Everything CIDEr-D needs from a fixed list of references: the featurizer that encoded
+    them, their n-gram counts, the document frequencies, `ref_len` and the tf-idf vector of
+    each reference. Scoring hypotheses against them only cooks the hypotheses, and gives the
+    same scores as `CiderD` on the same (references, hypotheses) pairs.
+    """
+
+    def __init__(self, refs, n=4, sigma=6.0):
+        self.n = n
+        self.sigma = sigma
+        self.num_refs = len(refs)
+        self.fingerprint = reference_fingerprint(refs, n, sigma)
+        self.featurizer = NgramFeaturizer(n=n)
+        self.ref_counts = self.featurizer.featurize(refs)
+
+        self.scorer = CiderScorer(n=n, sigma=sigma)
+        self.scorer.crefs = [[ref] for ref in self.ref_counts.as_dicts()]
+        self.scorer.integer_keys = True
+        self.scorer.compute_doc_freq()
+        self.scorer.ref_len = np.log(float(len(self.scorer.crefs)))
+        self.ref_vectors = [[self.scorer.counts2vec(ref) for ref in crefs] for crefs in self.scorer.crefs]
+        self.scorer.crefs = []
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def score_counts(self, res_counts):
+        """Score hypotheses featurized by `self.featurizer`, in the order of the references."""
+        assert len(res_counts) == self.num_refs, "refs/test mismatch! %d<>%d" % (self.num_refs, len(res_counts))
+        scores = [self.scorer.score_test(test, ref_vectors)
+                  for test, ref_vectors in zip(res_counts.as_dicts(), self.ref_vectors)]
+        return np.mean(np.array(scores)), np.array(scores)
+
+    def score(self, res):
+        return self.score_counts(self.featurizer.featurize(res))
+
+
+def get_reference_stats(name, refs, n=4, sigma=6.0, cache_dir=None):
+    """
+    Return the `CiderDReferenceStats` of the reference set `name`, loaded from `cache_dir`
+    if they were already computed for exactly these references, computed and saved otherwise.
+    A reference set keeps a single file, `<name>.pkl`, overwritten when its references change.
+    """
+    fingerprint = reference_fingerprint(refs, n, sigma)
+    stats = _LOADED_STATS.get(name)
+    if stats is not None and stats.fingerprint == fingerprint:
+        return stats
+    path = os.path.join(cache_dir or CACHE_DIR, f"{name}.pkl")
+    stats = None
+    if os.path.exists(path):
+        stats = CiderDReferenceStats.load(path)
+        if stats.fingerprint != fingerprint:
+            stats = None
+    if stats is None:
+        stats = CiderDReferenceStats(refs, n=n, sigma=sigma)
+        stats.save(path)
+        print(f"CIDEr-D reference statistics of {name} saved to {path}")
+    _LOADED_STATS[name] = stats
+    return stats
+
 
 class CiderD(nn.Module):
     """
@@ -18,38 +104,42 @@ class CiderD(nn.Module):
 
     """
 
-    def __init__(self, test=None, refs=None, n=4, sigma=6.0, **kwargs):
+    def __init__(self, test=None, refs=None, n=4, sigma=6.0, cache_dir=None, **kwargs):
         # set cider to sum over 1 to 4-grams
         super().__init__()
         self._n = n
         # set the standard deviation parameter for gaussian penalty
         self._sigma = sigma
+        self._cache_dir = cache_dir
+
+    def forward(self, gts, res, reference_set=None):
+        return self.compute_score(gts, res, reference_set=reference_set)
 
-    def forward(self, gts, res):
-        return self.compute_score(gts, res)
+    def reference_stats(self, reference_set, gts):
+        """Statistics of the references `gts`, persisted under the name `reference_set`."""
+        return get_reference_stats(reference_set, gts, n=self._n, sigma=self._sigma, cache_dir=self._cache_dir)
 
-    def compute_score(self, gts, res):
+    def compute_score(self, gts, res, reference_set=None):
         """
         Main function to compute CIDEr score
         :param  hypo_for_image (dict) : dictionary with key <image> and value <tokenized hypothesis / candidate sentence>
                 ref_for_image (dict)  : dictionary with key <image> and value <tokenized reference sentence>
+        :param reference_set (str) : if set, the reference statistics are loaded from (or saved to) the cache under this name
         :return: cider (float) : computed CIDEr score for the corpus 
         """
+        if reference_set is not None:
+            return self.reference_stats(reference_set, gts).score(res)
+
+        assert len(gts) == len(res)
+        featurizer = NgramFeaturizer(n=self._n)
+        return self.compute_score_counts(featurizer.featurize(gts), featurizer.featurize(res))
 
+    def compute_score_counts(self, gts_counts, res_counts):
+        """
+        CIDEr score from references and hypotheses featurized by the same `NgramFeaturizer`.
+        """
         cider_scorer = CiderScorer(n=self._n, sigma=self._sigma)
-        res = {i: [v] for i, v in enumerate(res)}
-        gts = {i: [v] for i, v in enumerate(gts)}
-        for id in sorted(gts.keys()):
-            hypo = res[id]
-            ref = gts[id]
-
-            # Sanity check.
-            assert (type(hypo) is list)
-            assert (len(hypo) == 1)
-            assert (type(ref) is list)
-            assert (len(ref) > 0)
-
-            cider_scorer += (hypo[0], ref)
+        cider_scorer.cook_append_counts(res_counts, gts_counts)
 
         (score, scores) = cider_scorer.compute_score()
 
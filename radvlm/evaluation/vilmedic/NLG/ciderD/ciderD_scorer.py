@@ -55,6 +55,7 @@ class CiderScorer(object):
         new = CiderScorer(n=self.n)
         new.ctest = copy.copy(self.ctest)
         new.crefs = copy.copy(self.crefs)
+        new.integer_keys = self.integer_keys
         return new
 
     def __init__(self, test=None, refs=None, n=4, sigma=6.0):
@@ -64,6 +65,7 @@ class CiderScorer(object):
         self.crefs = []
         self.ctest = []
         self.document_frequency = defaultdict(float)
+        self.integer_keys = False
         self.cook_append(test, refs)
         self.ref_len = None
 
@@ -77,6 +79,14 @@ class CiderScorer(object):
             else:
                 self.ctest.append(None) # lens of crefs and ctest have to match
 
+    def cook_append_counts(self, test_counts, ref_counts):
+        '''append featurized hypotheses and their single references (see ngrams.py).
+        Not to be mixed with cook_append in the same scorer.'''
+        assert len(test_counts) == len(ref_counts), "refs/test mismatch! %d<>%d" % (len(ref_counts), len(test_counts))
+        self.ctest.extend(test_counts.as_dicts())
+        self.crefs.extend([ref] for ref in ref_counts.as_dicts())
+        self.integer_keys = True
+
     def size(self):
         assert len(self.crefs) == len(self.ctest), "refs/test mismatch! %d<>%d" % (len(self.crefs), len(self.ctest))
         return len(self.crefs)
@@ -105,81 +115,95 @@ class CiderScorer(object):
                 self.document_frequency[ngram] += 1
             # maxcounts[ngram] = max(maxcounts.get(ngram,0), count)
 
-    def compute_cider(self):
-        def counts2vec(cnts):
-            """
-            Function maps counts of ngram to vector of tfidf weights.
-            The function returns vec, an array of dictionary that store mapping of n-gram and tf-idf weights.
-            The n-th entry of array denotes length of n-grams.
-            :param cnts:
-            :return: vec (array of dict), norm (array of float), length (int)
-            """
-            vec = [defaultdict(float) for _ in range(self.n)]
-            length = 0
-            norm = [0.0 for _ in range(self.n)]
-            for (ngram,term_freq) in six.iteritems(cnts):
-                # give word count 1 if it doesn't appear in reference corpus
-                df = np.log(max(1.0, self.document_frequency[ngram]))
-                # ngram index
-                n = len(ngram)-1
-                # tf (term_freq) * idf (precomputed idf) for n-grams
-                vec[n][ngram] = float(term_freq)*(self.ref_len - df)
-                # compute norm for the vector.  the norm will be used for computing similarity
-                norm[n] += pow(vec[n][ngram], 2)
-
-                if n == 1:
-                    length += term_freq
-            norm = [np.sqrt(n) for n in norm]
-            return vec, norm, length
-
-        def sim(vec_hyp, vec_ref, norm_hyp, norm_ref, length_hyp, length_ref):
-            '''
-            Compute the cosine similarity of two vectors.
-            :param vec_hyp: array of dictionary for vector corresponding to hypothesis
-            :param vec_ref: array of dictionary for vector corresponding to reference
-            :param norm_hyp: array of float for vector corresponding to hypothesis
-            :param norm_ref: array of float for vector corresponding to reference
-            :param length_hyp: int containing length of hypothesis
-            :param length_ref: int containing length of reference
-            :return: array of score for each n-grams cosine similarity
-            '''
-            delta = float(length_hyp - length_ref)
-            # measure consine similarity
-            val = np.array([0.0 for _ in range(self.n)])
-            for n in range(self.n):
-                # ngram
-                for (ngram,count) in six.iteritems(vec_hyp[n]):
-                    # vrama91 : added clipping
-                    val[n] += min(vec_hyp[n][ngram], vec_ref[n][ngram]) * vec_ref[n][ngram]
-
-                if (norm_hyp[n] != 0) and (norm_ref[n] != 0):
-                    val[n] /= (norm_hyp[n]*norm_ref[n])
-
-                assert(not math.isnan(val[n]))
-                # vrama91: added a length based gaussian penalty
-                val[n] *= np.e**(-(delta**2)/(2*self.sigma**2))
-            return val
+    def counts2vec(self, cnts):
+        """
+        Function maps counts of ngram to vector of tfidf weights.
+        The function returns vec, an array of dictionary that store mapping of n-gram and tf-idf weights.
+        The n-th entry of array denotes length of n-grams.
+        :param cnts:
+        :return: vec (array of dict), norm (array of float), length (int)
+        """
+        # n-grams are word tuples, or the int64 keys of ngrams.py that encode their order
+        integer_keys = self.integer_keys
+        n_orders = self.n
+        vec = [defaultdict(float) for _ in range(self.n)]
+        length = 0
+        norm = [0.0 for _ in range(self.n)]
+        for (ngram,term_freq) in six.iteritems(cnts):
+            # give word count 1 if it doesn't appear in reference corpus
+            df = np.log(max(1.0, self.document_frequency.get(ngram, 0.0)))
+            # ngram index
+            n = ngram % n_orders if integer_keys else len(ngram)-1
+            # tf (term_freq) * idf (precomputed idf) for n-grams
+            vec[n][ngram] = float(term_freq)*(self.ref_len - df)
+            # compute norm for the vector.  the norm will be used for computing similarity
+            norm[n] += pow(vec[n][ngram], 2)
+
+            if n == 1:
+                length += term_freq
+        norm = [np.sqrt(n) for n in norm]
+        return vec, norm, length
+
+    def sim(self, vec_hyp, vec_ref, norm_hyp, norm_ref, length_hyp, length_ref):
+        '''
+        Compute the cosine similarity of two vectors.
+        :param vec_hyp: array of dictionary for vector corresponding to hypothesis
+        :param vec_ref: array of dictionary for vector corresponding to reference
+        :param norm_hyp: array of float for vector corresponding to hypothesis
+        :param norm_ref: array of float for vector corresponding to reference
+        :param length_hyp: int containing length of hypothesis
+        :param length_ref: int containing length of reference
+        :return: array of score for each n-grams cosine similarity
+        '''
+        delta = float(length_hyp - length_ref)
+        # measure consine similarity
+        val = np.array([0.0 for _ in range(self.n)])
+        for n in range(self.n):
+            # ngram
+            for (ngram,count) in six.iteritems(vec_hyp[n]):
+                # vrama91 : added clipping
+                # (`get`: the reference vectors may be cached, so missing n-grams are not inserted)
+                ref_weight = vec_ref[n].get(ngram, 0.0)
+                val[n] += min(vec_hyp[n][ngram], ref_weight) * ref_weight
+
+            if (norm_hyp[n] != 0) and (norm_ref[n] != 0):
+                val[n] /= (norm_hyp[n]*norm_ref[n])
+
+            assert(not math.isnan(val[n]))
+            # vrama91: added a length based gaussian penalty
+            val[n] *= np.e**(-(delta**2)/(2*self.sigma**2))
+        return val
+
+    def score_test(self, test, ref_vectors):
+        '''
+        CIDEr-D score of one cooked hypothesis against the vectors of its references.
+        :param test: n-gram counts of the hypothesis
+        :param ref_vectors: list of (vec, norm, length) of the references, from counts2vec
+        :return: score (float)
+        '''
+        # compute vector for test captions
+        vec, norm, length = self.counts2vec(test)
+        score = np.array([0.0 for _ in range(self.n)])
+        for vec_ref, norm_ref, length_ref in ref_vectors:
+            score += self.sim(vec, vec_ref, norm, norm_ref, length, length_ref)
+        # change by vrama91 - mean of ngram scores, instead of sum
+        score_avg = np.mean(score)
+        # divide by number of references
+        score_avg /= len(ref_vectors)
+        # multiply score by 10
+        score_avg *= 10.0
+        return score_avg
 
+    def compute_cider(self):
         # compute log reference length
         self.ref_len = np.log(float(len(self.crefs)))
 
         scores = []
         for test, refs in zip(self.ctest, self.crefs):
-            # compute vector for test captions
-            vec, norm, length = counts2vec(test)
             # compute vector for ref captions
-            score = np.array([0.0 for _ in range(self.n)])
-            for ref in refs:
-                vec_ref, norm_ref, length_ref = counts2vec(ref)
-                score += sim(vec, vec_ref, norm, norm_ref, length, length_ref)
-            # change by vrama91 - mean of ngram scores, instead of sum
-            score_avg = np.mean(score)
-            # divide by number of references
-            score_avg /= len(refs)
-            # multiply score by 10
-            score_avg *= 10.0
+            ref_vectors = [self.counts2vec(ref) for ref in refs]
             # append score of an image to the score list
-            scores.append(score_avg)
+            scores.append(self.score_test(test, ref_vectors))
         return scores
 
     def compute_score(self, option=None, verbose=0):
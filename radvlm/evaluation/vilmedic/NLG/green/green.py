@@ -5,8 +5,8 @@ import torch
 import torch.nn as nn
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from tqdm import tqdm
-
-pair_to_reward_dict = dict()
+from ...cpu_profile import resolve_device
+from .green_cache import GREENCache
 
 
 class GREENModel(nn.Module):
@@ -16,16 +16,19 @@ class GREENModel(nn.Module):
             do_sample=False,
             batch_size=4,
             return_0_if_no_green_score=True,
+            device=None,
     ):
         super().__init__()
+        # fp16 on GPU, fp32 on CPU where fp16 generation is slow or unsupported
+        self.device = resolve_device(device)
         self.do_sample = do_sample
         self.batch_size = batch_size
         self.return_0_if_no_green_score = return_0_if_no_green_score
         self.model = AutoModelForCausalLM.from_pretrained(
             pretrained_model_name_or_path=model_id_or_path,
             trust_remote_code=True,
-            device_map={"": "cuda:{}".format(torch.cuda.current_device())},
-            torch_dtype=torch.float16,
+            device_map={"": str(self.device)},
+            torch_dtype=torch.float16 if self.device.type == "cuda" else torch.float32,
         )
         self.model.eval()
 
@@ -58,6 +61,17 @@ class GREENModel(nn.Module):
         prompt = f"Objective: Evaluate the accuracy of a candidate radiology report in comparison to a reference radiology report composed by expert radiologists.\n\n    Process Overview: You will be presented with:\n\n    1. The criteria for making a judgment.\n    2. The reference radiology report.\n    3. The candidate radiology report.\n    4. The desired format for your assessment.\n\n    1. Criteria for Judgment:\n\n    For each candidate report, determine:\n\n    The count of clinically significant errors.\n    The count of clinically insignificant errors.\n\n    Errors can fall into one of these categories:\n\n    a) False report of a finding in the candidate.\n    b) Missing a finding present in the reference.\n    c) Misidentification of a finding's anatomic location/position.\n    d) Misassessment of the severity of a finding.\n    e) Mentioning a comparison that isn't in the reference.\n    f) Omitting a comparison detailing a change from a prior study.\n    Note: Concentrate on the clinical findings rather than the report's writing style. Evaluate only the findings that appear in both reports.\n\n    2. Reference Report:\n    {text1}\n\n    3. Candidate Report:\n    {text2}\n\n    4. Reporting Your Assessment:\n\n    Follow this specific format for your output, even if no errors are found:\n    ```\n    [Explanation]:\n    <Explanation>\n\n    [Clinically Significant Errors]:\n    (a) <Error Type>: <The number of errors>. <Error 1>; <Error 2>; ...; <Error n>\n    ....\n    (f) <Error Type>: <The number of errors>. <Error 1>; <Error 2>; ...; <Error n>\n\n    [Clinically Insignificant Errors]:\n    (a) <Error Type>: <The number of errors>. <Error 1>; <Error 2>; ...; <Error n>\n    ....\n    (f) <Error Type>: <The number of errors>. <Error 1>; <Error 2>; ...; <Error n>\n\n    [Matched Findings]:\n    <The number of matched findings>. <Finding 1>; <Finding 2>; ...; <Finding n>\n    ```\n"
         return prompt
 
+    def chat_texts(self, pairs):
+        """Prompt of each (reference, candidate) pair, formatted with the chat template."""
+        batch = [self.make_prompt(ref, hyp) for ref, hyp in pairs]
+        batch = [[{"from": "human", "value": prompt}, {"from": "gpt", "value": ""}] for prompt in batch]
+        return [
+            self.tokenizer.apply_chat_template(
+                i, tokenize=False, add_generation_prompt=True
+            )
+            for i in batch
+        ]
+
     def tokenize_batch_as_chat(self, batch):
         batch = [
             self.tokenizer.apply_chat_template(
@@ -65,7 +79,9 @@ class GREENModel(nn.Module):
             )
             for i in batch
         ]
+        return self.tokenize_texts(batch)
 
+    def tokenize_texts(self, batch):
         batch = self.tokenizer.batch_encode_plus(
             batch,
             return_tensors="pt",
@@ -175,58 +191,80 @@ class GREENModel(nn.Module):
         return matched_findings / (matched_findings + sum(sig_errors))
 
     def forward(self, input_ids, attention_mask):
-        print(len(input_ids))
         reward_model_responses = self.get_response(input_ids, attention_mask)
 
         greens = [self.compute_green(response) for response in reward_model_responses]
         greens = [green for green in greens if green is not None]
 
-        return torch.tensor(greens, dtype=torch.float).cuda()
+        return torch.tensor(greens, dtype=torch.float, device=input_ids.device)
 
 
 class GREEN(nn.Module):
-    def __init__(self, **kwargs):
+    """
+    GREEN score of (reference, candidate) pairs. Pairs are generated in batches of prompts of
+    similar length, of at most `batch_size` pairs and `max_batch_tokens` padded prompt tokens,
+    and the response of each pair is kept in a `GREENCache` (on disk with `cache=True`), so
+    that only the pairs never scored before are generated.
+    """
+
+    def __init__(self, device=None, cache=True, cache_dir=None, max_batch_tokens=8192, **kwargs):
         super().__init__()
-        self.model = GREENModel(**kwargs).cuda()
+        self.device = resolve_device(device)
+        self.max_batch_tokens = max_batch_tokens
+        self.model = GREENModel(device=self.device, **kwargs).to(self.device)
         self.model.eval()
-
-        print("Using {} GPUs!".format(torch.cuda.device_count()))
-        self.model = torch.nn.DataParallel(self.model)
+        self.cache = GREENCache(self.model.model.name_or_path, cache_dir=cache_dir, persistent=cache)
+
+    def make_batches(self, pairs):
+        """Token-budgeted batches of `pairs`, longest prompts first, with their chat texts."""
+        texts = self.model.chat_texts(pairs)
+        lengths = [len(ids) for ids in self.model.tokenizer(texts, truncation=True, max_length=2048)["input_ids"]]
+        order = sorted(range(len(pairs)), key=lambda i: lengths[i], reverse=True)
+        batches, batch = [], []
+        for i in order:
+            # Sorted by decreasing length, the first prompt of a batch is the padded length
+            padded_length = lengths[batch[0]] if batch else lengths[i]
+            if batch and (len(batch) >= self.model.batch_size or (len(batch) + 1) * padded_length > self.max_batch_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return [([pairs[i] for i in batch], [texts[i] for i in batch]) for batch in batches]
+
+    def score_pairs(self, pairs, progress=True):
+        """Generate and cache the responses of the `pairs` that are not cached yet."""
+        pairs = [pair for pair in dict.fromkeys(pairs) if pair not in self.cache]
+        if not pairs:
+            return
+        with torch.no_grad(), tqdm(total=len(pairs), desc="GREEN", unit="pair", disable=not progress) as bar:
+            for batch_pairs, batch_texts in self.make_batches(pairs):
+                batch = self.model.tokenize_texts(batch_texts)
+                responses = self.model.get_response(batch["input_ids"].to(self.device),
+                                                    batch["attention_mask"].to(self.device))
+                scores = [self.model.compute_green(response) for response in responses]
+                self.cache.put(batch_pairs, scores, responses)
+                bar.update(len(batch_pairs))
+
+    def cached_results(self, refs, hyps):
+        """(score, response) of each pair, None for the pairs that were not scored."""
+        return [self.cache.get(pair) for pair in zip(refs, hyps)]
 
     def forward(self, refs, hyps):
         assert len(refs) == len(hyps)
 
-        with torch.no_grad():
-            pairs_to_process = []
-            indices_to_process = []
-            final_scores = torch.zeros(len(refs))
-
-            for i, (ref, hyp) in enumerate(zip(refs, hyps)):
-                if (ref, hyp) in pair_to_reward_dict:
-                    final_scores[i] = pair_to_reward_dict[(ref, hyp)]
-                else:
-                    pairs_to_process.append((ref, hyp))
-                    indices_to_process.append(i)
-
-            if pairs_to_process:
-                batch = [self.model.module.make_prompt(ref, hyp) for ref, hyp in pairs_to_process]
-                batch = [[{"from": "human", "value": prompt}, {"from": "gpt", "value": ""}] for prompt in batch]
-                batch = self.model.module.tokenize_batch_as_chat(batch)
-
-                greens_tensor = self.model(batch['input_ids'], batch['attention_mask'])
-
-                if len(greens_tensor) == len(pairs_to_process):
-                    for i, (ref, hyp) in enumerate(pairs_to_process):
-                        score = greens_tensor[i]
-                        pair_to_reward_dict[(ref, hyp)] = score
-                        final_scores[indices_to_process[i]] = score
-                else:
-                    print("An inconsistency was detected in processing pairs.")
-
-            # Compute mean_green over the entire set of final_scores
-            mean_green = final_scores.mean()
-
-            return mean_green, final_scores
+        self.score_pairs(list(zip(refs, hyps)))
+        final_scores = torch.zeros(len(refs))
+        for i, result in enumerate(self.cached_results(refs, hyps)):
+            # The score is recomputed from the response, it depends on `return_0_if_no_green_score`
+            score = self.model.compute_green(result[1])
+            if score is not None:
+                final_scores[i] = score
+
+        # Compute mean_green over the entire set of final_scores
+        mean_green = final_scores.mean()
+
+        return mean_green, final_scores
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+import os
+import json
+import fcntl
+import hashlib
+
+# GREEN responses on disk. Generating a GREEN analysis takes seconds per pair, and most
+# (reference, candidate) pairs of a result file are unchanged between two evaluations, so the
+# raw response of the GREEN model and its score are kept for each pair that was scored.
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "radvlm", "green")
+
+
+def pair_hash(ref, hyp):
+    return hashlib.sha1("\0".join((ref, hyp)).encode()).hexdigest()
+
+
+class GREENCache(object):
+    """
+    (reference, candidate) -> (score, response) of one GREEN model, in memory and, with
+    `persistent=True`, appended to `<cache_dir>/<model>.jsonl` as pairs are scored. The file
+    can be shared by several processes: appends are serialized by a lock file, and `reload`
+    reads the pairs written by the others.
+
+    Args:
+        model_id_or_path (str): GREEN model the responses come from.
+        cache_dir (str): Directory of the cache file.
+        persistent (bool): Whether to read and write the cache file.
+    """
+
+    def __init__(self, model_id_or_path, cache_dir=None, persistent=True):
+        name = model_id_or_path.rstrip("/").replace("/", "--")
+        self.path = os.path.join(cache_dir or CACHE_DIR, f"{name}.jsonl") if persistent else None
+        self.entries = {}
+        self.reload()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, pair):
+        return pair_hash(*pair) in self.entries
+
+    def reload(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    key, score, response = json.loads(line)
+                except ValueError:  # line cut by an interrupted write
+                    continue
+                self.entries[key] = (score, response)
+
+    def get(self, pair):
+        """(score, response) of `pair`, or None if it was not scored."""
+        return self.entries.get(pair_hash(*pair))
+
+    def put(self, pairs, scores, responses):
+        lines = []
+        for pair, score, response in zip(pairs, scores, responses):
+            key = pair_hash(*pair)
+            self.entries[key] = (score, response)
+            lines.append(json.dumps([key, score, response]) + "\n")
+        if lines and self.path is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(self.path, "ab+") as f:
+                        # Terminate a line cut by an interrupted write, which `reload` skips
+                        if f.tell() > 0:
+                            f.seek(-1, os.SEEK_END)
+                            if f.read(1) != b"\n":
+                                lines.insert(0, "\n")
+                        f.write("".join(lines).encode())
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,193 @@
+import numpy as np
+
+# Shared n-gram featurization for BLEU and CIDEr-D. Words are mapped to integer ids once, and
+# each n-gram gets an int64 key built from the key of its (n-1)-gram prefix and its last word,
+# so that the n-grams of a whole corpus are extracted with numpy operations instead of one
+# tuple per n-gram. Keys are collision free and stay the same for the lifetime of a featurizer.
+
+_WORD_BITS = 31
+
+
+class NgramCounts(object):
+    """
+    N-gram counts of a list of sentences, in compressed sparse row layout: the n-grams of
+    sentence `i` are `keys[indptr[i]:indptr[i + 1]]` with counts `counts[indptr[i]:indptr[i + 1]]`.
+
+    Within a sentence the n-grams come in the order in which `precook` of the BLEU and
+    CIDEr-D scorers first meets them (by order, then by position), so that dictionaries
+    built from these arrays iterate in the same order as the original ones.
+    """
+
+    def __init__(self, n, lengths, indptr, keys, counts):
+        self.n = n
+        self.lengths = lengths
+        self.indptr = indptr
+        self.keys = keys
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def orders(self, keys=None):
+        """Order (1 to n) of each n-gram key."""
+        keys = self.keys if keys is None else keys
+        return keys % self.n + 1
+
+    def sentence_ids(self):
+        """Index of the sentence of each entry of `keys`."""
+        return np.repeat(np.arange(len(self.lengths)), np.diff(self.indptr))
+
+    def as_dicts(self):
+        """One {key: count} dictionary per sentence, for the CIDEr-D scorer."""
+        keys = self.keys.tolist()
+        counts = self.counts.tolist()
+        indptr = self.indptr.tolist()
+        return [dict(zip(keys[start:end], counts[start:end])) for start, end in zip(indptr[:-1], indptr[1:])]
+
+
+class NgramFeaturizer(object):
+    """
+    Maps sentences to the int64 keys of their 1- to n-grams.
+
+    Args:
+        n (int): Maximum n-gram order.
+
+    Example:
+        featurizer = NgramFeaturizer(n=4)
+        counts = featurizer.featurize(["there is no pneumothorax", "no pneumothorax"])
+    """
+
+    def __init__(self, n=4):
+        self.n = n
+        self.vocab = {}
+        # For each order k >= 2, the sorted (prefix id, word id) pairs seen so far and their ids
+        self._pairs = {k: np.zeros(0, dtype=np.int64) for k in range(2, n + 1)}
+        self._pair_ids = {k: np.zeros(0, dtype=np.int64) for k in range(2, n + 1)}
+
+    def _word_ids(self, sentences):
+        vocab = self.vocab
+        lengths = []
+        ids = []
+        for sentence in sentences:
+            words = sentence.split()
+            lengths.append(len(words))
+            for word in words:
+                word_id = vocab.get(word)
+                if word_id is None:
+                    word_id = vocab[word] = len(vocab)
+                ids.append(word_id)
+        if len(vocab) >= 2 ** _WORD_BITS:
+            raise ValueError(f"Vocabulary too large for {_WORD_BITS}-bit word ids: {len(vocab)}")
+        return np.array(lengths, dtype=np.int64), np.array(ids, dtype=np.int64)
+
+    def _ngram_ids(self, k, pairs):
+        """Ids of the k-grams given as (prefix id, word id) pairs, registering the new ones."""
+        known = self._pairs[k]
+        index = np.searchsorted(known, pairs)
+        found = index < len(known)
+        found[found] = known[index[found]] == pairs[found]
+        if not found.all():
+            new_pairs = np.unique(pairs[~found])
+            new_ids = np.arange(len(known), len(known) + len(new_pairs), dtype=np.int64)
+            merged = np.concatenate([known, new_pairs])
+            order = np.argsort(merged, kind="stable")
+            self._pairs[k] = merged[order]
+            self._pair_ids[k] = np.concatenate([self._pair_ids[k], new_ids])[order]
+            known = self._pairs[k]
+            index = np.searchsorted(known, pairs)
+        return self._pair_ids[k][index]
+
+    def featurize(self, sentences):
+        """Returns the `NgramCounts` of `sentences` (split on whitespace, as `precook`)."""
+        n = self.n
+        lengths, word_ids = self._word_ids(sentences)
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        sentence_of_word = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+        position = np.arange(len(word_ids), dtype=np.int64) - starts[sentence_of_word]
+        remaining = lengths[sentence_of_word] - position  # words from this one to the end of the sentence
+
+        # ids[i] is the id of the k-gram starting at word i, valid where remaining >= k
+        ids = word_ids
+        all_sentences = []
+        all_orders = []
+        all_positions = []
+        all_keys = []
+        for k in range(1, n + 1):
+            if k > 1:
+                num_positions = max(len(ids) - 1, 0)
+                valid = remaining[:num_positions] >= k
+                pairs = (ids[:num_positions][valid] << _WORD_BITS) | word_ids[k - 1:][valid]
+                ids = np.zeros(num_positions, dtype=np.int64)
+                ids[valid] = self._ngram_ids(k, pairs)
+                valid_positions = np.nonzero(valid)[0]
+            else:
+                valid_positions = np.arange(len(ids))
+            all_sentences.append(sentence_of_word[valid_positions])
+            all_orders.append(np.full(len(valid_positions), k, dtype=np.int64))
+            all_positions.append(position[valid_positions])
+            all_keys.append(ids[valid_positions] * n + (k - 1))
+        sentence = np.concatenate(all_sentences)
+        order = np.concatenate(all_orders)
+        position = np.concatenate(all_positions)
+        keys = np.concatenate(all_keys)
+
+        # Count each (sentence, key). The n-grams are listed by order then by word, so
+        # `return_index` gives the first occurrence of each one in its sentence
+        stride = int(keys.max(initial=0)) + 1
+        if len(lengths) * stride >= 2 ** 63:
+            raise ValueError("Too many sentences and n-grams for int64 keys, featurize fewer sentences at once")
+        _, first_index, counts = np.unique(sentence * stride + keys, return_index=True, return_counts=True)
+        sentence, order, position, keys = sentence[first_index], order[first_index], position[first_index], keys[first_index]
+
+        # Order of `precook`: by n-gram order, then by position of the first occurrence
+        max_length = int(lengths.max(initial=0)) + 1
+        by_occurrence = np.argsort((sentence * n + order - 1) * max_length + position)
+        keys = keys[by_occurrence]
+        counts = counts[by_occurrence]
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sentence, minlength=len(lengths)), out=indptr[1:])
+        return NgramCounts(n, lengths, indptr, keys, counts)
+
+
+def clipped_matches(test_counts, ref_counts):
+    """
+    Number of n-grams of each test sentence found in its reference, clipped to the count in
+    the reference, per order: an array of shape (number of sentences, n).
+    Both arguments must come from the same featurizer and have the same number of sentences.
+    """
+    n = test_counts.n
+    num_sentences = len(test_counts)
+    stride = int(max(test_counts.keys.max(initial=0), ref_counts.keys.max(initial=0))) + 1
+    test_keys = test_counts.sentence_ids() * stride + test_counts.keys
+    ref_keys = ref_counts.sentence_ids() * stride + ref_counts.keys
+    _, test_index, ref_index = np.intersect1d(test_keys, ref_keys, assume_unique=True, return_indices=True)
+    matches = np.minimum(test_counts.counts[test_index], ref_counts.counts[ref_index])
+    cells = test_counts.sentence_ids()[test_index] * n + test_counts.orders(test_counts.keys[test_index]) - 1
+    return np.bincount(cells, weights=matches, minlength=num_sentences * n).astype(np.int64).reshape(num_sentences, n)
+
+
+def cook_bleu(refs, hyps, n=4, featurizer=None):
+    """
+    BLEU statistics of each (single reference, hypothesis) pair, the same dictionaries as
+    `bleu_scorer.cook_test(hyp, cook_refs([ref]))`, ready for `BleuScorer.ctest`.
+    """
+    if featurizer is None:
+        featurizer = NgramFeaturizer(n)
+    ref_counts = featurizer.featurize(refs)
+    test_counts = featurizer.featurize(hyps)
+    return cook_bleu_counts(ref_counts, test_counts)
+
+
+def cook_bleu_counts(ref_counts, test_counts):
+    """`cook_bleu` from already featurized references and hypotheses."""
+    n = test_counts.n
+    correct = clipped_matches(test_counts, ref_counts).tolist()
+    cooked = []
+    for reflen, testlen, correct_k in zip(ref_counts.lengths.tolist(), test_counts.lengths.tolist(), correct):
+        cooked.append({
+            "reflen": [reflen],
+            "testlen": testlen,
+            "guess": [max(0, testlen - k + 1) for k in range(1, n + 1)],
+            "correct": correct_k,
+        })
+    return cooked
@@ -1,14 +1,36 @@
 import torch.nn as nn
-from rouge_score import rouge_scorer
+from rouge_score import rouge_scorer, tokenize, tokenizers
+from nltk.stem import porter
 from six.moves import zip_longest
 import numpy as np
 
 
+class MemoizedStemTokenizer(tokenizers.Tokenizer):
+    """
+    Same tokens as the default tokenizer of `rouge_scorer` with `use_stemmer=True`, but each
+    word is stemmed only once: radiology reports reuse a small vocabulary, so almost every
+    word is found in the cache.
+    """
+
+    def __init__(self):
+        self._stemmer = porter.PorterStemmer()
+        self._stems = {}
+
+    def stem(self, word):
+        stem = self._stems.get(word)
+        if stem is None:
+            stem = self._stems[word] = self._stemmer.stem(word)
+        return stem
+
+    def tokenize(self, text):
+        return tokenize.tokenize(text, self)
+
+
 class Rouge(nn.Module):
     def __init__(self, rouges, **kwargs):
         super().__init__()
         rouges = [r.replace('rougel', 'rougeL') for r in rouges]
-        self.scorer = rouge_scorer.RougeScorer(rouges, use_stemmer=True)
+        self.scorer = rouge_scorer.RougeScorer(rouges, tokenizer=MemoizedStemTokenizer())
         self.rouges = rouges
 
     def forward(self, refs, hyps):
@@ -22,6 +44,33 @@ class Rouge(nn.Module):
         return np.mean(f1_rouge), f1_rouge
 
 
+class RougeAll(nn.Module):
+    """
+    ROUGE-1, ROUGE-2 and ROUGE-L in a single pass: each reference and hypothesis is tokenized
+    and stemmed once, and the three variants are computed from the same tokens.
+    """
+
+    def __init__(self, rouges=("rouge1", "rouge2", "rougel"), **kwargs):
+        super().__init__()
+        self.names = list(rouges)
+        self.rouges = [r.replace('rougel', 'rougeL') for r in rouges]
+        self.scorer = rouge_scorer.RougeScorer(self.rouges, tokenizer=MemoizedStemTokenizer())
+
+    def forward(self, refs, hyps):
+        """Returns {name: (mean F1, per-sample F1 list)}, as `Rouge` for each variant."""
+        scores = []
+        for target_rec, prediction_rec in zip_longest(refs, hyps):
+            if target_rec is None or prediction_rec is None:
+                raise ValueError("Must have equal number of lines across target and "
+                                 "prediction.")
+            scores.append(self.scorer.score(target_rec, prediction_rec))
+        results = {}
+        for name, rouge in zip(self.names, self.rouges):
+            f1_rouge = [s[rouge].fmeasure for s in scores]
+            results[name] = (np.mean(f1_rouge), f1_rouge)
+        return results
+
+
 class Rouge1(Rouge):
     def __init__(self, **kwargs):
         super(Rouge1, self).__init__(rouges=['rouge1'])
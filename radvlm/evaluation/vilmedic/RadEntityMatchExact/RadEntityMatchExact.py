@@ -1,36 +1,56 @@
 import numpy as np
 import torch.nn as nn
-import stanza
-from stanza import Pipeline
 
 import logging
 
-stanza.download('en', processors='tokenize,lemma,pos,ner')
-stanza.download('en', package='radiology')
+from .ner_cache import NERCache, ReportEntities, compact_annotation
 
 
 class RadEntityMatchExact(nn.Module):
-    def __init__(self, **kwargs):
+    def __init__(self, ner_cache=True, cache_dir=None, ner=None, **kwargs):
         super().__init__()
-        self.ner = Pipeline(lang='en', package='radiology', processors={'tokenize': 'default', 'ner': 'radiology'},
-                            **{'tokenize_batch_size': 256, 'ner_batch_size': 256})
+        # Callable annotating a list of texts into stanza `Document`s, by default the stanza
+        # radiology pipeline. The annotations of another `ner` (e.g. the stand-in of
+        # `stand_in_metrics.py`) are only cached in memory.
+        self._ner = ner
         self.target_types = {'S-ANATOMY', 'S-OBSERVATION'}
+        # Annotations of the texts already seen, on disk with `ner_cache=True` and the stanza
+        # pipeline, whose annotations are the only ones stored under this name (see `ner_cache.py`)
+        self.ner_cache = NERCache("radiology_anatomy_observation", cache_dir=cache_dir,
+                                  persistent=ner_cache and ner is None)
+
+    @property
+    def ner(self):
+        # Loaded on first use, so that nothing is loaded when all the texts are cached
+        if self._ner is None:
+            import stanza
+            stanza.download('en', processors='tokenize,lemma,pos,ner')
+            stanza.download('en', package='radiology')
+            pipeline = stanza.Pipeline(lang='en', package='radiology',
+                                       processors={'tokenize': 'default', 'ner': 'radiology'},
+                                       **{'tokenize_batch_size': 256, 'ner_batch_size': 256})
+            self._ner = lambda texts: pipeline([stanza.Document([], text=text) for text in texts])
+        return self._ner
+
+    def annotate(self, texts):
+        """`ReportEntities` of each text, running the NER pipeline only on the texts not cached."""
+        texts = [text.lower().replace(' .', '.') for text in texts]
+        missing = [text for text in dict.fromkeys(texts) if text not in self.ner_cache]
+        if missing:
+            docs = self.ner(missing)
+            self.ner_cache.put(missing, [compact_annotation(doc, self.target_types) for doc in docs])
+        return [ReportEntities(self.ner_cache.get(text)) for text in texts]
 
     def forward(self, refs, hyps):
-        docs_h = self.ner([stanza.Document([], text=d.lower().replace(' .', '.')) for d in hyps])
-        docs_r = self.ner([stanza.Document([], text=d.lower().replace(' .', '.')) for d in refs])
+        docs_h = self.annotate(hyps)
+        docs_r = self.annotate(refs)
 
         scores_e = []
         for doc_h, doc_r in zip(docs_h, docs_r):
 
             # NER
-            ner_h = []
-            for sentence in doc_h.sentences:
-                ner_h.extend([ner['text'] for ner in sentence.to_dict() if ner['ner'] in self.target_types])
-
-            ner_r = []
-            for sentence in doc_r.sentences:
-                ner_r.extend([ner['text'] for ner in sentence.to_dict() if ner['ner'] in self.target_types])
+            ner_h = doc_h.all_entities()
+            ner_r = doc_r.all_entities()
 
             # precision
             match_p = sum([1.0 for ner in ner_h if ner in ner_r])
@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+
+# Radiology NER annotations on disk. RadEntityMatchExact and RadEntityNLI only need, for each
+# sentence of a report, its token texts and which tokens are ANATOMY/OBSERVATION entities, so
+# that is all that is kept of the stanza `Document`s, keyed by the hash of the annotated text.
+# The reference reports of a test set are then annotated once for every evaluated model.
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "radvlm", "ner")
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def compact_annotation(doc, target_types):
+    """
+    Compact form of a stanza `Document`: one [tokens, entity indices] pair per sentence, where
+    the entity indices are those of the tokens whose NER tag is in `target_types`.
+    """
+    sentences = []
+    for sentence in doc.sentences:
+        tokens = sentence.to_dict()
+        sentences.append([
+            [token['text'] for token in tokens],
+            [i for i, token in enumerate(tokens) if token['ner'] in target_types],
+        ])
+    return sentences
+
+
+class ReportEntities(object):
+    """
+    Sentences and entities of an annotated report.
+
+    Attributes:
+        sentences (list): Token texts of each sentence joined by spaces.
+        entities (list): Entity texts of each sentence.
+    """
+
+    def __init__(self, annotation):
+        self.sentences = [' '.join(tokens) for tokens, _ in annotation]
+        self.entities = [[tokens[i] for i in indices] for tokens, indices in annotation]
+
+    def all_entities(self):
+        return [entity for sentence_entities in self.entities for entity in sentence_entities]
+
+
+class NERCache(object):
+    """
+    Compact annotations (see `compact_annotation`) keyed by text hash, kept in memory and,
+    with `persistent=True`, appended to `<cache_dir>/<name>.jsonl` as texts are annotated.
+
+    Args:
+        name (str): Name of the NER pipeline and target types the annotations come from.
+        cache_dir (str): Directory of the cache file.
+        persistent (bool): Whether to read and write the cache file.
+    """
+
+    def __init__(self, name, cache_dir=None, persistent=True):
+        self.path = os.path.join(cache_dir or CACHE_DIR, f"{name}.jsonl") if persistent else None
+        self.annotations = {}
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        key, annotation = json.loads(line)
+                    except ValueError:  # line cut by an interrupted write
+                        continue
+                    self.annotations[key] = annotation
+
+    def __len__(self):
+        return len(self.annotations)
+
+    def __contains__(self, text):
+        return text_hash(text) in self.annotations
+
+    def get(self, text):
+        return self.annotations.get(text_hash(text))
+
+    def put(self, texts, annotations):
+        """Add the annotations of `texts` that are not cached yet."""
+        lines = []
+        for text, annotation in zip(texts, annotations):
+            key = text_hash(text)
+            if key in self.annotations:
+                continue
+            self.annotations[key] = annotation
+            lines.append(json.dumps([key, annotation], separators=(',', ':')) + '\n')
+        if lines and self.path is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.writelines(lines)
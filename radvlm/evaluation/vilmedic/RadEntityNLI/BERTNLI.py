@@ -62,6 +62,7 @@ class BERTNLI(torch.nn.Module):
         super(BERTNLI, self).cuda(device)
         if device != torch.device('cpu'):
             self.device = 'gpu'
+        return self
 
     def forward(self, sent1s, sent2s):
         buffer, boundaries, max_len = [], [], 0
@@ -99,7 +100,8 @@ class BERTNLI(torch.nn.Module):
             token_ids, attn_mask, seg_ids = data_cuda(token_ids, attn_mask, seg_ids, device=self.device)
         else:
             token_ids, attn_mask = data_cuda(token_ids, attn_mask, device=self.device)
-        out = self.bert(token_ids.cuda(), attention_mask=attn_mask.cuda(), token_type_ids=seg_ids.cuda())
+        # `data_cuda` already placed the inputs on the device of the model
+        out = self.bert(token_ids, attention_mask=attn_mask, token_type_ids=seg_ids)
         reps = out["last_hidden_state"]
         cls = out["pooler_output"]
         if self.cls == 'token':
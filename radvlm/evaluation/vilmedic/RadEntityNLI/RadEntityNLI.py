@@ -3,93 +3,153 @@ import torch
 import time
 import numpy as np
 import torch.nn as nn
-from vilmedic.blocks.scorers import RadEntityMatchExact
-from vilmedic.blocks.scorers.RadEntityNLI.nli import SimpleNLI
-from vilmedic.constants import EXTRA_CACHE_DIR
-from vilmedic.zoo.utils import download_model
+from ..RadEntityMatchExact.RadEntityMatchExact import RadEntityMatchExact
+from .nli import SimpleNLI
+from .nli_cache import checkpoint_fingerprint
 
 # from torchmetrics.functional.text.bert import BERTScorer
 from bert_score import BERTScorer
+from ..NLG.bertscore.embedding_cache import CachedBERTScorer, ReferenceEmbeddingCache
+from ..cpu_profile import apply_cpu_profile, check_cpu_profile, resolve_device
 
 from itertools import chain, product
 
 
 class RadEntityNLI(nn.Module):
-    def __init__(self, **kwargs):
+    def __init__(self, nli_batch_size=128, bertscore_batch_size=256, device=None, cpu_profile=None,
+                 nli_disk_cache=True, ner_cache=True, reference_cache=False, ner=None, nli_model=None,
+                 bert_scorer=None, **kwargs):
         super().__init__()
-        # NER types
-        self.target_types = {'S-ANATOMY', 'S-OBSERVATION'}
-        self.match_exact = RadEntityMatchExact()
-
-        # Downloading pretrain model from huggingface
-        checkpoint = os.path.join(EXTRA_CACHE_DIR, "model_medrad_19k.gz")
-        if not os.path.exists(checkpoint):
-            download_model(repo_id='StanfordAIMI/RRG_scorers', cache_dir=EXTRA_CACHE_DIR,
-                           filename="model_medrad_19k.gz")
-
-        # NLI scorer
-        model = SimpleNLI.load_model(checkpoint)
-        self.nli = SimpleNLI(model, batch=24, neutral_score=0.3333333333333333, nthreads=2, pin_memory=False,
-                             bert_score='distilbert-base-uncased', cache=200000,
-                             verbose=False)
+        # Device of the NLI and BERTScore models (CUDA when available by default), and on CPU
+        # the profile of their encoders, see `cpu_profile.py`
+        self.device = resolve_device(device)
+        self.cpu_profile = check_cpu_profile(cpu_profile, self.device)
+        # Sentence pairs of the whole corpus are scored together in batches of these sizes
+        self.nli_batch_size = nli_batch_size
+        self.bertscore_batch_size = bertscore_batch_size
+        # NER, with the annotations cached on disk
+        self.match_exact = RadEntityMatchExact(ner_cache=ner_cache, ner=ner)
+        self.target_types = self.match_exact.target_types
+
+        # The NLI model and the BERTScore encoder can be replaced (e.g. by the stand-ins of
+        # `stand_in_metrics.py`) by passing a BERTNLI on CPU as `nli_model` and an already
+        # created `bert_score.BERTScorer` as `bert_scorer`
+        cache_model_id = None
+        if nli_model is None:
+            from vilmedic.constants import EXTRA_CACHE_DIR
+            from vilmedic.zoo.utils import download_model
+
+            # Downloading pretrain model from huggingface
+            checkpoint = os.path.join(EXTRA_CACHE_DIR, "model_medrad_19k.gz")
+            if not os.path.exists(checkpoint):
+                download_model(repo_id='StanfordAIMI/RRG_scorers', cache_dir=EXTRA_CACHE_DIR,
+                               filename="model_medrad_19k.gz")
+            nli_model = SimpleNLI.load_model(checkpoint)
+
+            # The predictions are also cached on disk for this checkpoint and profile with
+            # `nli_disk_cache=True` (see `nli_cache.py`)
+            if nli_disk_cache:
+                cache_model_id = f"{checkpoint_fingerprint(checkpoint)}_{self.cpu_profile or 'fp32'}"
+        # The BERTScore model of the NLI scorer itself is not used by `forward`, and is only
+        # loaded along with the default encoder
+        self.nli = SimpleNLI(nli_model, batch=24, neutral_score=0.3333333333333333, nthreads=2, pin_memory=False,
+                             bert_score='distilbert-base-uncased' if bert_scorer is None else None, cache=200000,
+                             verbose=False, device=self.device, cpu_profile=self.cpu_profile,
+                             cache_model_id=cache_model_id)
 
         # BertSore
-        self.bert_scorer = BERTScorer(model_type='distilbert-base-uncased',
-                                      num_layers=5,
-                                      batch_size=64,
-                                      nthreads=4,
-                                      all_layers=False,
-                                      idf=False,
-                                      device='cuda',
-                                      lang='en',
-                                      rescale_with_baseline=True,
-                                      baseline_path=None)
+        if bert_scorer is None:
+            bert_scorer = BERTScorer(model_type='distilbert-base-uncased',
+                                     num_layers=5,
+                                     batch_size=64,
+                                     nthreads=4,
+                                     all_layers=False,
+                                     idf=False,
+                                     device=str(self.device),
+                                     lang='en',
+                                     rescale_with_baseline=True,
+                                     baseline_path=None)
+        self.bert_scorer = bert_scorer
+        if self.device.type == 'cpu':
+            apply_cpu_profile(self.bert_scorer._model, self.cpu_profile)
+        # With `reference_cache=True`, the embeddings of the reference sentences are cached on
+        # disk in fp16 across runs (see `NLG/bertscore/embedding_cache.py`)
+        if reference_cache:
+            self.bert_scorer = CachedBERTScorer(
+                self.bert_scorer,
+                ReferenceEmbeddingCache(self.bert_scorer.model_type, self.bert_scorer.num_layers,
+                                        variant=self.cpu_profile)
+            )
 
     def forward(self, refs, hyps):
         t = time.time()
         with torch.no_grad():
-            # # Getting radiology reports with rad entities
-            _, _, docs_h, docs_r = self.match_exact(refs, hyps)
-
-            scores_e = []
+            # Sentences and entities of the reports, from the NER cache of `match_exact`
+            docs_h = self.match_exact.annotate(hyps)
+            docs_r = self.match_exact.annotate(refs)
+
+            # Phase 1: sentences and entities of every document, and the BERTScore of all the
+            # (hypothesis sentence, reference sentence) pairs of the corpus in a single call
+            docs = []
+            cands, cand_refs = [], []
             for doc_h, doc_r in zip(docs_h, docs_r):
 
-                hyp_report = [' '.join([token['text'] for token in sentence.to_dict()]) for sentence in
-                              doc_h.sentences]
-                ref_report = [' '.join([token['text'] for token in sentence.to_dict()]) for sentence in
-                              doc_r.sentences]
+                hyp_report = doc_h.sentences
+                ref_report = doc_r.sentences
 
                 if len(hyp_report) == 0 or len(ref_report) == 0:
                     continue
 
-                ner_h = [[ner['text'] for ner in sentence.to_dict() if ner['ner'] in self.target_types] for sentence in
-                         doc_h.sentences]
-                ner_r = [[ner['text'] for ner in sentence.to_dict() if ner['ner'] in self.target_types] for sentence in
-                         doc_r.sentences]
+                # Entities of the target types of `match_exact`, per sentence
+                ner_h = doc_h.entities
+                ner_r = doc_r.entities
 
                 # getting all sentence pairs scores
                 pairs = list(product(hyp_report, ref_report))
-                _, _, f_scores = self.bert_scorer.score(
-                    cands=[p[0] for p in pairs],
-                    refs=[p[1] for p in pairs],
+                docs.append((hyp_report, ref_report, ner_h, ner_r, len(cands)))
+                cands += [p[0] for p in pairs]
+                cand_refs += [p[1] for p in pairs]
+
+            if cands:
+                _, _, all_f_scores = self.bert_scorer.score(
+                    cands=cands,
+                    refs=cand_refs,
                     verbose=False,
-                    batch_size=64,
+                    batch_size=self.bertscore_batch_size,
                 )
-
-                f_scores = torch.reshape(torch.tensor(f_scores), (len(hyp_report), len(ref_report)))
-
-                # self.bert_scorer.plot_example([p[0] for p in pairs][0], [p[1] for p in pairs][0])
-
+                all_f_scores = torch.as_tensor(all_f_scores)
+
+            # Phase 2: the NLI pairs of every document, between each sentence with entities and
+            # the most similar sentence of the other report, predicted in a single call
+            nli_requests = []
+            for hyp_report, ref_report, ner_h, ner_r, offset in docs:
+                f_scores = torch.reshape(all_f_scores[offset:offset + len(hyp_report) * len(ref_report)],
+                                         (len(hyp_report), len(ref_report)))
+                for hyp_sentence, hyp_sentence_entities, hyp_f_score in zip(hyp_report, ner_h, f_scores):
+                    # No entites in current sentence
+                    if hyp_sentence_entities:
+                        nli_requests.append((hyp_sentence, ref_report[torch.argmax(hyp_f_score)]))
+                for ref_sentence, ref_sentence_entities, ref_f_score in zip(ref_report, ner_r, f_scores.T):
+                    if ref_sentence_entities:
+                        nli_requests.append((ref_sentence, hyp_report[torch.argmax(ref_f_score)]))
+            nli_labels = iter(self.nli.predict_sorted(
+                [request[0] for request in nli_requests],
+                [request[1] for request in nli_requests],
+                batch_size=self.nli_batch_size,
+            )[1])
+
+            # Phase 3: precision and recall counts of each document, in the order of phase 2
+            scores_e = []
+            for hyp_report, ref_report, ner_h, ner_r, offset in docs:
                 # precision
                 match_p = 0
                 entity_ner_r = list(chain.from_iterable(ner_r))
                 total_p = 0
-                for hyp_sentence, hyp_sentence_entities, hyp_f_score in zip(hyp_report, ner_h, f_scores):
+                for hyp_sentence_entities in ner_h:
                     # No entites in current sentence
                     if not hyp_sentence_entities:
                         continue
-                    sim_index = torch.argmax(hyp_f_score)
-                    nli_label = self.nli.predict([hyp_sentence], [ref_report[sim_index]])[1][0]
+                    nli_label = next(nli_labels)
                     if nli_label == 'entailment':
                         match_p += 1
                     for entity in hyp_sentence_entities:
@@ -102,12 +162,11 @@ class RadEntityNLI(nn.Module):
                 match_r = 0
                 entity_ner_h = list(chain.from_iterable(ner_h))
                 total_r = 0
-                for ref_sentence, ref_sentence_entities, ref_f_score in zip(ref_report, ner_r, f_scores.T):
+                for ref_sentence_entities in ner_r:
                     # No entites in current sentence
                     if not ref_sentence_entities:
                         continue
-                    sim_index = torch.argmax(ref_f_score)
-                    nli_label = self.nli.predict([ref_sentence], [hyp_report[sim_index]])[1][0]
+                    nli_label = next(nli_labels)
                     if nli_label == 'entailment':
                         match_r += 1
                     for entity in ref_sentence_entities:
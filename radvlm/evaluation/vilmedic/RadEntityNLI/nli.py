@@ -9,11 +9,13 @@ import torch
 from collections import defaultdict, OrderedDict
 from bert_score.utils import bert_cos_score_idf, cache_scibert, get_idf_dict, get_model, lang2model, model2layers
 from .CacheTools import LRUCache
+from .nli_cache import TwoTierNLICache
 from torch.nn import DataParallel
 from torch.nn.functional import softmax
 from transformers import AutoTokenizer
 from nltk.tokenize import wordpunct_tokenize
 from .BERTNLI import BERTNLI
+from ..cpu_profile import apply_cpu_profile, check_cpu_profile, resolve_device
 
 
 class NLTKTokenizer:
@@ -33,7 +35,7 @@ class _NLIScorer:
     THRESH_NONE = 'none'
 
     def __init__(self, neutral_score=(1.0 / 3), batch=16, nthreads=2, pin_memory=False, bert_score=None,
-                 cache=None, verbose=False):
+                 cache=None, verbose=False, cache_model_id=None, cache_path=None):
         self.model = None
         self.neutral_score = neutral_score
         self.batch = batch
@@ -46,7 +48,11 @@ class _NLIScorer:
                                                lang='en', rescale_with_baseline=True)
         else:
             self.bert_score_model = None
-        self.cache = LRUCache(cache) if cache is not None else None
+        # With `cache_model_id`, the in-memory cache is backed by a SQLite table (see `nli_cache.py`)
+        if cache is not None and cache_model_id is not None:
+            self.cache = TwoTierNLICache(cache, cache_model_id, path=cache_path)
+        else:
+            self.cache = LRUCache(cache) if cache is not None else None
         self.verbose = verbose
         self.gpu = False
 
@@ -60,6 +66,17 @@ class _NLIScorer:
     def predict(self, premises, hypotheses):
         raise NotImplementedError
 
+    def flush_cache(self):
+        """Write the new pairs of a disk-backed cache to disk."""
+        if isinstance(self.cache, TwoTierNLICache):
+            self.cache.flush()
+
+    def cache_stats(self):
+        """Hit/miss statistics of a disk-backed cache, None otherwise."""
+        if isinstance(self.cache, TwoTierNLICache):
+            return self.cache.stats()
+        return None
+
     def sentence_scores_bert_score(self, texts1, texts2, label='entailment', thresh='none', prf='f'):
         # Calculate BertScores
         tids, tsents1, tsents2, bsents1, bsents2 = [], {}, {}, [], []
@@ -174,6 +191,7 @@ class _NLIScorer:
             rcs.append(mean_recall)
             fb1s.append(fb1)
             stats.append({'scores': sent_probs, 'threshes': (thresh1, thresh2)})
+        self.flush_cache()
         return prs, rcs, fb1s, stats
 
     def stop(self):
@@ -265,13 +283,23 @@ class BERTScorer:
 
 class SimpleNLI(_NLIScorer):
     def __init__(self, model, neutral_score=(1.0 / 3), batch=16, nthreads=2, pin_memory=False, bert_score=None,
-                 cache=None, verbose=False):
+                 cache=None, verbose=False, device=None, cpu_profile=None, cache_model_id=None, cache_path=None):
         super(SimpleNLI, self).__init__(neutral_score, batch, nthreads, pin_memory, bert_score, cache,
-                                        verbose)
-
+                                        verbose, cache_model_id, cache_path)
+
+        # `model` is a BERTNLI on CPU, moved to `device` (CUDA when available by default) or
+        # prepared for CPU inference with `cpu_profile` (see `cpu_profile.py`)
+        device = resolve_device(device)
+        cpu_profile = check_cpu_profile(cpu_profile, device)
+        if device.type == 'cuda':
+            # BERTNLI.cuda (not DataParallel.cuda) also moves its inputs to the GPU
+            model.cuda(device)
+            self.gpu = True
+        else:
+            apply_cpu_profile(model, cpu_profile)
+        self.device = device
+        self.cpu_profile = cpu_profile
         self.model = DataParallel(model)
-        self.model.cuda()
-        self.model.eval()
         self.model.eval()
 
     @classmethod
@@ -295,23 +323,53 @@ class SimpleNLI(_NLIScorer):
         if len(buf1) > 0:
             batches.append((buf1, buf2))
 
+        probs, preds = [], []
+        for b1, b2 in batches:
+            batch_probs, batch_preds = self._predict_batch(b1, b2)
+            probs += batch_probs
+            preds += batch_preds
+        return probs, preds
+
+    def _predict_batch(self, b1, b2):
         probs, preds = [], []
         with torch.no_grad():
-            for b1, b2 in batches:
-                out = self.model(b1, b2)
-                out = softmax(out, dim=-1).detach().cpu()
-                _, idxs = out.max(dim=-1)
-                for i, idx in enumerate(idxs):
-                    idx = int(idx)
-                    probs.append({'entailment': float(out[i][BERTNLI.LABEL_ENTAILMENT]),
-                                  'neutral': float(out[i][BERTNLI.LABEL_NEUTRAL]),
-                                  'contradiction': float(out[i][BERTNLI.LABEL_CONTRADICTION])})
-                    if idx == BERTNLI.LABEL_ENTAILMENT:
-                        preds.append('entailment')
-                    elif idx == BERTNLI.LABEL_NEUTRAL:
-                        preds.append('neutral')
-                    elif idx == BERTNLI.LABEL_CONTRADICTION:
-                        preds.append('contradiction')
-                    else:
-                        raise ValueError('Unknown label index {0}'.format(idx))
+            out = self.model(b1, b2)
+            out = softmax(out, dim=-1).detach().cpu()
+            for i in range(len(out)):
+                prob = {'entailment': float(out[i][BERTNLI.LABEL_ENTAILMENT]),
+                        'neutral': float(out[i][BERTNLI.LABEL_NEUTRAL]),
+                        'contradiction': float(out[i][BERTNLI.LABEL_CONTRADICTION])}
+                probs.append(prob)
+                preds.append(self._label(prob))
         return probs, preds
+
+    @staticmethod
+    def _label(prob):
+        # Most probable label, on ties the first one in the order of the BERTNLI outputs (as `max`)
+        return max(('entailment', 'neutral', 'contradiction'), key=lambda label: prob[label])
+
+    def predict_sorted(self, sent1s, sent2s, batch_size=None):
+        """
+        Same output as `predict`, for many pairs at once: each distinct pair is scored once,
+        in batches of `batch_size` pairs of similar length so that little padding is computed.
+        """
+        batch_size = batch_size or self.batch
+        unique_pairs = list(dict.fromkeys(zip(sent1s, sent2s)))
+        results = {}
+        if self.cache is not None:
+            for pair in unique_pairs:
+                prob = self.cache.get(pair)
+                if prob is not None:
+                    results[pair] = (prob, self._label(prob))
+            unique_pairs = [pair for pair in unique_pairs if pair not in results]
+        unique_pairs.sort(key=lambda pair: len(pair[0].split()) + len(pair[1].split()), reverse=True)
+        for start in range(0, len(unique_pairs), batch_size):
+            batch = unique_pairs[start:start + batch_size]
+            batch_probs, batch_preds = self._predict_batch([p[0] for p in batch], [p[1] for p in batch])
+            for pair, prob, pred in zip(batch, batch_probs, batch_preds):
+                results[pair] = (prob, pred)
+                if self.cache is not None:
+                    self.cache[pair] = prob
+        self.flush_cache()
+        pairs = list(zip(sent1s, sent2s))
+        return [results[pair][0] for pair in pairs], [results[pair][1] for pair in pairs]
@@ -0,0 +1,120 @@
+import os
+import json
+import sqlite3
+import hashlib
+
+from .CacheTools import LRUCache
+
+# NLI probabilities on disk. The (premise, hypothesis) pairs of a test set largely repeat
+# between evaluations of similar checkpoints, so the probabilities predicted for a pair are
+# stored in a SQLite table keyed by the hash of the pair and of the NLI model, and the
+# in-memory LRU cache of `_NLIScorer` falls back to it before running the model.
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "radvlm", "nli")
+
+
+def checkpoint_fingerprint(path, chunk_size=1 << 20):
+    """SHA-1 of the content of a checkpoint file, identifying the NLI model in the cache keys."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TwoTierNLICache(object):
+    """
+    `LRUCache` of (premise, hypothesis) -> probabilities backed by a SQLite table shared by
+    all the processes using `path`. Pairs missing from memory are looked up on disk and
+    promoted to memory; new pairs are written to disk by `flush`, and automatically every
+    `flush_every` insertions.
+
+    Args:
+        maxsize (int): Number of pairs kept in memory.
+        model_id (str): Identity of the NLI model (e.g. checkpoint fingerprint and CPU profile),
+            part of every key so that different models never share probabilities.
+        path (str): SQLite database, by default `nli.sqlite` in `CACHE_DIR`.
+        flush_every (int): Number of pending insertions that triggers a write to disk.
+    """
+
+    def __init__(self, maxsize, model_id, path=None, flush_every=1024):
+        self.memory = LRUCache(maxsize)
+        self.model_id = model_id
+        self.path = path or os.path.join(CACHE_DIR, "nli.sqlite")
+        self.flush_every = flush_every
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS nli (key TEXT PRIMARY KEY, probs TEXT NOT NULL)")
+        self.connection.commit()
+        self.pending = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _key(self, pair):
+        premise, hypothesis = pair
+        return hashlib.sha1("\0".join((self.model_id, premise, hypothesis)).encode()).hexdigest()
+
+    def _load(self, pair):
+        key = self._key(pair)
+        if key in self.pending:
+            return self.pending[key]
+        row = self.connection.execute("SELECT probs FROM nli WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get(self, pair, default=None):
+        """Probabilities of `pair` from memory, else from disk, counting hits and misses."""
+        if pair in self.memory:
+            self.memory_hits += 1
+            return self.memory[pair]
+        probs = self._load(pair)
+        if probs is None:
+            self.misses += 1
+            return default
+        self.disk_hits += 1
+        self.memory[pair] = probs
+        return probs
+
+    def __contains__(self, pair):
+        # Hits are counted by the `__getitem__` that follows, misses here
+        found = pair in self.memory or self._load(pair) is not None
+        if not found:
+            self.misses += 1
+        return found
+
+    def __getitem__(self, pair):
+        probs = self.get(pair)
+        if probs is None:
+            raise KeyError(pair)
+        return probs
+
+    def __setitem__(self, pair, probs):
+        self.memory[pair] = probs
+        self.pending[self._key(pair)] = probs
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write the pending pairs to disk."""
+        if not self.pending:
+            return
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO nli (key, probs) VALUES (?, ?)",
+            [(key, json.dumps(probs)) for key, probs in self.pending.items()]
+        )
+        self.connection.commit()
+        self.pending = {}
+
+    def stats(self):
+        """Hit and miss counts of the lookups since the cache was created."""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self.flush()
+        self.connection.close()
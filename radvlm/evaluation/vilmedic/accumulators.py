@@ -0,0 +1,320 @@
+import numpy as np
+from sklearn.metrics import accuracy_score, classification_report
+
+from .NLG.bleu.bleu_scorer import BleuScorer
+from .NLG.ngrams import cook_bleu
+from .registry import get_scorer
+
+# Streaming versions of the report metrics of `utils.calcAllMetrics_whole`. Each accumulator
+# is fed (references, predictions) batches with `update` as inference produces them, keeps
+# only the per-sample statistics needed by its metric, and gives the corpus-level result with
+# `compute`. Accumulators hold no model (the scorers come from `registry.py`), so they can be
+# pickled and gathered from distributed ranks, then combined with `merge`.
+
+
+class MetricAccumulator:
+    """Base class: `update(refs, hyps)`, `compute()` and `merge(other)`."""
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def update(self, refs, hyps):
+        if len(refs) != len(hyps):
+            raise ValueError(f"refs and hyps must have same length: {len(refs)} vs {len(hyps)}")
+        self._update(refs, hyps)
+        return self
+
+    def _update(self, refs, hyps):
+        raise NotImplementedError
+
+    def compute(self):
+        raise NotImplementedError
+
+    def merge(self, other):
+        if type(other) is not type(self):
+            raise TypeError(f"Cannot merge {type(other).__name__} into {type(self).__name__}")
+        self._merge(other)
+        return self
+
+    def _merge(self, other):
+        raise NotImplementedError
+
+
+class BleuAccumulator(MetricAccumulator):
+    """BLEU-n: keeps the cooked n-gram statistics of each sample, same result as `Bleu`."""
+
+    def __init__(self, n=4):
+        self.n = n
+        self.cooked = []
+
+    def __len__(self):
+        return len(self.cooked)
+
+    def _update(self, refs, hyps):
+        self.cooked.extend(cook_bleu(refs, hyps, n=self.n))
+
+    def _merge(self, other):
+        self.cooked.extend(other.cooked)
+
+    def compute(self):
+        bleu_scorer = BleuScorer(n=self.n)
+        bleu_scorer.ctest.extend(self.cooked)
+        score, scores = bleu_scorer.compute_score(option='closest', verbose=0)
+        return score[self.n - 1], scores[self.n - 1]
+
+
+class RougeAccumulator(MetricAccumulator):
+    """ROUGE-1/2/L: keeps the per-sample F-measures of each of the `rouges` variants."""
+
+    def __init__(self, rouges=("rouge1", "rouge2", "rougel")):
+        self.rouges = [rouge.lower() for rouge in rouges]
+        self.scores = {rouge: [] for rouge in self.rouges}
+
+    def __len__(self):
+        return len(self.scores[self.rouges[0]])
+
+    def _update(self, refs, hyps):
+        # All variants come from the same tokens (see `RougeAll`)
+        results = get_scorer("rouge")(refs, hyps)
+        for rouge in self.rouges:
+            self.scores[rouge].extend(results[rouge][1])
+
+    def _merge(self, other):
+        for rouge in self.rouges:
+            self.scores[rouge].extend(other.scores[rouge])
+
+    def compute(self):
+        """Returns {rouge: (mean F1, per-sample F1 list)}."""
+        return {rouge: (np.mean(scores), scores) for rouge, scores in self.scores.items()}
+
+
+class CiderDAccumulator(MetricAccumulator):
+    """
+    CIDEr-D: keeps the texts of each sample. The document frequencies depend on the whole
+    corpus, and the n-gram keys of `NgramFeaturizer` on the featurizer that created them, so
+    the corpus is featurized once by `compute`, with the same scorer as `utils.calcCiderD`.
+    """
+
+    def __init__(self):
+        self.refs = []
+        self.hyps = []
+
+    def __len__(self):
+        return len(self.hyps)
+
+    def _update(self, refs, hyps):
+        self.refs.extend(refs)
+        self.hyps.extend(hyps)
+
+    def _merge(self, other):
+        self.refs.extend(other.refs)
+        self.hyps.extend(other.hyps)
+
+    def compute(self):
+        return get_scorer("ciderd")(self.refs, self.hyps)
+
+
+class BertScoreAccumulator(MetricAccumulator):
+    """BERTScore: keeps the per-sample F1 (the baseline rescaling does not depend on the corpus)."""
+
+    def __init__(self):
+        self.scores = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def _update(self, refs, hyps):
+        self.scores.extend(get_scorer("bertscore")(refs, hyps)[1])
+
+    def _merge(self, other):
+        self.scores.extend(other.scores)
+
+    def compute(self):
+        return float(np.mean(self.scores)), self.scores
+
+
+class RadGraphAccumulator(MetricAccumulator):
+    """RadGraph F1: keeps the per-sample simple/partial/complete rewards."""
+
+    def __init__(self):
+        self.rewards = ([], [], [])
+
+    def __len__(self):
+        return len(self.rewards[0])
+
+    def _update(self, refs, hyps):
+        _, rewards, _, _ = get_scorer("radgraph")(refs, hyps)
+        for level, level_rewards in zip(self.rewards, rewards):
+            level.extend(level_rewards)
+
+    def _merge(self, other):
+        for level, level_rewards in zip(self.rewards, other.rewards):
+            level.extend(level_rewards)
+
+    def compute(self):
+        """Returns (simple, partial, complete) as `utils.calcF1RadGraph`."""
+        return tuple(sum(level) / len(level) for level in self.rewards)
+
+
+class CheXbertAccumulator(MetricAccumulator):
+    """
+    CheXbert F1: keeps the 14 labels of each reference and prediction, the classification
+    reports are computed over the whole corpus by `compute`. The label names are those of the
+    scorer (`target_names` and `target_names_5` of `f1chexbert.F1CheXbert`).
+    """
+
+    def __init__(self, target_names=None, target_names_5=None):
+        self.target_names = target_names
+        self.target_names_5 = target_names_5
+        self.ref_labels = []
+        self.hyp_labels = []
+
+    def __len__(self):
+        return len(self.hyp_labels)
+
+    def _set_label_names(self, chexbert):
+        self.target_names = list(chexbert.target_names)
+        self.target_names_5 = list(chexbert.target_names_5)
+
+    def _update(self, refs, hyps):
+        chexbert = get_scorer("chexbert")
+        self._set_label_names(chexbert)
+        self.ref_labels.extend(chexbert.get_label(ref.strip()) for ref in refs)
+        self.hyp_labels.extend(chexbert.get_label(hyp.strip()) for hyp in hyps)
+
+    def _merge(self, other):
+        if self.target_names is None:
+            self.target_names, self.target_names_5 = other.target_names, other.target_names_5
+        self.ref_labels.extend(other.ref_labels)
+        self.hyp_labels.extend(other.hyp_labels)
+
+    def _index_5(self):
+        if self.target_names is None:
+            self._set_label_names(get_scorer("chexbert"))
+        return np.where(np.isin(self.target_names, self.target_names_5))[0]
+
+    def compute_reports(self):
+        """Returns (accuracy, chexbert_all, chexbert_5) as computed by `F1CheXbert.forward`."""
+        index_5 = self._index_5()
+        ref_labels_5 = [np.array(r)[index_5] for r in self.ref_labels]
+        hyp_labels_5 = [np.array(h)[index_5] for h in self.hyp_labels]
+        accuracy = accuracy_score(y_true=ref_labels_5, y_pred=hyp_labels_5)
+        chexbert_all = classification_report(
+            self.ref_labels, self.hyp_labels, target_names=self.target_names, output_dict=True
+        )
+        chexbert_5 = classification_report(
+            ref_labels_5, hyp_labels_5, target_names=self.target_names_5, output_dict=True
+        )
+        return accuracy, chexbert_all, chexbert_5
+
+    def accuracy_per_sample(self):
+        """Whether the 5 main labels of each prediction all match the reference, as 0/1 floats."""
+        index_5 = self._index_5()
+        ref_labels_5 = np.array(self.ref_labels).reshape(len(self.ref_labels), -1)[:, index_5]
+        hyp_labels_5 = np.array(self.hyp_labels).reshape(len(self.hyp_labels), -1)[:, index_5]
+        return (ref_labels_5 == hyp_labels_5).all(axis=1).astype(float).tolist()
+
+    def compute(self):
+        """Returns the micro/macro F1 of all and of the 5 main labels, as `utils.calcChexbert`."""
+        _, chexbert_all, chexbert_5 = self.compute_reports()
+        return (
+            chexbert_all["micro avg"]["f1-score"],
+            chexbert_all["macro avg"]["f1-score"],
+            chexbert_5["micro avg"]["f1-score"],
+            chexbert_5["macro avg"]["f1-score"],
+        )
+
+
+class ReportMetricsAccumulator:
+    """
+    All the metrics of `utils.calcAllMetrics_whole`, fed one report pair at a time with `add`.
+    Pairs are buffered and passed to the accumulators `buffer_size` at a time, so that the
+    model-based scorers still run on batches.
+
+    Example:
+        accumulator = ReportMetricsAccumulator()
+        for reference, prediction in pairs:
+            accumulator.add(reference, prediction)
+        metrics = accumulator.compute()
+    """
+
+    def __init__(self, buffer_size=32):
+        self.buffer_size = buffer_size
+        self.buffer = ([], [])
+        self.accumulators = {
+            "bleu": BleuAccumulator(),
+            "bertscore": BertScoreAccumulator(),
+            "ciderd": CiderDAccumulator(),
+            "rouge": RougeAccumulator(),
+            "radgraph": RadGraphAccumulator(),
+            "chexbert": CheXbertAccumulator(),
+        }
+
+    def __len__(self):
+        return len(self.accumulators["bleu"]) + len(self.buffer[0])
+
+    def add(self, reference, prediction):
+        self.buffer[0].append(reference)
+        self.buffer[1].append(prediction)
+        if len(self.buffer[0]) >= self.buffer_size:
+            self.flush()
+
+    def update(self, refs, hyps):
+        for reference, prediction in zip(refs, hyps):
+            self.add(reference, prediction)
+        return self
+
+    def flush(self):
+        """Score the buffered pairs."""
+        refs, hyps = self.buffer
+        if refs:
+            for accumulator in self.accumulators.values():
+                accumulator.update(refs, hyps)
+        self.buffer = ([], [])
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        for name, accumulator in self.accumulators.items():
+            accumulator.merge(other.accumulators[name])
+        return self
+
+    def compute(self, return_per_sample=False):
+        """Returns the same dictionary (and per-sample scores) as `utils.calcAllMetrics_whole`."""
+        self.flush()
+        radgraph_simple, radgraph_partial, radgraph_complete = self.accumulators["radgraph"].compute()
+        chexbert_all_micro, chexbert_all_macro, chexbert_5_micro, chexbert_5_macro = (
+            self.accumulators["chexbert"].compute()
+        )
+        rouge = self.accumulators["rouge"].compute()
+        metrics = {
+            "blue": self.accumulators["bleu"].compute()[0],
+            "bertscore": self.accumulators["bertscore"].compute()[0],
+            "ciderd": self.accumulators["ciderd"].compute()[0],
+            "rouge1": rouge["rouge1"][0],
+            "rouge2": rouge["rouge2"][0],
+            "rougel": rouge["rougel"][0],
+            "radgraph_simple": radgraph_simple,
+            "radgraph_partial": radgraph_partial,
+            "radgraph_complete": radgraph_complete,
+            "chexbert_all_micro": chexbert_all_micro,
+            "chexbert_all_macro": chexbert_all_macro,
+            "chexbert_5_micro": chexbert_5_micro,
+            "chexbert_5_macro": chexbert_5_macro,
+        }
+        if return_per_sample:
+            chexbert_accuracy_list = self.accumulators["chexbert"].accuracy_per_sample()
+            radgraph_lists = self.accumulators["radgraph"].rewards
+            metrics["chexbert_5_accuracy"] = float(np.mean(chexbert_accuracy_list))
+            per_sample = {
+                "bertscore": self.accumulators["bertscore"].scores,
+                "rouge1": rouge["rouge1"][1],
+                "rouge2": rouge["rouge2"][1],
+                "rougel": rouge["rougel"][1],
+                "radgraph_simple": radgraph_lists[0],
+                "radgraph_partial": radgraph_lists[1],
+                "radgraph_complete": radgraph_lists[2],
+                "chexbert_5_accuracy": chexbert_accuracy_list,
+            }
+            return metrics, per_sample
+        return metrics
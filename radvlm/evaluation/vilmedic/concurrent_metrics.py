@@ -0,0 +1,116 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from .NLG.bleu.bleu_scorer import BleuScorer
+from .NLG.ngrams import NgramFeaturizer, cook_bleu
+from .registry import get_scorer
+
+# Scheduler running the lexical metrics (pure Python, CPU-bound) in a process pool while the
+# model-based metrics run in the main process. BLEU and ROUGE are split across workers by
+# sample range and merged so that the results are identical to a single sequential pass.
+# CIDEr-D needs the document frequencies of the whole corpus and runs as a single task, so in
+# the pool BLEU and CIDEr-D featurize their n-grams separately: the key of an n-gram depends on
+# the featurizer that created it, and the counts of separate workers cannot be merged without
+# sending their vocabularies back. With persisted reference statistics (`reference_set`), the
+# CIDEr-D task only featurizes the predictions, and BLEU is still split by sample range.
+
+ROUGE_METRICS = ["rouge1", "rouge2", "rougel"]
+
+
+def _rouge_chunk(targets, predictions):
+    """Per-sample ROUGE-1/2/L F-measures of a range of samples."""
+    results = get_scorer("rouge")(targets, predictions)
+    return {rouge: results[rouge][1] for rouge in ROUGE_METRICS}
+
+
+def _bleu_chunk(targets, predictions):
+    """Cook the BLEU statistics of a range of samples (see `ngrams.cook_bleu`)."""
+    return cook_bleu(targets, predictions)
+
+
+def _merge_bleu(cooked_chunks, n=4):
+    bleu_scorer = BleuScorer(n=n)
+    for cooked in cooked_chunks:
+        bleu_scorer.ctest.extend(cooked)
+    score, scores = bleu_scorer.compute_score(option='closest', verbose=0)
+    return score[n - 1], scores[n - 1]
+
+
+def _ciderd(targets, predictions, reference_set=None):
+    return get_scorer("ciderd")(targets, predictions, reference_set=reference_set)
+
+
+def compute_bleu_ciderd(targets, predictions, reference_set=None):
+    """
+    BLEU and CIDEr-D from a single n-gram featurization of the corpus (see `NLG/ngrams.py`).
+    CIDEr-D needs the document frequencies of the whole corpus, so this runs as a single task.
+    If `reference_set` is given, the reference side (n-gram counts, document frequencies and
+    CIDEr-D vectors) is loaded from the statistics persisted under that name, if any, so that
+    only the predictions are featurized.
+    """
+    if reference_set is not None:
+        stats = get_scorer("ciderd").reference_stats(reference_set, targets)
+        target_counts = stats.ref_counts
+        prediction_counts = stats.featurizer.featurize(predictions)
+        ciderd = stats.score_counts(prediction_counts)
+    else:
+        featurizer = NgramFeaturizer(n=4)
+        target_counts = featurizer.featurize(targets)
+        prediction_counts = featurizer.featurize(predictions)
+        ciderd = get_scorer("ciderd").compute_score_counts(target_counts, prediction_counts)
+    bleu = get_scorer("bleu").compute_score_counts(target_counts, prediction_counts)
+    return bleu, ciderd
+
+
+def compute_metrics_concurrently(target_list, prediction_list, neural_metrics, num_workers=None, reference_set=None):
+    """
+    Compute BLEU, CIDEr-D and ROUGE-1/2/L in a pool of `num_workers` processes while the
+    `neural_metrics` run in threads of the main process (where their models are loaded once,
+    see `registry.py`).
+
+    Args:
+        target_list (list): Reference reports.
+        prediction_list (list): Generated reports.
+        neural_metrics (dict): {name: function(target_list, prediction_list)}.
+        num_workers (int): Number of worker processes, defaults to the number of available cores (at most 8).
+        reference_set (str): Name of the persisted reference statistics of CIDEr-D (see `NLG/ciderD/ciderD.py`).
+
+    Returns:
+        dict: {name: result}, where the lexical results have the same (score, per-sample scores)
+        format as the `calc*` functions of `utils.py`.
+    """
+    if num_workers is None:
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        num_workers = max(1, min(8, num_cores))
+    chunk_size = max(1, -(-len(target_list) // num_workers))
+    ranges = [(start, start + chunk_size) for start in range(0, len(target_list), chunk_size)]
+
+    # Spawned workers: the parent may already hold CUDA contexts and running threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as process_pool, \
+            ThreadPoolExecutor(max_workers=max(1, len(neural_metrics))) as thread_pool:
+        ciderd_future = process_pool.submit(_ciderd, target_list, prediction_list, reference_set)
+        bleu_futures = [
+            process_pool.submit(_bleu_chunk, target_list[start:end], prediction_list[start:end])
+            for start, end in ranges
+        ]
+        rouge_futures = [
+            process_pool.submit(_rouge_chunk, target_list[start:end], prediction_list[start:end])
+            for start, end in ranges
+        ]
+        neural_futures = {
+            name: thread_pool.submit(metric, target_list, prediction_list)
+            for name, metric in neural_metrics.items()
+        }
+
+        results = {name: future.result() for name, future in neural_futures.items()}
+        results["ciderd"] = ciderd_future.result()
+        results["bleu"] = _merge_bleu([future.result() for future in bleu_futures])
+        rouge_chunks = [future.result() for future in rouge_futures]
+        for rouge in ROUGE_METRICS:
+            f1_rouge = [score for chunk in rouge_chunks for score in chunk[rouge]]
+            results[rouge] = (np.mean(f1_rouge), f1_rouge)
+    return results
@@ -0,0 +1,49 @@
+import os
+
+import torch
+
+# CPU execution profile of the BERT-based scorers (BertScore, RadEntityNLI and its BERTNLI),
+# for metric workers without a GPU. 'fp32' runs the encoders as they are, 'int8' quantizes the
+# weights of their `nn.Linear` layers to int8 with activations quantized on the fly, which
+# speeds up CPU inference at the cost of small score differences (see benchmark_cpu_metrics.py).
+
+METRIC_CPU_PROFILES = ("fp32", "int8")
+
+
+def resolve_device(device=None):
+    """`device` as a torch.device, defaulting to CUDA when available."""
+    if device is None:
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return torch.device(device)
+
+
+def set_cpu_threads(num_threads=None):
+    """Set the number of intra-op threads used by torch on CPU (defaults to all available cores)."""
+    if num_threads is None:
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(num_threads)
+    return torch.get_num_threads()
+
+
+def check_cpu_profile(cpu_profile, device):
+    """Validate `cpu_profile` for a scorer running on `device`, returning None for the default profile."""
+    if cpu_profile is None or cpu_profile == "fp32":
+        return None
+    if cpu_profile not in METRIC_CPU_PROFILES:
+        raise ValueError(f"Unknown CPU profile: {cpu_profile}. Choose among: {', '.join(METRIC_CPU_PROFILES)}")
+    if resolve_device(device).type != "cpu":
+        raise ValueError(f"The {cpu_profile} profile only runs on CPU, got device {device}")
+    return cpu_profile
+
+
+def apply_cpu_profile(model, cpu_profile):
+    """
+    Prepare a model already on CPU for inference with `cpu_profile` (in place), for the metric
+    encoders as well as the evaluated models (see `models_loading_inference.py`). With 'int8',
+    the weights of all `nn.Linear` layers are quantized to int8 and activations are quantized
+    on the fly (the remaining layers stay in fp32).
+    """
+    model.eval()
+    if cpu_profile == "int8":
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
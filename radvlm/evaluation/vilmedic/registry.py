@@ -0,0 +1,127 @@
+import gc
+
+import torch
+
+from . import Rouge, RougeAll, Bleu, Meteor, CiderD, BertScore
+from .cpu_profile import check_cpu_profile, set_cpu_threads
+
+# Process-wide registry of the report metric scorers. Each scorer is created on first use,
+# pinned to the configured device, and reused by all later calls (splits, tasks, models),
+# so that every model-based metric is loaded only once per process.
+
+_SCORERS = {}
+_DEVICE = None
+_CPU_PROFILE = None
+_REFERENCE_CACHE = False
+
+
+def _cpu_profile(device):
+    # The CPU profile only applies to scorers created on CPU
+    return _CPU_PROFILE if device.type == "cpu" else None
+
+
+def _radgraph_cuda_index(device):
+    # RadGraph takes a CUDA device index, or -1 for CPU
+    if device.type != "cuda":
+        return -1
+    return device.index if device.index is not None else 0
+
+
+def _chexbert(device):
+    # Imported on first use, so that the other metrics do not require the package
+    from f1chexbert import F1CheXbert
+    return F1CheXbert(device=device)
+
+
+def _radgraph(device):
+    from radgraph import F1RadGraph
+    return F1RadGraph(reward_level="all", model_type="radgraph-xl", cuda=_radgraph_cuda_index(device))
+
+
+_FACTORIES = {
+    "bleu": lambda device: Bleu(),
+    "meteor": lambda device: Meteor(),
+    "ciderd": lambda device: CiderD(),
+    "rouge1": lambda device: Rouge(rouges=["rouge1"]),
+    "rouge2": lambda device: Rouge(rouges=["rouge2"]),
+    "rougel": lambda device: Rouge(rouges=["rougel"]),
+    "rouge": lambda device: RougeAll(rouges=["rouge1", "rouge2", "rougel"]),
+    "bertscore": lambda device: BertScore(device=device, reference_cache=_REFERENCE_CACHE, cpu_profile=_cpu_profile(device)),
+    "chexbert": _chexbert,
+    "radgraph": _radgraph,
+}
+
+
+def set_device(device):
+    """
+    Set the device of the model-based scorers created from now on. Scorers that are already
+    loaded stay on their device until they are released.
+    """
+    global _DEVICE
+    _DEVICE = torch.device(device)
+
+
+def set_cpu_profile(cpu_profile, num_threads=None):
+    """
+    Set the CPU profile ('fp32' or 'int8', see `cpu_profile.py`) of the BERT-based scorers
+    created on CPU from now on, and the number of torch CPU threads (all cores by default).
+    """
+    global _CPU_PROFILE
+    _CPU_PROFILE = check_cpu_profile(cpu_profile, "cpu")
+    print(f"Metrics CPU profile: {cpu_profile}, {set_cpu_threads(num_threads)} threads")
+
+
+def set_reference_cache(enabled=True):
+    """
+    Cache the reference embeddings of the BERTScore scorer created from now on on disk, in
+    fp16 (see `NLG/bertscore/embedding_cache.py`). Off by default, since the fp16 rounding
+    makes the scores differ slightly (about 1e-4) from those of `bert_score`.
+    """
+    global _REFERENCE_CACHE
+    _REFERENCE_CACHE = enabled
+
+
+def get_cpu_profile():
+    return _CPU_PROFILE
+
+
+def get_device():
+    """Return the configured device, defaulting to CUDA when available."""
+    if _DEVICE is not None:
+        return _DEVICE
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def get_scorer(name):
+    """Return the scorer registered under `name`, creating it on first use."""
+    name = name.lower()
+    if name not in _FACTORIES:
+        raise ValueError(f"Unknown scorer: {name}. Choose among: {', '.join(_FACTORIES)}")
+    if name not in _SCORERS:
+        _SCORERS[name] = _FACTORIES[name](get_device())
+    return _SCORERS[name]
+
+
+def set_scorer(name, scorer):
+    """
+    Register an already created `scorer` under `name`, in place of the one of the factory,
+    e.g. a scorer without disk cache or with a stand-in model (see `benchmark_metrics.py`).
+    """
+    name = name.lower()
+    if name not in _FACTORIES:
+        raise ValueError(f"Unknown scorer: {name}. Choose among: {', '.join(_FACTORIES)}")
+    _SCORERS[name] = scorer
+
+
+def loaded_scorers():
+    return list(_SCORERS)
+
+
+def release(name=None):
+    """Release the scorer `name` (or all scorers if None) and free the memory of its model."""
+    names = list(_SCORERS) if name is None else [name.lower()]
+    for scorer_name in names:
+        _SCORERS.pop(scorer_name, None)
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
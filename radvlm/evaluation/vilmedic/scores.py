@@ -9,6 +9,7 @@ from f1chexbert import F1CheXbert
 from sklearn.metrics import classification_report, roc_auc_score
 from . import *
 from .utils import get_logger_directory
+from .registry import get_scorer
 
 # RadGraph package overrides logger, need to set back to default
 logging.setLoggerClass(logging.Logger)
@@ -72,15 +73,15 @@ def compute_scores(metrics, refs, hyps, split, seed, config, epoch, logger, dump
 
         # Iterating over metrics
         if metric == "BLEU":
-            scores["BLEU"] = Bleu()(refs, hyps)[0]
+            scores["BLEU"] = get_scorer("bleu")(refs, hyps)[0]
         elif metric == "METEOR":
-            scores["METEOR"] = Meteor()(refs, hyps)[0]
+            scores["METEOR"] = get_scorer("meteor")(refs, hyps)[0]
         elif metric == "CIDERD":
-            scores["CIDERD"] = CiderD()(refs, hyps)[0]
+            scores["CIDERD"] = get_scorer("ciderd")(refs, hyps)[0]
         elif metric == "bertscore":
-            scores["bertscore"] = BertScore()(refs, hyps)[0]
+            scores["bertscore"] = get_scorer("bertscore")(refs, hyps)[0]
         elif metric in ["ROUGE1", "ROUGE2", "ROUGEL"]:
-            scores[metric] = Rouge(rouges=[metric.lower()])(refs, hyps)[0]
+            scores[metric] = get_scorer(metric)(refs, hyps)[0]
         elif metric == "accuracy":
             scores["accuracy"] = round(
                 np.mean(np.array(refs) == np.argmax(hyps, axis=-1)) * 100, 2
@@ -94,10 +95,15 @@ def compute_scores(metrics, refs, hyps, split, seed, config, epoch, logger, dump
                 multi_class="ovr",
             )
         elif metric == "chexbert":
-            accuracy, accuracy_per_sample, chexbert_all, chexbert_5 = F1CheXbert(
-                refs_filename=base.format("refs.chexbert.txt") if dump else None,
-                hyps_filename=base.format("hyps.chexbert.txt") if dump else None,
-            )(hyps, refs)
+            # The shared scorer dumps its labels to the files of this split, if any
+            chexbert = get_scorer("chexbert")
+            chexbert.refs_filename = base.format("refs.chexbert.txt") if dump else None
+            chexbert.hyps_filename = base.format("hyps.chexbert.txt") if dump else None
+            try:
+                accuracy, accuracy_per_sample, chexbert_all, chexbert_5 = chexbert(hyps, refs)
+            finally:
+                chexbert.refs_filename = None
+                chexbert.hyps_filename = None
             scores["chexbert-5_micro avg_f1-score"] = chexbert_5["micro avg"][
                 "f1-score"
             ]
@@ -119,7 +125,7 @@ def compute_scores(metrics, refs, hyps, split, seed, config, epoch, logger, dump
                 scores["radgraph_simple"],
                 scores["radgraph_partial"],
                 scores["radgraph_complete"],
-            ) = F1RadGraph(reward_level="all", model_type="radgraph-xl")(
+            ) = get_scorer("radgraph")(
                 refs=refs, hyps=hyps
             )[
                 0
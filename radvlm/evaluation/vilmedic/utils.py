@@ -1,7 +1,8 @@
 from __future__ import absolute_import
+import numpy as np
 from . import *
-from radgraph import F1RadGraph
-from f1chexbert import F1CheXbert
+from .registry import get_scorer
+from .concurrent_metrics import compute_metrics_concurrently, compute_bleu_ciderd
 
 
 def calcAllMetrics_by_one_by_one(target, prediction):
@@ -33,22 +34,54 @@ def calcAllMetrics_by_one_by_one(target, prediction):
     }
 
 
-def calcAllMetrics_whole(target_list, prediction_list):
-    """Calculate all metrics between target and prediction."""
-    bleu = calcBLEU(target_list, prediction_list)
-    bert_score_average, bert_score_list = calcBertScore(target_list, prediction_list)
-    #meteor = calcMeteor(target_list, prediction_list)
-    ciderd = calcCiderD(target_list, prediction_list)
-    rouge1 = calcRouge(target_list, prediction_list, rouges="ROUGE1")
-    rouge2 = calcRouge(target_list, prediction_list, rouges="ROUGE2")
-    rougel = calcRouge(target_list, prediction_list, rouges="ROUGEL")
-    radgraph_simple, radgraph_partial, radgraph_complete = calcF1RadGraph(
-        target_list, prediction_list, batch=True
-    )
-    chexbert_all_micro, chexbert_all_macro, chexbert_5_micro, chexbert_5_macro = (
-        calcChexbert(target_list, prediction_list)
-    )
-    return {
+def calcAllMetrics_whole(target_list, prediction_list, num_workers=None, reference_set=None, return_per_sample=False):
+    """
+    Calculate all metrics between target and prediction.
+
+    The lexical metrics (BLEU, CIDEr-D, ROUGE) run in a pool of `num_workers` processes while
+    the model-based metrics (BERTScore, RadGraph, CheXbert) run in the main process
+    (see `concurrent_metrics.py`). Use `num_workers=0` to compute all metrics sequentially.
+    For a fixed test set, `reference_set` names the reference statistics of BLEU and CIDEr-D
+    persisted between calls (see `NLG/ciderD/ciderD.py`).
+    If `return_per_sample` is set, the per-sample scores of the metrics that are means over
+    the samples are returned as well, as {metric: list} (see `bootstrap.py`).
+    """
+    if num_workers == 0:
+        bleu, ciderd = compute_bleu_ciderd(target_list, prediction_list, reference_set=reference_set)
+        bert_score_average, bert_score_list = calcBertScore(target_list, prediction_list)
+        #meteor = calcMeteor(target_list, prediction_list)
+        rouge1, rouge2, rougel = calcRougeAll(target_list, prediction_list)
+        radgraph_simple, radgraph_partial, radgraph_complete, radgraph_lists = calcF1RadGraph(
+            target_list, prediction_list, batch=True, return_per_sample=True
+        )
+        chexbert_all_micro, chexbert_all_macro, chexbert_5_micro, chexbert_5_macro, chexbert_accuracy_list = (
+            calcChexbert(target_list, prediction_list, return_per_sample=True)
+        )
+    else:
+        results = compute_metrics_concurrently(
+            target_list,
+            prediction_list,
+            neural_metrics={
+                "bertscore": calcBertScore,
+                "radgraph": lambda target, prediction: calcF1RadGraph(
+                    target, prediction, batch=True, return_per_sample=True
+                ),
+                "chexbert": lambda target, prediction: calcChexbert(target, prediction, return_per_sample=True),
+            },
+            num_workers=num_workers,
+            reference_set=reference_set,
+        )
+        bleu = results["bleu"]
+        bert_score_average, bert_score_list = results["bertscore"]
+        ciderd = results["ciderd"]
+        rouge1 = results["rouge1"]
+        rouge2 = results["rouge2"]
+        rougel = results["rougel"]
+        radgraph_simple, radgraph_partial, radgraph_complete, radgraph_lists = results["radgraph"]
+        chexbert_all_micro, chexbert_all_macro, chexbert_5_micro, chexbert_5_macro, chexbert_accuracy_list = (
+            results["chexbert"]
+        )
+    metrics = {
         "blue": bleu[0],
         "bertscore": bert_score_average,
         #"meteor": meteor[0],
@@ -64,65 +97,99 @@ def calcAllMetrics_whole(target_list, prediction_list):
         "chexbert_5_micro": chexbert_5_micro,
         "chexbert_5_macro": chexbert_5_macro,
     }
+    if return_per_sample:
+        # The accuracy over the 5 main labels is reported as well, its mean is over the samples
+        metrics["chexbert_5_accuracy"] = float(np.mean(chexbert_accuracy_list))
+        per_sample = {
+            "bertscore": bert_score_list,
+            "rouge1": rouge1[1],
+            "rouge2": rouge2[1],
+            "rougel": rougel[1],
+            "radgraph_simple": radgraph_lists[0],
+            "radgraph_partial": radgraph_lists[1],
+            "radgraph_complete": radgraph_lists[2],
+            "chexbert_5_accuracy": chexbert_accuracy_list,
+        }
+        return metrics, per_sample
+    return metrics
 
 
 def calcBLEU(target, prediction):
     """Calculate BLEU score between target and prediction."""
-    return Bleu()(target, prediction)
+    return get_scorer("bleu")(target, prediction)
 
 
 def calcBertScore(target, prediction):
     """Calculate BERTScore between target and prediction."""
-    return BertScore()(target, prediction)
+    return get_scorer("bertscore")(target, prediction)
 
 
 def calcMeteor(target, prediction):
     """Calculate METEOR score between target and prediction."""
-    return Meteor()(target, prediction)
+    return get_scorer("meteor")(target, prediction)
 
 
-def calcCiderD(target, prediction):
+def calcCiderD(target, prediction, reference_set=None):
     """Calculate CIDEr-D score between target and prediction."""
-    return CiderD()(target, prediction)
+    return get_scorer("ciderd")(target, prediction, reference_set=reference_set)
 
 
 def calcRouge(target, prediction, rouges="ROUNGE1"):
     """Calculate ROUGE score between target and prediction."""
-    return Rouge(rouges=[rouges.lower()])(target, prediction)
+    return get_scorer(rouges)(target, prediction)
+
+
+def calcRougeAll(target, prediction):
+    """Calculate ROUGE-1, ROUGE-2 and ROUGE-L in a single pass over target and prediction."""
+    results = get_scorer("rouge")(target, prediction)
+    return results["rouge1"], results["rouge2"], results["rougel"]
 
 
-def calcF1RadGraph(target, prediction, batch=False):
-    """Calculate F1 score for RadGraph between target and prediction."""
+def calcF1RadGraph(target, prediction, batch=False, batch_size=64, return_per_sample=False):
+    """
+    Calculate F1 score for RadGraph between target and prediction.
+
+    With `batch=True`, the report pairs are scored in batches of `batch_size` pairs by the
+    shared scorer (see `registry.py`), and the per-sample simple/partial/complete rewards are averaged.
+    If `return_per_sample` is set, the per-sample reward lists are returned as well.
+    """
+    scorer = get_scorer("radgraph")
     if batch:
         simple_list = []
         partial_list = []
         complete_list = []
-        for t, p in zip(target, prediction):
-            simple, partial, complete = F1RadGraph(
-                reward_level="all", model_type="radgraph-xl"
-            )([t], [p])[0]
-            simple_list.append(simple)
-            partial_list.append(partial)
-            complete_list.append(complete)
+        for start in range(0, len(target), batch_size):
+            _, (simple, partial, complete), _, _ = scorer(
+                target[start:start + batch_size], prediction[start:start + batch_size]
+            )
+            simple_list.extend(simple)
+            partial_list.extend(partial)
+            complete_list.extend(complete)
         simple = sum(simple_list) / len(simple_list)  # average
         partial = sum(partial_list) / len(partial_list)
         complete = sum(complete_list) / len(complete_list)
+        if return_per_sample:
+            return simple, partial, complete, (simple_list, partial_list, complete_list)
         return simple, partial, complete
     else:
-        simple, partial, complete = F1RadGraph(
-            reward_level="all", model_type="radgraph-xl"
-        )(target, prediction)[0]
+        simple, partial, complete = scorer(target, prediction)[0]
         return simple, partial, complete
 
 
-def calcChexbert(target, prediction):
-    """Calculate F1 score for CheXbert between target and prediction."""
-    accuracy, accuracy_per_sample, chexbert_all, chexbert_5 = F1CheXbert(
-        refs_filename=None, hyps_filename=None
-    )(prediction, target)
-    return (
+def calcChexbert(target, prediction, return_per_sample=False):
+    """
+    Calculate F1 score for CheXbert between target and prediction.
+    If `return_per_sample` is set, the accuracy over the 5 main labels of each sample is returned as well.
+    """
+    accuracy, accuracy_per_sample, chexbert_all, chexbert_5 = get_scorer("chexbert")(
+        prediction, target
+    )
+    scores = (
         chexbert_all["micro avg"]["f1-score"],
         chexbert_all["macro avg"]["f1-score"],
         chexbert_5["micro avg"]["f1-score"],
         chexbert_5["macro avg"]["f1-score"],
     )
+    if return_per_sample:
+        return scores + (list(accuracy_per_sample),)
+    return scores
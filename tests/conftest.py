@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# `radvlm` requires DATA_DIR at import time; the tests do not read any dataset
+os.environ.setdefault("DATA_DIR", tempfile.gettempdir())
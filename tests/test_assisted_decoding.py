@@ -0,0 +1,108 @@
+import pytest
+import torch
+import transformers
+
+from radvlm.evaluation.assisted_decoding import AssistedDecodingStats, summarize_decoding_stats
+from radvlm.evaluation.models_loading_inference import load_draft_model
+
+# Assisted generation on CPU with tiny randomly initialized LLaVA-OV models sharing a
+# vocabulary. Greedy outputs must not depend on the draft model, and the acceptance rate
+# estimated by `AssistedDecodingStats` from forward-pass counts must match the one counted
+# round by round from the candidates of the draft model.
+
+
+def tiny_llava_onevision_config(hidden_size=32, num_layers=2):
+    return transformers.LlavaOnevisionConfig(
+        vision_config=dict(model_type="siglip_vision_model", hidden_size=16, intermediate_size=32,
+                           num_hidden_layers=1, num_attention_heads=2, image_size=28, patch_size=14),
+        text_config=dict(model_type="qwen2", vocab_size=128, hidden_size=hidden_size,
+                         intermediate_size=2 * hidden_size, num_hidden_layers=num_layers, num_attention_heads=2,
+                         num_key_value_heads=2, max_position_embeddings=256),
+        image_token_index=127,
+        video_token_index=126,
+        image_grid_pinpoints=[[28, 28]],
+    )
+
+
+def build_model(config, seed):
+    torch.manual_seed(seed)
+    return load_draft_model(config, cpu_profile='fp32')
+
+
+def generate(model, input_ids, assistant_model=None):
+    """Greedy generation (assisted if `assistant_model` is given) and its decoding statistics."""
+    stats = AssistedDecodingStats(model, assistant_model).attach()
+    try:
+        output = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                assistant_model=assistant_model, do_sample=False, max_new_tokens=24,
+                                pad_token_id=0, eos_token_id=125)
+    finally:
+        stats.detach()
+    return output, summarize_decoding_stats([stats.counts()])
+
+
+@pytest.fixture(scope="module")
+def target():
+    return build_model(tiny_llava_onevision_config(), seed=0)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_greedy_outputs_unchanged_with_draft_model(target, seed):
+    draft = build_model(tiny_llava_onevision_config(hidden_size=16, num_layers=1), seed=seed + 1)
+    input_ids = torch.randint(0, 120, (1, 10), generator=torch.Generator().manual_seed(seed))
+    reference, _ = generate(target, input_ids)
+    assisted, stats = generate(target, input_ids, assistant_model=draft)
+    assert torch.equal(assisted, reference)
+    assert stats["generated_tokens"] == reference.shape[-1] - input_ids.shape[-1]
+    assert stats["draft_forward_passes"] > 0
+    assert 0.0 <= stats["acceptance_rate"] <= 1.0
+
+
+def counted_acceptance_rate(target, draft, input_ids):
+    """
+    Acceptance rate counted from the candidates of the draft model: with greedy decoding, the
+    accepted candidates of a round are its longest prefix matching the final output.
+    """
+    rounds = []
+    draft_generate = draft.generate
+
+    def recording_generate(*args, **kwargs):
+        output = draft_generate(*args, **kwargs)
+        start = kwargs.get("input_ids", args[0] if args else None).shape[-1]
+        sequences = output.sequences if hasattr(output, "sequences") else output
+        rounds.append((start, sequences[0, start:].tolist()))
+        return output
+
+    draft.generate = recording_generate
+    try:
+        output, stats = generate(target, input_ids, assistant_model=draft)
+    finally:
+        del draft.generate
+    accepted = 0
+    for start, candidates in rounds:
+        for candidate, token in zip(candidates, output[0, start:].tolist()):
+            if candidate != token:
+                break
+            accepted += 1
+    drafted = sum(len(candidates) for _, candidates in rounds)
+    return accepted / drafted, stats
+
+
+@pytest.mark.parametrize("identical", [False, True])
+def test_estimated_acceptance_rate(target, identical):
+    if identical:
+        draft = build_model(tiny_llava_onevision_config(), seed=0)
+    else:
+        draft = build_model(tiny_llava_onevision_config(hidden_size=16, num_layers=1), seed=1)
+    for seed in range(4):
+        input_ids = torch.randint(0, 120, (1, 10), generator=torch.Generator().manual_seed(seed))
+        acceptance_rate, stats = counted_acceptance_rate(target, draft, input_ids)
+        assert stats["acceptance_rate"] == pytest.approx(acceptance_rate)
+        if identical:
+            assert stats["acceptance_rate"] > 0.5
+            assert stats["target_forward_passes"] < stats["generated_tokens"]
+
+
+def test_load_draft_model_keeps_created_model(target):
+    assert load_draft_model(target, cpu_profile='fp32') is target
+    assert not target.training
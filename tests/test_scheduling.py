@@ -0,0 +1,50 @@
+import os
+import socket
+
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from radvlm.evaluation.scheduling import DynamicChunkSampler, get_shared_store
+
+# `DynamicChunkSampler` on two gloo ranks sharing the TCP store of `get_shared_store`.
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def pull_indices(rank, world_size, port):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        assert get_shared_store() is get_shared_store()
+        # Two samplers created one after the other, e.g. for two tasks, with different chunk sizes
+        first = DynamicChunkSampler(list(range(50)), chunk_size=4)
+        first_indices = list(first)
+        second = DynamicChunkSampler(list(range(100, 110)), chunk_size=3)
+        second_indices = list(second)
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, (first_indices, second_indices, first.num_chunks_pulled))
+        if rank == 0:
+            first_all = [idx for indices, _, _ in gathered for idx in indices]
+            second_all = [idx for _, indices, _ in gathered for idx in indices]
+            # Every index exactly once across the ranks
+            assert sorted(first_all) == list(range(50))
+            assert sorted(second_all) == list(range(100, 110))
+            assert sum(num_chunks for _, _, num_chunks in gathered) == 13
+    finally:
+        dist.destroy_process_group()
+
+
+def test_dynamic_chunk_sampler_covers_all_indices_once_on_two_ranks():
+    # Failures of the ranks are raised here by `mp.spawn`
+    mp.spawn(pull_indices, args=(2, free_port()), nprocs=2)
+
+
+def test_dynamic_chunk_sampler_without_process_group():
+    sampler = DynamicChunkSampler(list(range(10)), chunk_size=4)
+    assert sampler.store is None
+    assert list(sampler) == list(range(10))
+    assert sampler.num_chunks_pulled == 3